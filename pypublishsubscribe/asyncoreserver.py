@@ -0,0 +1,650 @@
+"""An HTTP/1.1 front end to a PublishSubscribeEngine, built on the
+standard library's asyncore event loop rather than Twisted. It
+serves the same paths, with the same semantics, as the Twisted
+front end in publishsubscribeserver.py. Connections are kept alive
+between requests, and pipelined requests are handled one after
+another, in the order they arrived, as Twisted does.
+
+Run it with "--frontend asyncore", or embed it in another program
+by creating an EventLoop, an HTTPServer on it, and calling the
+loop's "run" method from the thread that will own the engine.
+
+Everything is kept in memory: durable storage and worker processes
+depend on the Twisted reactor, and so need the Twisted front end."""
+import time
+import json
+import heapq
+import socket
+import signal
+import urllib
+import httplib
+import asyncore
+import asynchat
+import itertools
+import traceback
+import urlparse
+from collections import deque
+from pypublishsubscribe.engine import get_positive_arg, EXPIRY_TICK, USER_PATH
+from pypublishsubscribe.framing import frame_parts, decode_frames, FRAMED_CONTENT_TYPE
+from pypublishsubscribe.frontend import TopicWatch, TopicStream, UserFetch
+from pypublishsubscribe.metrics import METRICS_PATH
+from pypublishsubscribe.patterns import is_pattern
+from pypublishsubscribe.payload import encode_message
+from pypublishsubscribe.topic import TopicFull, ServerFull
+
+# The most requests read ahead of the one being answered. Beyond
+# this we stop reading from the connection until we catch up.
+MAX_PIPELINED = 32
+
+# The longest request head, in bytes, that will be accepted.
+MAX_HEAD_BYTES = 64 * 1024
+
+class Timer(object):
+    """A call scheduled on an EventLoop, which can be cancelled
+        until it has been made."""
+
+    def __init__(self, when, function, args):
+        self.when = when
+        self.function = function
+        self.args = args
+        self.called = False
+        self.cancelled = False
+
+    def active(self):
+        return not self.called and not self.cancelled
+
+    def cancel(self):
+        self.cancelled = True
+
+class EventLoop(object):
+    """asyncore's loop over its own map of channels, with timers."""
+
+    def __init__(self):
+        self.map = {}
+        self.timers = []
+        self.counter = itertools.count()
+        self.running = False
+
+    def call_later(self, delay, function, *args):
+        timer = Timer(time.time() + delay, function, args)
+        # The counter keeps timers due at the same time in the
+        # order they were scheduled.
+        heapq.heappush(self.timers, (timer.when, next(self.counter), timer))
+        return timer
+
+    def run(self):
+        """Run until "stop" is called, which may be from another
+            thread. Stopping can take up to a second."""
+        self.running = True
+        while self.running:
+            now = time.time()
+            while self.timers and self.timers[0][0] <= now:
+                timer = heapq.heappop(self.timers)[2]
+                if timer.active():
+                    timer.called = True
+                    timer.function(*timer.args)
+            timeout = 1.0
+            if self.timers:
+                timeout = max(0, min(timeout, self.timers[0][0] - now))
+            if self.map:
+                # poll, unlike select, isn't limited to descriptors
+                # below FD_SETSIZE, so many connections can be open.
+                asyncore.loop(timeout, use_poll=True, map=self.map, count=1)
+            else:
+                time.sleep(timeout)
+
+    def stop(self):
+        self.running = False
+
+class Request(object):
+    """A parsed HTTP request. "postpath" and "args" are as in a
+        Twisted request: the unquoted segments of the path, and the
+        values of each query string argument."""
+
+    def __init__(self, method, uri, version, headers):
+        self.method = method
+        self.uri = uri
+        self.version = version
+        self.headers = headers
+        path, query = urlparse.urlsplit(uri)[2:4]
+        self.postpath = [urllib.unquote(segment) for segment in path[1:].split("/")]
+        self.args = urlparse.parse_qs(query, True)
+        self.body = ""
+
+    def getHeader(self, name):
+        return self.headers.get(name.lower())
+
+    def keep_alive(self):
+        connection = (self.getHeader("Connection") or "").lower()
+        if self.version == "HTTP/1.1":
+            return connection != "close"
+        return connection == "keep-alive"
+
+class Response(object):
+    """The response to one request on an HTTPChannel. It is either
+        finished in one go, or started as a stream that is written
+        to in chunks and then ended."""
+
+    def __init__(self, channel, request):
+        self.channel = channel
+        self.request = request
+        self.code = 200
+        self.headers = {"Content-Type": "text/html"}
+        self.keep_alive = request.keep_alive()
+        self.streaming = False
+        self.finished = False
+        self.finish_callbacks = []
+
+    def set_header(self, name, value):
+        self.headers[name] = value
+
+    def notify_finish(self, callback):
+        """Call "callback" once the response is finished, with
+            True, or the connection is lost first, with False."""
+        self.finish_callbacks.append(callback)
+
+    def finish(self, code, body=""):
+        """Send the whole response. "body" is a string, or a list
+            of strings to be sent one after another."""
+        if self.finished:
+            return
+        self.code = code
+        parts = [body] if isinstance(body, str) else body
+        self.headers["Content-Length"] = str(sum(map(len, parts)))
+        self.channel.push_parts([self.head()] + parts)
+        self.done(True)
+
+    def start_stream(self, code):
+        self.code = code
+        self.streaming = True
+        if self.request.version == "HTTP/1.1":
+            self.headers["Transfer-Encoding"] = "chunked"
+        else:
+            # Without chunked encoding, the end of the stream can
+            # only be marked by closing the connection.
+            self.keep_alive = False
+        self.channel.push(self.head())
+
+    def write(self, data):
+        if data and not self.finished:
+            if self.request.version == "HTTP/1.1":
+                self.channel.push_parts(["%x\r\n" % len(data), data, "\r\n"])
+            else:
+                self.channel.push(data)
+
+    def end_stream(self):
+        if self.request.version == "HTTP/1.1":
+            self.channel.push("0\r\n\r\n")
+        self.done(True)
+
+    def head(self):
+        lines = ["%s %d %s" % (self.request.version, self.code, httplib.responses.get(self.code, ""))]
+        if not self.keep_alive:
+            self.headers["Connection"] = "close"
+        elif self.request.version != "HTTP/1.1":
+            self.headers["Connection"] = "keep-alive"
+        lines.extend("%s: %s" % header for header in sorted(self.headers.iteritems()))
+        return "\r\n".join(lines) + "\r\n\r\n"
+
+    def done(self, completed):
+        if self.finished:
+            return
+        self.finished = True
+        for callback in self.finish_callbacks:
+            callback(completed)
+        if completed:
+            self.channel.response_done(self)
+
+class BufferProducer(object):
+    """Produces a string for asynchat to send, in pieces that are
+        views onto it rather than copies of it."""
+
+    def __init__(self, data, size):
+        self.data = data
+        self.size = size
+        self.position = 0
+
+    def more(self):
+        if self.position >= len(self.data):
+            return ""
+        piece = buffer(self.data, self.position, self.size)
+        self.position += self.size
+        return piece
+
+class HTTPChannel(asynchat.async_chat):
+    """A single client connection. Requests are parsed as they
+        arrive, queued, and handed to the front end one at a time,
+        so that pipelined requests are answered in order."""
+
+    # Send in larger pieces than asynchat's default of 4KB.
+    ac_out_buffer_size = 64 * 1024
+
+    def __init__(self, sock, front_end, loop):
+        asynchat.async_chat.__init__(self, sock, map=loop.map)
+        self.front_end = front_end
+        self.set_terminator("\r\n\r\n")
+        self.incoming = []
+        self.incoming_bytes = 0
+        # The request whose body is being read, if any.
+        self.reading = None
+        self.queue = deque()
+        self.current = None
+        self.processing = False
+        self.rejected = False
+
+    def readable(self):
+        return (not self.rejected and len(self.queue) < MAX_PIPELINED and
+                asynchat.async_chat.readable(self))
+
+    def collect_incoming_data(self, data):
+        if self.rejected:
+            return
+        self.incoming.append(data)
+        self.incoming_bytes += len(data)
+        if self.reading is None and self.incoming_bytes > MAX_HEAD_BYTES:
+            self.reject(431)
+
+    def found_terminator(self):
+        if self.rejected:
+            return
+        data = "".join(self.incoming)
+        self.incoming = []
+        self.incoming_bytes = 0
+        if self.reading is not None:
+            request = self.reading
+            request.body = data
+            self.reading = None
+            self.set_terminator("\r\n\r\n")
+            self.queue_request(request)
+            return
+        # Clients may send blank lines between requests.
+        data = data.lstrip("\r\n")
+        if not data:
+            return
+        lines = data.split("\r\n")
+        try:
+            method, uri, version = lines[0].split(" ")
+            headers = {}
+            for line in lines[1:]:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+            length = int(headers.get("content-length", 0))
+        except ValueError:
+            self.reject(400)
+            return
+        if version not in ("HTTP/1.0", "HTTP/1.1") or length < 0:
+            self.reject(400)
+            return
+        if "transfer-encoding" in headers:
+            # Only bodies with a Content-Length are supported.
+            self.reject(411)
+            return
+        request = Request(method, uri, version, headers)
+        if length:
+            self.reading = request
+            self.set_terminator(length)
+        else:
+            self.queue_request(request)
+
+    def push_parts(self, parts):
+        """Send a sequence of strings. Runs of small ones are joined
+            and sent together, but a large one, such as a big message,
+            is sent straight from the string itself: asynchat would
+            otherwise copy it into pieces before sending them."""
+        small = []
+        for part in parts:
+            if len(part) <= self.ac_out_buffer_size:
+                small.append(part)
+                continue
+            if small:
+                self.push("".join(small))
+                small = []
+            self.push_with_producer(BufferProducer(part, self.ac_out_buffer_size))
+        if small:
+            self.push("".join(small))
+
+    def reject(self, code):
+        """Answer a request that couldn't be parsed, then close
+            the connection, as what follows it can't be trusted."""
+        self.rejected = True
+        self.queue.clear()
+        self.set_terminator(None)
+        self.incoming = []
+        if self.current is None:
+            self.push("HTTP/1.1 %d %s\r\nContent-Length: 0\r\nConnection: close\r\n\r\n" %
+                    (code, httplib.responses.get(code, "")))
+            self.close_when_done()
+        else:
+            self.current.keep_alive = False
+
+    def queue_request(self, request):
+        self.queue.append(request)
+        self.process_queue()
+
+    def process_queue(self):
+        if self.processing:
+            return
+        self.processing = True
+        try:
+            while self.current is None and self.queue and self.connected:
+                request = self.queue.popleft()
+                self.current = Response(self, request)
+                self.front_end.handle(request, self.current)
+        finally:
+            self.processing = False
+
+    def response_done(self, response):
+        self.current = None
+        if not response.keep_alive:
+            self.queue.clear()
+            self.close_when_done()
+        else:
+            self.process_queue()
+
+    def handle_close(self):
+        self.close()
+        if self.current is not None:
+            current, self.current = self.current, None
+            current.done(False)
+        self.queue.clear()
+
+class HTTPServer(asyncore.dispatcher):
+    """Listens for connections, handing each to an HTTPChannel."""
+
+    def __init__(self, front_end, loop, port_number, interface=""):
+        asyncore.dispatcher.__init__(self, map=loop.map)
+        self.front_end = front_end
+        self.loop = loop
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((interface, port_number))
+        self.listen(128)
+
+    def port_number(self):
+        return self.socket.getsockname()[1]
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is None:
+            return
+        sock = pair[0]
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        HTTPChannel(sock, self.front_end, self.loop)
+
+class AsyncoreFrontEnd(object):
+    """Turns requests into calls on a PublishSubscribeEngine,
+        exactly as the Twisted PublishSubscribeServer does."""
+
+    def __init__(self, engine, loop):
+        self.engine = engine
+        self.loop = loop
+        self.loop.call_later(EXPIRY_TICK, self.expire)
+
+    def expire(self):
+        self.engine.expire()
+        self.loop.call_later(EXPIRY_TICK, self.expire)
+
+    def handle(self, request, response):
+        if request.postpath[0] == METRICS_PATH:
+            self.handle_metrics(request, response)
+            return
+        method = request.method
+        handler = getattr(self, "handle_" + method, None)
+        if request.postpath[0] == USER_PATH:
+            handler = self.handle_user
+        start = time.time()
+        # As with Twisted, the response code isn't known until the
+        # response is finished.
+        metrics = self.engine.metrics
+        response.notify_finish(lambda completed: metrics.requests.inc((method, str(response.code))))
+        if handler is None:
+            response.set_header("Allow", "DELETE, GET, POST")
+            response.finish(405)
+        else:
+            try:
+                handler(request, response)
+            except Exception:
+                traceback.print_exc()
+                if not response.streaming:
+                    response.finish(500)
+        metrics.request_seconds.observe(time.time() - start, (method,))
+
+    def handle_metrics(self, request, response):
+        # See PublishSubscribeServer.render_metrics.
+        if request.postpath == [METRICS_PATH] and request.method == "GET":
+            response.set_header("Content-Type", "text/plain; version=0.0.4")
+            response.finish(200, self.engine.metrics.render())
+            return
+        profiler = self.engine.profiler
+        if request.postpath != [METRICS_PATH, "profile"]:
+            response.finish(404)
+        elif request.method == "POST":
+            try:
+                interval = get_positive_arg(request.args, "interval", 0.005, float)
+            except ValueError:
+                response.finish(400)
+                return
+            self.engine.start_profiler(interval)
+            response.finish(200)
+        elif request.method == "DELETE" and profiler is not None:
+            profiler.stop()
+            response.finish(200)
+        elif request.method == "GET" and profiler is not None:
+            response.set_header("Content-Type", "text/plain")
+            response.finish(200, profiler.render())
+        else:
+            response.finish(404)
+
+    def handle_user(self, request, response):
+        # See PublishSubscribeServer.render_user.
+        engine = self.engine
+        if request.method != "GET":
+            response.set_header("Allow", "GET")
+            response.finish(405)
+            return
+        user_fetch = UserFetch(engine, request.postpath, request.args)
+        if user_fetch.error is not None:
+            response.finish(user_fetch.error)
+            return
+        def fetch():
+            frames = user_fetch.take()
+            if frames is None:
+                return None
+            response.set_header("Content-Type", FRAMED_CONTENT_TYPE)
+            return frame_parts(frames)
+        body = fetch()
+        if body is not None:
+            response.finish(200, body)
+        elif user_fetch.wait:
+            LongPoll(engine, self.loop, response, user_fetch.topics, user_fetch.is_subscribed, fetch, user_fetch.wait)
+        else:
+            response.finish(204)
+
+    def handle_GET(self, request, response):
+        engine = self.engine
+        if len(request.postpath) == 3:
+            topic, group, member = request.postpath
+            if not engine.is_valid_member(topic, group, member):
+                response.finish(404)
+                return
+            is_subscribed = lambda: engine.is_valid_member(topic, group, member)
+        elif len(request.postpath) == 2:
+            topic, username = request.postpath
+            if not engine.is_valid_username_and_topic(topic, username):
+                response.finish(404)
+                return
+            is_subscribed = lambda: engine.is_valid_username_and_topic(topic, username)
+        else:
+            response.finish(404)
+            return
+        try:
+            max_count = get_positive_arg(request.args, "max", None)
+            max_bytes = get_positive_arg(request.args, "max_bytes", None)
+            wait = get_positive_arg(request.args, "wait", None, float)
+            lease = get_positive_arg(request.args, "lease", None, float)
+        except ValueError:
+            response.finish(400)
+            return
+        if lease is not None and len(request.postpath) == 3:
+            # Consumer groups acknowledge with their next fetch.
+            response.finish(400)
+            return
+        if "stream" in request.args:
+            if len(request.postpath) == 3 or lease is not None:
+                # A stream has no way to acknowledge messages.
+                response.finish(400)
+            else:
+                EventStream(engine, response, topic, username)
+            return
+        framed = max_count is not None or max_bytes is not None
+        if not framed:
+            max_count = 1
+        elif max_count is None:
+            max_count = engine.max_messages
+        def fetch():
+            if len(request.postpath) == 3:
+                messages = engine.take_group_messages(topic, group, member, max_count, max_bytes)
+            elif lease is not None:
+                delivery_id, messages = engine.lease_messages(topic, username, max_count, lease, max_bytes)
+                if messages:
+                    response.set_header("X-Delivery-Id", str(delivery_id))
+            else:
+                messages = engine.take_messages(topic, username, max_count, max_bytes)
+            if not messages:
+                return None
+            if framed:
+                response.set_header("Content-Type", FRAMED_CONTENT_TYPE)
+                return frame_parts(messages)
+            return self.message_body(request, response, messages[0])
+        body = fetch()
+        if body is not None:
+            response.finish(200, body)
+        elif wait:
+            LongPoll(engine, self.loop, response, lambda: [topic], is_subscribed, fetch, wait)
+        else:
+            response.finish(204)
+
+    def message_body(self, request, response, message):
+        # See PublishSubscribeServer.message_body.
+        encoding, body = encode_message(message, request.getHeader("Accept-Encoding"))
+        if encoding is not None:
+            response.set_header("Content-Encoding", encoding)
+        if self.engine.compress_min_bytes is not None:
+            response.set_header("Vary", "Accept-Encoding")
+        return body
+
+    def handle_POST(self, request, response):
+        engine = self.engine
+        postpath = request.postpath
+        content_type = (request.getHeader("Content-Type") or "").split(";")[0].strip()
+        is_framed = content_type == FRAMED_CONTENT_TYPE
+        try:
+            if postpath == [""] and is_framed:
+                frames = decode_frames(request.body)
+                if len(frames) % 2:
+                    raise ValueError("Odd number of frames")
+                # publish_multi_topic raises ValueError, for a 400, if
+                # any of the topics is a pattern.
+                ttl = get_positive_arg(request.args, "ttl", None, float)
+                response.finish(200, json.dumps(engine.publish_multi_topic(frames, ttl)))
+            elif len(postpath) == 1:
+                if is_pattern(postpath[0]):
+                    # Messages must go to a single topic.
+                    raise ValueError("Can't publish to a pattern")
+                ttl = get_positive_arg(request.args, "ttl", None, float)
+                if is_framed:
+                    response.finish(200, json.dumps(engine.publish(postpath[0], decode_frames(request.body), ttl)))
+                else:
+                    engine.publish(postpath[0], [request.body], ttl)
+                    response.finish(200)
+            elif len(postpath) == 2 and "ack" in request.args:
+                # See PublishSubscribeServer.render_POST.
+                if not engine.is_valid_username_and_topic(*postpath):
+                    response.finish(404)
+                elif engine.acknowledge(postpath[0], postpath[1], int(request.args["ack"][0])):
+                    response.finish(200)
+                else:
+                    response.finish(404)
+            elif len(postpath) == 2:
+                engine.subscribe(postpath[0], postpath[1], request.args.get("filter"))
+                response.finish(200)
+            elif len(postpath) == 3:
+                engine.join_group(*postpath)
+                response.finish(200)
+            else:
+                response.finish(404)
+        except ValueError:
+            response.finish(400)
+        except TopicFull:
+            response.finish(429)
+        except ServerFull:
+            response.finish(503)
+
+    def handle_DELETE(self, request, response):
+        engine = self.engine
+        postpath = request.postpath
+        if len(postpath) == 3 and engine.is_valid_member(*postpath):
+            engine.leave_group(*postpath)
+            response.finish(200)
+        elif len(postpath) == 2 and engine.is_valid_username_and_topic(*postpath):
+            engine.unsubscribe(*postpath)
+            response.finish(200)
+        else:
+            response.finish(404)
+
+class LongPoll(object):
+    """A GET that found no messages, parked until a message is
+        published to the topics it is for or "wait" seconds have
+        passed. The arguments are as for a TopicWatch (see
+        frontend.py), with "fetch" returning the response body."""
+
+    def __init__(self, engine, loop, response, topics, is_subscribed, fetch, wait):
+        self.response = response
+        self.topic_watch = TopicWatch(engine, topics, is_subscribed, fetch, self.finish)
+        self.timeout = loop.call_later(wait, self.finish, 204, None)
+        self.topic_watch.watch()
+        response.notify_finish(self.on_finished)
+
+    def finish(self, code, body):
+        self.response.finish(code, "" if body is None else body)
+
+    def on_finished(self, completed):
+        self.timeout.cancel()
+        self.topic_watch.unwatch()
+
+class EventStream(object):
+    """A GET that stays open, pushing each of the user's messages
+        to them as a Server-Sent Event as soon as it is published.
+        The stream ends when the user unsubscribes."""
+
+    def __init__(self, engine, response, topic, username):
+        stream = TopicStream(engine, topic, username, response.write, response.end_stream)
+        response.set_header("Content-Type", "text/event-stream")
+        response.set_header("Cache-Control", "no-cache")
+        response.notify_finish(lambda completed: stream.stop())
+        response.start_stream(200)
+        # Start the response with a comment, so that the client
+        # sees the stream open even if no messages are waiting.
+        response.write(":\n\n")
+        stream.on_topic_changed()
+
+def serve(engine, port_number, interface="", snapshot_path=None, snapshot_interval=None):
+    """Serve an engine on a port until the process is stopped. If
+        "snapshot_path" is given, a snapshot of the engine's topics is
+        written there on SIGUSR1, and every "snapshot_interval"
+        seconds if that is given too."""
+    loop = EventLoop()
+    HTTPServer(AsyncoreFrontEnd(engine, loop), loop, port_number, interface)
+    if snapshot_path is not None:
+        # The snapshot is started from the loop, not in the middle
+        # of whatever the signal interrupted.
+        signal.signal(signal.SIGUSR1, lambda signum, frame: loop.call_later(0, engine.snapshot, snapshot_path))
+    if snapshot_path is not None and snapshot_interval is not None:
+        def snapshot():
+            engine.snapshot(snapshot_path)
+            loop.call_later(snapshot_interval, snapshot)
+        loop.call_later(snapshot_interval, snapshot)
+    try:
+        loop.run()
+    except KeyboardInterrupt:
+        pass
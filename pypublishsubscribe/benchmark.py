@@ -0,0 +1,368 @@
+"""A load-generation benchmark for the publish-subscribe server.
+
+Run it with:
+
+    python -m pypublishsubscribe.benchmark [options]
+
+By default it starts its own server on a free port. Producer and
+consumer processes then drive that server over HTTP, and the
+benchmark reports publish and consume throughput, along with
+percentiles of publish, fetch and end-to-end latency. With
+"--output" the results are also written as JSON, so that runs
+can be compared between releases.
+
+With "--protocol binary" the producers and consumers use the
+binary protocol instead (see binaryprotocol.py). Producers then
+pipeline each batch as separate PUBLISH requests, and consumers
+have messages pushed to them rather than fetching them."""
+import sys
+import json
+import time
+import struct
+import socket
+import argparse
+import platform
+import urlparse
+import subprocess
+import multiprocessing
+import requests
+from pypublishsubscribe.framing import encode_frames, decode_frames, FRAMED_CONTENT_TYPE
+from pypublishsubscribe.client import BinaryClient
+
+# Every message starts with the time it was published, so that
+# consumers can measure end-to-end latency.
+TIMESTAMP = struct.Struct(">d")
+
+PERCENTILES = [50, 99, 99.9]
+
+def percentile(sorted_values, percent):
+    """Return the value below which "percent" percent of a sorted
+        list of values fall, or None if there are no values."""
+    if not sorted_values:
+        return None
+    index = int(round(percent / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+def summarize(latencies):
+    """Summarize a list of latencies, in seconds, as a dict of
+        percentiles in milliseconds."""
+    latencies = sorted(latencies)
+    summary = {"count": len(latencies)}
+    for percent in PERCENTILES:
+        value = percentile(latencies, percent)
+        summary["p%s" % str(percent).replace(".", "")] = None if value is None else value * 1000
+    return summary
+
+def topic_name(index):
+    return "bench%d" % index
+
+def username(topic_index, subscriber_index):
+    return "t%ds%d" % (topic_index, subscriber_index)
+
+def make_message(size):
+    return TIMESTAMP.pack(time.time()) + "x" * max(0, size - TIMESTAMP.size)
+
+def messages_for_topic(config, topic_index):
+    """The number of messages producers will publish to a topic.
+        Each producer spreads its messages over the topics
+        round-robin, starting from its own index."""
+    total = 0
+    for producer_index in xrange(config.producers):
+        # How far round from this producer's first topic this topic is.
+        offset = (topic_index - producer_index) % config.topics
+        total += config.messages // config.topics + (1 if offset < config.messages % config.topics else 0)
+    return total
+
+def produce(url, config, producer_index, results):
+    session = requests.Session()
+    latencies = []
+    start = time.time()
+    sent = 0
+    # Each producer starts at a different topic, so that producers
+    # don't all publish to the same topic at the same time.
+    topic_index = producer_index % config.topics
+    while sent < config.messages:
+        count = min(config.publish_batch, config.messages - sent)
+        batch = []
+        for i in xrange(count):
+            batch.append(topic_name(topic_index))
+            batch.append(make_message(config.message_size))
+            topic_index = (topic_index + 1) % config.topics
+        request_start = time.time()
+        if count == 1:
+            response = session.post("%s/%s" % (url, batch[0]), data=batch[1])
+        else:
+            response = session.post(url + "/", data=encode_frames(batch),
+                    headers={"Content-Type": FRAMED_CONTENT_TYPE})
+        latencies.append(time.time() - request_start)
+        if response.status_code != 200:
+            raise IOError("Publish failed with %d" % response.status_code)
+        sent += count
+    results.put(("produce", sent, time.time() - start, latencies, []))
+
+def consume(url, config, subscriptions, results):
+    """Fetch messages for the given (topic index, subscriber index)
+        pairs until each has received everything published to
+        its topic, or the timeout passes."""
+    session = requests.Session()
+    fetch_latencies = []
+    end_to_end_latencies = []
+    remaining = {}
+    for topic_index, subscriber_index in subscriptions:
+        remaining[(topic_index, subscriber_index)] = config.backlog + messages_for_topic(config, topic_index)
+    received = 0
+    start = time.time()
+    deadline = start + config.timeout
+    idle = False
+    while remaining and time.time() < deadline:
+        # Poll each subscription in turn. Only once a whole pass
+        # finds nothing do we ask the server to wait for messages,
+        # as a wait on one idle subscription holds up the others.
+        received_in_pass = 0
+        for subscription in remaining.keys():
+            path = "%s/%s/%s?max=%d" % (url, topic_name(subscription[0]), username(*subscription),
+                    config.fetch_batch)
+            if idle:
+                path += "&wait=0.05"
+            request_start = time.time()
+            response = session.get(path)
+            now = time.time()
+            fetch_latencies.append(now - request_start)
+            if response.status_code == 204:
+                continue
+            if response.status_code != 200:
+                raise IOError("Fetch failed with %d" % response.status_code)
+            messages = decode_frames(response.content)
+            for message in messages:
+                end_to_end_latencies.append(now - TIMESTAMP.unpack_from(message)[0])
+            received_in_pass += len(messages)
+            remaining[subscription] -= len(messages)
+            if remaining[subscription] <= 0:
+                del remaining[subscription]
+        received += received_in_pass
+        idle = not received_in_pass
+    results.put(("consume", received, time.time() - start, fetch_latencies, end_to_end_latencies))
+
+def binary_client(url, config, timeout=None):
+    return BinaryClient(urlparse.urlsplit(url).hostname, config.binary_port, timeout)
+
+def produce_binary(url, config, producer_index, results):
+    client = binary_client(url, config)
+    latencies = []
+    start = time.time()
+    sent = 0
+    topic_index = producer_index % config.topics
+    while sent < config.messages:
+        count = min(config.publish_batch, config.messages - sent)
+        # Pipeline the whole batch, then wait for all the replies.
+        request_start = time.time()
+        for i in xrange(count):
+            client.send_publish(topic_name(topic_index), [make_message(config.message_size)])
+            topic_index = (topic_index + 1) % config.topics
+        client.wait_all()
+        latencies.append(time.time() - request_start)
+        sent += count
+    client.close()
+    results.put(("produce", sent, time.time() - start, latencies, []))
+
+def consume_binary(url, config, subscriptions, results):
+    """As consume, but with every subscription's messages pushed
+        to one connection, which acknowledges each batch."""
+    client = binary_client(url, config, timeout=0.5)
+    end_to_end_latencies = []
+    remaining = {}
+    for topic_index, subscriber_index in subscriptions:
+        subscription = (topic_name(topic_index), username(topic_index, subscriber_index))
+        remaining[subscription] = config.backlog + messages_for_topic(config, topic_index)
+        client.send_subscribe(subscription[0], subscription[1], config.window)
+    received = 0
+    start = time.time()
+    deadline = start + config.timeout
+    while remaining and time.time() < deadline:
+        try:
+            topic, user, messages = client.next_delivery()
+        except socket.timeout:
+            continue
+        now = time.time()
+        for message in messages:
+            end_to_end_latencies.append(now - TIMESTAMP.unpack_from(message)[0])
+        received += len(messages)
+        client.send_ack(topic, user, len(messages))
+        if len(client.pending) > 100:
+            client.wait_all()
+        remaining[(topic, user)] -= len(messages)
+        if remaining[(topic, user)] <= 0:
+            del remaining[(topic, user)]
+    client.close()
+    results.put(("consume", received, time.time() - start, [], end_to_end_latencies))
+
+def run_worker(target, args, results):
+    # Report a failure back to the benchmark rather than leaving
+    # it waiting for results that will never come.
+    try:
+        target(*args)
+    except Exception as e:
+        results.put(("error", "%s: %s" % (target.__name__, e)))
+
+def setup(url, config):
+    """Subscribe every consumer, and publish each topic's backlog."""
+    session = requests.Session()
+    for topic_index in xrange(config.topics):
+        for subscriber_index in xrange(config.fanout):
+            response = session.post("%s/%s/%s" % (url, topic_name(topic_index), username(topic_index, subscriber_index)))
+            if response.status_code != 200:
+                raise IOError("Subscribe failed with %d" % response.status_code)
+    for topic_index in xrange(config.topics):
+        for first in xrange(0, config.backlog, 1000):
+            messages = [make_message(config.message_size) for i in xrange(min(1000, config.backlog - first))]
+            response = session.post("%s/%s" % (url, topic_name(topic_index)), data=encode_frames(messages),
+                    headers={"Content-Type": FRAMED_CONTENT_TYPE})
+            if response.status_code != 200:
+                raise IOError("Publishing backlog failed with %d" % response.status_code)
+
+def teardown(url, config):
+    session = requests.Session()
+    for topic_index in xrange(config.topics):
+        for subscriber_index in xrange(config.fanout):
+            session.delete("%s/%s/%s" % (url, topic_name(topic_index), username(topic_index, subscriber_index)))
+
+def free_port():
+    """Return a TCP port that nothing is listening on."""
+    sock = socket.socket()
+    sock.bind(("", 0))
+    port_number = sock.getsockname()[1]
+    sock.close()
+    return port_number
+
+def start_server(config):
+    """Start a server on a free port, returning the process and
+        the server's URL. With the binary protocol, it also listens
+        on another free port, stored in "config.binary_port"."""
+    port_number = free_port()
+    # Make sure the backlog and everything published fits, so that
+    # no messages are evicted before they are consumed.
+    max_messages = config.backlog + config.producers * config.messages
+    args = [sys.executable, "-m", "pypublishsubscribe.publishsubscribeserver", str(port_number),
+            "--max_messages", str(max(max_messages, 1))] + config.server_args
+    if config.protocol == "binary":
+        config.binary_port = free_port()
+        args += ["--binary_port", str(config.binary_port)]
+    process = subprocess.Popen(args, stdout=open("/dev/null", "w"))
+    url = "http://localhost:%d" % port_number
+    for attempt in xrange(100):
+        try:
+            requests.get(url + "/")
+            return process, url
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    process.terminate()
+    raise IOError("Server did not start")
+
+def run_benchmark(config):
+    """Run the benchmark described by "config" (as parsed by
+        parse_args), returning the results as a dict."""
+    process = None
+    url = config.url
+    if url is None:
+        process, url = start_server(config)
+    try:
+        setup(url, config)
+        subscriptions = [(topic_index, subscriber_index)
+                for topic_index in xrange(config.topics) for subscriber_index in xrange(config.fanout)]
+        results = multiprocessing.Queue()
+        if config.protocol == "binary":
+            producer, consumer = produce_binary, consume_binary
+        else:
+            producer, consumer = produce, consume
+        workers = []
+        for consumer_index in xrange(config.consumers):
+            workers.append(multiprocessing.Process(target=run_worker,
+                    args=(consumer, (url, config, subscriptions[consumer_index::config.consumers], results), results)))
+        for producer_index in xrange(config.producers):
+            workers.append(multiprocessing.Process(target=run_worker,
+                    args=(producer, (url, config, producer_index, results), results)))
+        for worker in workers:
+            worker.start()
+        outcomes = [results.get() for worker in workers]
+        for worker in workers:
+            worker.join()
+        errors = [outcome[1] for outcome in outcomes if outcome[0] == "error"]
+        if errors:
+            raise IOError("; ".join(errors))
+        teardown(url, config)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+    published = sum(outcome[1] for outcome in outcomes if outcome[0] == "produce")
+    consumed = sum(outcome[1] for outcome in outcomes if outcome[0] == "consume")
+    produce_time = max([outcome[2] for outcome in outcomes if outcome[0] == "produce"] or [0])
+    consume_time = max([outcome[2] for outcome in outcomes if outcome[0] == "consume"] or [0])
+    expected = sum(config.fanout * (config.backlog + messages_for_topic(config, topic_index))
+            for topic_index in xrange(config.topics))
+    return {
+        "config": dict((name, value) for name, value in vars(config).items() if name != "output"),
+        "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                        "cpus": multiprocessing.cpu_count()},
+        "published": published,
+        "consumed": consumed,
+        "expected": expected,
+        "publish_throughput": published / produce_time if produce_time else None,
+        "consume_throughput": consumed / consume_time if consume_time else None,
+        "publish_latency_ms": summarize(sum((outcome[3] for outcome in outcomes if outcome[0] == "produce"), [])),
+        "fetch_latency_ms": summarize(sum((outcome[3] for outcome in outcomes if outcome[0] == "consume"), [])),
+        "end_to_end_latency_ms": summarize(sum((outcome[4] for outcome in outcomes), [])),
+    }
+
+def format_results(results):
+    lines = ["Published %(published)d messages, consumed %(consumed)d of %(expected)d expected." % results]
+    for name in ["publish_throughput", "consume_throughput"]:
+        if results[name] is not None:
+            lines.append("%-22s %12.1f messages/s" % (name.replace("_", " ") + ":", results[name]))
+    for name in ["publish_latency_ms", "fetch_latency_ms", "end_to_end_latency_ms"]:
+        summary = results[name]
+        values = ["%s=%s" % (key, "-" if summary[key] is None else "%.3f" % summary[key])
+                for key in sorted(summary) if key != "count"]
+        lines.append("%-22s %s (ms, %d samples)" % (name[:-3].replace("_", " ") + ":", " ".join(values), summary["count"]))
+    return "\n".join(lines)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the publish-subscribe server.")
+    parser.add_argument("--url", default=None,
+            help="URL of a running server to benchmark. By default a server is started.")
+    parser.add_argument("--protocol", choices=["http", "binary"], default="http",
+            help="The protocol producers and consumers use.")
+    parser.add_argument("--binary_port", type=int, default=None,
+            help="Port of the binary protocol listener of the server given by --url.")
+    parser.add_argument("--window", type=int, default=1000,
+            help="With the binary protocol, the number of messages pushed to a consumer "
+                 "before it has to acknowledge them.")
+    parser.add_argument("--producers", type=int, default=2, help="Number of producer processes.")
+    parser.add_argument("--consumers", type=int, default=2, help="Number of consumer processes.")
+    parser.add_argument("--topics", type=int, default=4, help="Number of topics.")
+    parser.add_argument("--fanout", type=int, default=2, help="Number of subscribers to each topic.")
+    parser.add_argument("--messages", type=int, default=1000, help="Number of messages each producer publishes.")
+    parser.add_argument("--message_size", type=int, default=100, help="Size of each message in bytes.")
+    parser.add_argument("--backlog", type=int, default=0,
+            help="Number of messages published to each topic before consumers start.")
+    parser.add_argument("--publish_batch", type=int, default=1, help="Number of messages per publish request.")
+    parser.add_argument("--fetch_batch", type=int, default=1, help="Maximum number of messages per fetch request.")
+    parser.add_argument("--timeout", type=float, default=300, help="Seconds after which consumers give up.")
+    parser.add_argument("--output", default=None, help="Write the results to this file as JSON.")
+    parser.add_argument("server_args", nargs=argparse.REMAINDER,
+            help="Any further arguments, after a \"--\", are passed to the server that is started.")
+    config = parser.parse_args(argv)
+    if config.server_args[:1] == ["--"]:
+        config.server_args = config.server_args[1:]
+    return config
+
+def main():
+    config = parse_args()
+    results = run_benchmark(config)
+    print format_results(results)
+    if config.output is not None:
+        with open(config.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+if __name__ == "__main__":
+    main()
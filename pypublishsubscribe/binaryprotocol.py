@@ -0,0 +1,126 @@
+"""A compact binary protocol for producers and consumers that
+keep a connection open, as an alternative to HTTP.
+
+Each frame is sent as a 4-byte big-endian length followed by that
+many bytes. A frame starts with a 1-byte opcode and a 4-byte
+request id, chosen by the client and echoed in the reply, then
+holds the fields its opcode calls for, in this order:
+
+    names      each a 2-byte length and that many bytes
+    number     an 8-byte unsigned integer
+    messages   a 4-byte count, then each message as a 4-byte
+               length and that many bytes
+
+The requests, and their replies, are:
+
+    SUBSCRIBE    topic, username, window     OK
+    UNSUBSCRIBE  topic, username             OK
+    PUBLISH      topic, messages             PUBLISHED
+    FETCH        topic, username, max count  MESSAGES
+    ACK          topic, username, count      OK
+
+SUBSCRIBE with a window of 0 subscribes for FETCH alone. With a
+window above 0, messages are also pushed to the connection, as
+DELIVER frames (topic, username, messages) with a request id of 0,
+as soon as they are published. At most "window" pushed messages
+may be unacknowledged at once; ACK acknowledges "count" of them,
+oldest first, letting more be pushed. Any of "count" beyond the
+number unacknowledged is ignored. Pushed messages are leased
+rather than taken: each stays in the topic until it, and the rest
+of the DELIVER frame it came in, have been acknowledged. Those not
+acknowledged when the connection closes are given out again, before
+any newer messages, so delivery is at least once.
+
+PUBLISHED carries the sequence number of the first message plus 1,
+or 0 if nobody was subscribed and the messages were dropped. The
+rest of the messages follow on from the first. ERROR carries a
+code, using the HTTP response codes for the same failures (400 for
+a bad request, 404 for an unknown subscription).
+
+Requests can be pipelined: a client may send many without waiting,
+and the replies come back in the same order."""
+import struct
+
+SUBSCRIBE = 1
+UNSUBSCRIBE = 2
+PUBLISH = 3
+FETCH = 4
+ACK = 5
+
+OK = 64
+PUBLISHED = 65
+MESSAGES = 66
+DELIVER = 67
+ERROR = 68
+
+# The fields of each kind of frame, as (number of names, whether
+# it has a number, whether it has messages).
+FORMATS = {
+    SUBSCRIBE: (2, True, False),
+    UNSUBSCRIBE: (2, False, False),
+    PUBLISH: (1, False, True),
+    FETCH: (2, True, False),
+    ACK: (2, True, False),
+    OK: (0, False, False),
+    PUBLISHED: (0, True, False),
+    MESSAGES: (0, False, True),
+    DELIVER: (2, False, True),
+    ERROR: (0, True, False),
+}
+
+HEADER = struct.Struct(">BI")
+NAME_LENGTH = struct.Struct(">H")
+NUMBER = struct.Struct(">Q")
+LENGTH = struct.Struct(">I")
+
+# The length prefix of every frame.
+PREFIX = LENGTH
+
+def encode_frame(opcode, request_id, names=(), number=0, messages=()):
+    """Encode a frame, without its length prefix."""
+    name_count, has_number, has_messages = FORMATS[opcode]
+    parts = [HEADER.pack(opcode, request_id)]
+    for name in names[:name_count]:
+        parts.append(NAME_LENGTH.pack(len(name)))
+        parts.append(name)
+    if has_number:
+        parts.append(NUMBER.pack(number))
+    if has_messages:
+        parts.append(LENGTH.pack(len(messages)))
+        for message in messages:
+            parts.append(LENGTH.pack(len(message)))
+            parts.append(message)
+    return "".join(parts)
+
+def decode_frame(data):
+    """Decode a frame, without its length prefix, into a tuple of
+        (opcode, request id, names, number, messages). Raises
+        ValueError if the frame is malformed."""
+    try:
+        opcode, request_id = HEADER.unpack_from(data)
+        name_count, has_number, has_messages = FORMATS[opcode]
+        position = HEADER.size
+        names = []
+        for i in xrange(name_count):
+            length, = NAME_LENGTH.unpack_from(data, position)
+            position += NAME_LENGTH.size
+            names.append(data[position:position + length])
+            position += length
+        number = 0
+        if has_number:
+            number, = NUMBER.unpack_from(data, position)
+            position += NUMBER.size
+        messages = []
+        if has_messages:
+            count, = LENGTH.unpack_from(data, position)
+            position += LENGTH.size
+            for i in xrange(count):
+                length, = LENGTH.unpack_from(data, position)
+                position += LENGTH.size
+                messages.append(data[position:position + length])
+                position += length
+    except (struct.error, KeyError):
+        raise ValueError("Malformed frame")
+    if position != len(data):
+        raise ValueError("Malformed frame")
+    return opcode, request_id, names, number, messages
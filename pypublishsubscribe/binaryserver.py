@@ -0,0 +1,200 @@
+"""The server side of the binary protocol (see binaryprotocol.py),
+run alongside the HTTP front end on the same engine."""
+from collections import deque
+from twisted.internet import protocol
+from twisted.protocols.basic import Int32StringReceiver
+from pypublishsubscribe.binaryprotocol import (encode_frame, decode_frame, SUBSCRIBE, UNSUBSCRIBE,
+        PUBLISH, FETCH, ACK, OK, PUBLISHED, MESSAGES, DELIVER, ERROR)
+from pypublishsubscribe.patterns import is_pattern
+from pypublishsubscribe.topic import TopicFull, ServerFull
+
+class PushSubscription(object):
+    """Pushes a subscriber's messages down a connection as they are
+        published, with no more than "window" unacknowledged. Each
+        push leases its messages (see Topic.lease_messages), and
+        they are only removed from the topic once acknowledged. If
+        the connection is lost first, they are given out again."""
+
+    def __init__(self, connection, topic, username, window):
+        self.connection = connection
+        self.engine = connection.engine
+        self.topic = topic
+        self.username = username
+        self.credit = window
+        self.waiting = False
+        # The lease of each push not yet wholly acknowledged, oldest
+        # first, as [delivery id, messages not yet acknowledged].
+        self.leases = deque()
+
+    def acknowledge(self, count):
+        if not self.engine.is_valid_username_and_topic(self.topic, self.username):
+            self.stop()
+            return
+        # Acknowledgements count messages in the order they were
+        # pushed, and a lease is committed once all of its messages
+        # have been acknowledged. Acknowledging more messages than
+        # are outstanding mustn't widen the window, so only those
+        # that were are credited.
+        while count and self.leases:
+            lease = self.leases[0]
+            acknowledged = min(count, lease[1])
+            lease[1] -= acknowledged
+            count -= acknowledged
+            self.credit += acknowledged
+            if not lease[1]:
+                self.leases.popleft()
+                self.engine.acknowledge(self.topic, self.username, lease[0])
+        self.push()
+
+    def on_topic_changed(self):
+        self.waiting = False
+        self.push()
+
+    def push(self):
+        if not self.engine.is_valid_username_and_topic(self.topic, self.username):
+            # Unsubscribed, perhaps over HTTP.
+            self.stop()
+            return
+        if self.credit > 0:
+            delivery_id, messages = self.engine.lease_messages(self.topic, self.username, self.credit, None)
+            if messages:
+                self.credit -= len(messages)
+                self.leases.append([delivery_id, len(messages)])
+                self.connection.sendString(encode_frame(DELIVER, 0, (self.topic, self.username),
+                        messages=messages))
+        if self.credit > 0 and not self.waiting:
+            self.waiting = True
+            self.engine.add_waiter(self.topic, self.on_topic_changed)
+
+    def stop(self):
+        self.connection.pushes.pop((self.topic, self.username), None)
+        if self.waiting:
+            self.waiting = False
+            self.engine.remove_waiter(self.topic, self.on_topic_changed)
+        if self.leases and self.engine.is_valid_username_and_topic(self.topic, self.username):
+            for delivery_id, count in self.leases:
+                self.engine.release_lease(self.topic, self.username, delivery_id)
+        self.leases.clear()
+
+class BinaryConnection(Int32StringReceiver):
+    """One client's connection. Each frame is handled as soon as it
+        arrives, so replies are sent in the order requests came
+        in. When topics are kept on disk, replies to requests that
+        change them wait until the change is synced, and any later
+        replies wait behind them."""
+
+    MAX_LENGTH = 64 * 1024 * 1024
+
+    def __init__(self, engine):
+        self.engine = engine
+        # Push subscriptions on this connection, keyed by
+        # (topic, username).
+        self.pushes = {}
+        # Replies waiting for an earlier one to be synced, each
+        # as [ready, frame].
+        self.replies = deque()
+        self.handlers = {
+            SUBSCRIBE: self.handle_subscribe,
+            UNSUBSCRIBE: self.handle_unsubscribe,
+            PUBLISH: self.handle_publish,
+            FETCH: self.handle_fetch,
+            ACK: self.handle_ack,
+        }
+
+    def stringReceived(self, data):
+        try:
+            opcode, request_id, names, number, messages = decode_frame(data)
+            handler = self.handlers[opcode]
+        except (ValueError, KeyError):
+            # Whatever follows can't be trusted either.
+            self.transport.loseConnection()
+            return
+        reply, changed = handler(names, number, messages)
+        opcode, fields = reply[0], reply[1:]
+        self.reply(encode_frame(opcode, request_id, *fields), changed)
+
+    def handle_subscribe(self, names, window, messages):
+        topic, username = names
+        try:
+            self.engine.subscribe(topic, username)
+        except ValueError:
+            return (ERROR, (), 400), False
+        if window and (topic, username) not in self.pushes:
+            push = self.pushes[(topic, username)] = PushSubscription(self, topic, username, window)
+            push.push()
+        return (OK,), True
+
+    def handle_unsubscribe(self, names, number, messages):
+        topic, username = names
+        if not self.engine.is_valid_username_and_topic(topic, username):
+            return (ERROR, (), 404), False
+        self.engine.unsubscribe(topic, username)
+        push = self.pushes.get((topic, username))
+        if push is not None:
+            push.stop()
+        return (OK,), True
+
+    def handle_publish(self, names, number, messages):
+        topic, = names
+        if is_pattern(topic):
+            # Messages must go to a single topic.
+            return (ERROR, (), 400), False
+        try:
+            sequence_numbers = self.engine.publish(topic, messages)
+        except TopicFull:
+            return (ERROR, (), 429), False
+        except ServerFull:
+            return (ERROR, (), 503), False
+        if not sequence_numbers or sequence_numbers[0] is None:
+            return (PUBLISHED, (), 0), False
+        return (PUBLISHED, (), sequence_numbers[0] + 1), True
+
+    def handle_fetch(self, names, max_count, messages):
+        topic, username = names
+        if not self.engine.is_valid_username_and_topic(topic, username):
+            return (ERROR, (), 404), False
+        if not max_count:
+            return (ERROR, (), 400), False
+        return (MESSAGES, (), 0, self.engine.take_messages(topic, username, max_count)), False
+
+    def handle_ack(self, names, count, messages):
+        topic, username = names
+        push = self.pushes.get((topic, username))
+        if push is None:
+            return (ERROR, (), 404), False
+        push.acknowledge(count)
+        # Acknowledging may have moved the subscriber's cursor.
+        return (OK,), True
+
+    def reply(self, frame, changed):
+        storage = self.engine.storage
+        if not self.replies and (storage is None or not changed):
+            self.sendString(frame)
+            return
+        entry = [storage is None or not changed, frame]
+        self.replies.append(entry)
+        if not entry[0]:
+            def synced(result):
+                entry[0] = True
+                self.send_ready_replies()
+            def failed(failure):
+                # The change may not have been kept, and the client
+                # can't be told which, so drop the connection.
+                self.transport.loseConnection()
+            storage.when_synced().addCallbacks(synced, failed)
+
+    def send_ready_replies(self):
+        while self.replies and self.replies[0][0]:
+            self.sendString(self.replies.popleft()[1])
+
+    def connectionLost(self, reason):
+        for push in self.pushes.values():
+            push.stop()
+
+class BinaryProtocolFactory(protocol.Factory):
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def buildProtocol(self, addr):
+        return BinaryConnection(self.engine)
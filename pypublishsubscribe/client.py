@@ -0,0 +1,161 @@
+"""A small blocking client for the binary protocol (see
+binaryprotocol.py).
+
+    client = BinaryClient("localhost", 9090)
+    client.subscribe("weather", "bob")
+    client.publish("weather", ["cloudy", "sunny"])
+    client.fetch("weather", "bob", 10)
+
+Each of those waits for its reply. To pipeline requests, use the
+"send_" methods, which return at once with the request's id, and
+then "wait" for the replies. Messages pushed to a subscription
+with a window are collected by "next_delivery"."""
+import socket
+from collections import deque
+from pypublishsubscribe.binaryprotocol import (encode_frame, decode_frame, PREFIX, SUBSCRIBE, UNSUBSCRIBE,
+        PUBLISH, FETCH, ACK, PUBLISHED, MESSAGES, DELIVER, ERROR)
+
+class ProtocolError(Exception):
+    """The server replied to a request with an error. "code" is
+        as for the matching HTTP response."""
+
+    def __init__(self, code):
+        Exception.__init__(self, "Server replied with error %d" % code)
+        self.code = code
+
+class BinaryClient(object):
+
+    def __init__(self, host, port_number, timeout=None):
+        self.sock = socket.create_connection((host, port_number), timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buffer = ""
+        self.position = 0
+        self.next_request_id = 1
+        # Ids of requests not yet waited for, in the order sent.
+        self.pending = deque()
+        # Replies received for requests not yet waited for.
+        self.replies = {}
+        # The number of messages in each PUBLISH not yet replied
+        # to, which the reply doesn't repeat.
+        self.published_counts = {}
+        # Pushed (topic, username, messages) not yet collected.
+        self.deliveries = deque()
+
+    def close(self):
+        self.sock.close()
+
+    def send(self, opcode, names=(), number=0, messages=()):
+        request_id = self.next_request_id
+        self.next_request_id = self.next_request_id % 0xffffffff + 1
+        frame = encode_frame(opcode, request_id, names, number, messages)
+        self.sock.sendall(PREFIX.pack(len(frame)) + frame)
+        self.pending.append(request_id)
+        return request_id
+
+    def send_subscribe(self, topic, username, window=0):
+        return self.send(SUBSCRIBE, (topic, username), window)
+
+    def send_unsubscribe(self, topic, username):
+        return self.send(UNSUBSCRIBE, (topic, username))
+
+    def send_publish(self, topic, messages):
+        request_id = self.send(PUBLISH, (topic,), messages=messages)
+        self.published_counts[request_id] = len(messages)
+        return request_id
+
+    def send_fetch(self, topic, username, max_count):
+        return self.send(FETCH, (topic, username), max_count)
+
+    def send_ack(self, topic, username, count):
+        return self.send(ACK, (topic, username), count)
+
+    def subscribe(self, topic, username, window=0):
+        """Subscribe a user to a topic. With a window, messages for
+            them are pushed to this client as they are published."""
+        self.wait(self.send_subscribe(topic, username, window))
+
+    def unsubscribe(self, topic, username):
+        self.wait(self.send_unsubscribe(topic, username))
+
+    def publish(self, topic, messages):
+        """Publish messages to a topic, returning their sequence
+            numbers, which are None if the messages were dropped."""
+        return self.wait(self.send_publish(topic, messages))
+
+    def fetch(self, topic, username, max_count=1):
+        return self.wait(self.send_fetch(topic, username, max_count))
+
+    def ack(self, topic, username, count):
+        self.wait(self.send_ack(topic, username, count))
+
+    def wait(self, request_id=None):
+        """Wait for the reply to a request (by default, the last one
+            sent), reading the replies to any before it on the way.
+            Returns the reply's result: the sequence numbers for a
+            PUBLISH, the messages for a FETCH, or None. Raises
+            ProtocolError if the server replied with an error."""
+        if request_id is None:
+            request_id = self.pending[-1]
+        while request_id not in self.replies:
+            self.read_frame()
+        self.pending.remove(request_id)
+        opcode, number, messages = self.replies.pop(request_id)
+        if opcode == ERROR:
+            raise ProtocolError(number)
+        if opcode == PUBLISHED:
+            # The first sequence number, plus one, or 0 if the
+            # messages were dropped.
+            return [None] * messages if not number else range(number - 1, number - 1 + messages)
+        if opcode == MESSAGES:
+            return messages
+        return None
+
+    def wait_all(self):
+        """Wait for the replies to every request not yet waited
+            for, returning their results in order. Raises
+            ProtocolError, after waiting for all of them, if the
+            server replied to any with an error."""
+        results = []
+        error = None
+        for request_id in list(self.pending):
+            try:
+                results.append(self.wait(request_id))
+            except ProtocolError as e:
+                results.append(None)
+                error = error or e
+        if error is not None:
+            raise error
+        return results
+
+    def next_delivery(self):
+        """Wait for the next batch of messages pushed to this client,
+            returned as (topic, username, messages)."""
+        while not self.deliveries:
+            self.read_frame()
+        return self.deliveries.popleft()
+
+    def read_frame(self):
+        while True:
+            available = len(self.buffer) - self.position
+            if available >= PREFIX.size:
+                length, = PREFIX.unpack_from(self.buffer, self.position)
+                if available >= PREFIX.size + length:
+                    start = self.position + PREFIX.size
+                    frame = self.buffer[start:start + length]
+                    self.position = start + length
+                    break
+            data = self.sock.recv(65536)
+            if not data:
+                raise IOError("Connection closed by server")
+            self.buffer = self.buffer[self.position:] + data
+            self.position = 0
+        opcode, request_id, names, number, messages = decode_frame(frame)
+        if opcode == DELIVER:
+            self.deliveries.append((names[0], names[1], messages))
+            return
+        # A PUBLISHED reply doesn't say how many messages there
+        # were, so that is remembered from the request.
+        count = self.published_counts.pop(request_id, None)
+        if opcode == PUBLISHED:
+            messages = count
+        self.replies[request_id] = (opcode, number, messages)
@@ -0,0 +1,228 @@
+import os
+import sys
+import json
+import socket
+import signal
+import hashlib
+import subprocess
+from bisect import bisect
+from StringIO import StringIO
+from twisted.web import server, resource, proxy
+from twisted.web.client import Agent, FileBodyProducer, readBody
+from twisted.web.http_headers import Headers
+from twisted.internet import reactor, defer
+from twisted.internet.endpoints import UNIXClientEndpoint
+from pypublishsubscribe.engine import get_positive_arg, USER_PATH
+from pypublishsubscribe.framing import encode_frames, decode_frames, is_framed_request, FRAMED_CONTENT_TYPE
+from pypublishsubscribe.metrics import METRICS_PATH
+from pypublishsubscribe.patterns import SEPARATOR, ONE_WORD, ANY_WORDS, is_pattern
+from pypublishsubscribe.topic import TopicFull, ServerFull
+
+# Linux has supported SO_REUSEPORT since 3.9, but Python 2's
+# socket module doesn't define it.
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", 15)
+
+class HashRing(object):
+    """Maps keys to nodes by consistent hashing. Each node is
+        placed at many points on a ring of hash values, and a key
+        belongs to the first node found after the key's own hash."""
+
+    def __init__(self, nodes, replicas=100):
+        points = []
+        for node in nodes:
+            for replica in xrange(replicas):
+                points.append((self.hash("%s-%d" % (node, replica)), node))
+        points.sort()
+        self.hashes = [point[0] for point in points]
+        self.nodes = [point[1] for point in points]
+
+    @staticmethod
+    def hash(key):
+        return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+    def owner(self, key):
+        index = bisect(self.hashes, self.hash(key))
+        if index == len(self.hashes):
+            index = 0
+        return self.nodes[index]
+
+class WorkerEndpointFactory(object):
+    """Lets an Agent reach other workers over their UNIX sockets,
+        using URLs of the form http://<worker index>/."""
+
+    def __init__(self, socket_paths):
+        self.socket_paths = socket_paths
+
+    def endpointForURI(self, uri):
+        return UNIXClientEndpoint(reactor, self.socket_paths[int(uri.host)])
+
+class ShardedPublishSubscribeServer(resource.Resource):
+    """Sits in front of the PublishSubscribeServer in one of several
+        worker processes. Every topic is owned by exactly one worker,
+        chosen by consistent hashing of the first word of the topic
+        name, so that the ordering of its messages is unaffected by
+        running several workers. A request for a topic owned by
+        another worker is forwarded to it over that worker's UNIX
+        socket.
+
+        Hashing only the first word means that every topic a
+        wildcard pattern can match is owned by the same worker as
+        the pattern, as long as the pattern's first word isn't a
+        wildcard. Patterns that start with a wildcard could match
+        topics on any worker, and so aren't allowed. Nor are fetches
+        from all of a user's subscriptions, for the same reason."""
+
+    isLeaf = True
+
+    def __init__(self, publisher, worker_index, socket_paths):
+        resource.Resource.__init__(self)
+        self.publisher = publisher
+        self.worker_index = worker_index
+        self.socket_paths = socket_paths
+        self.ring = HashRing(range(len(socket_paths)))
+        self.agent = Agent.usingEndpointFactory(reactor, WorkerEndpointFactory(socket_paths))
+
+    def render(self, request):
+        if request.postpath == [""] and request.method == "POST" and is_framed_request(request):
+            # A batch of messages for many topics, which may be
+            # owned by several workers.
+            return self.render_multi_topic_POST(request)
+        if request.postpath[0] == METRICS_PATH:
+            # Metrics are for this worker alone.
+            return self.publisher.render(request)
+        shard_key = request.postpath[0].split(SEPARATOR, 1)[0]
+        if shard_key in (ONE_WORD, ANY_WORDS, USER_PATH):
+            # A user's topics, like those a pattern starting with a
+            # wildcard matches, may be owned by any of the workers.
+            request.setResponseCode(400)
+            return ""
+        owner = self.ring.owner(shard_key)
+        if owner == self.worker_index:
+            return self.publisher.render(request)
+        return self.forward(request, owner)
+
+    def forward(self, request, owner):
+        """Pass the request on to the worker that owns its topic,
+            and relay that worker's response back."""
+        request.content.seek(0)
+        factory = proxy.ProxyClientFactory(request.method, request.uri, request.clientproto,
+                request.getAllHeaders().copy(), request.content.read(), request)
+        reactor.connectUNIX(self.socket_paths[owner], factory)
+        return server.NOT_DONE_YET
+
+    def render_multi_topic_POST(self, request):
+        try:
+            frames = decode_frames(request.content.read())
+            ttl = get_positive_arg(request.args, "ttl", None, float)
+        except ValueError:
+            request.setResponseCode(400)
+            return ""
+        if len(frames) % 2 or any(is_pattern(frames[index]) for index in xrange(0, len(frames), 2)):
+            request.setResponseCode(400)
+            return ""
+        # Split the batch up by the worker that owns each topic,
+        # remembering where each message came in the original.
+        by_owner = {}
+        for index in xrange(0, len(frames), 2):
+            indexes = by_owner.setdefault(self.ring.owner(frames[index].split(SEPARATOR, 1)[0]), [])
+            indexes.append(index // 2)
+        sequence_numbers = [None] * (len(frames) // 2)
+        def published(result, indexes):
+            for index, seq in zip(indexes, result):
+                sequence_numbers[index] = seq
+        pending = []
+        for owner, indexes in by_owner.iteritems():
+            batch = []
+            for index in indexes:
+                batch.extend(frames[index * 2:index * 2 + 2])
+            if owner == self.worker_index:
+                d = self.publish_locally(batch, ttl)
+            else:
+                d = self.publish_remotely(owner, batch, ttl)
+            d.addCallback(published, indexes)
+            pending.append(d)
+        def succeeded(result):
+            request.setResponseCode(200)
+            request.write(json.dumps(sequence_numbers))
+            request.finish()
+        def failed(failure):
+            # Pass on a refusal by a full topic or worker, as the
+            # publisher should back off.
+            error = failure.value.subFailure
+            if error.check(TopicFull):
+                request.setResponseCode(429)
+            elif error.check(ServerFull):
+                request.setResponseCode(503)
+            else:
+                request.setResponseCode(502)
+            request.finish()
+        d = defer.gatherResults(pending, consumeErrors=True)
+        d.addCallbacks(succeeded, failed)
+        return server.NOT_DONE_YET
+
+    def publish_locally(self, batch, ttl=None):
+        engine = self.publisher.engine
+        try:
+            sequence_numbers = engine.publish_multi_topic(batch, ttl)
+        except (TopicFull, ServerFull):
+            return defer.fail()
+        if engine.storage is None:
+            return defer.succeed(sequence_numbers)
+        return engine.storage.when_synced().addCallback(lambda result: sequence_numbers)
+
+    def publish_remotely(self, owner, batch, ttl=None):
+        body = FileBodyProducer(StringIO(encode_frames(batch)))
+        headers = Headers({"Content-Type": [FRAMED_CONTENT_TYPE]})
+        uri = "http://%d/" % owner
+        if ttl is not None:
+            uri += "?ttl=%r" % ttl
+        d = self.agent.request("POST", uri, headers, body)
+        def received(response):
+            if response.code == 429:
+                raise TopicFull("Worker %d's topic is full" % owner)
+            if response.code == 503:
+                raise ServerFull("Worker %d is full" % owner)
+            if response.code != 200:
+                raise IOError("Worker %d returned %d" % (owner, response.code))
+            return readBody(response).addCallback(json.loads)
+        return d.addCallback(received)
+
+def worker_socket_paths(socket_dir, workers):
+    return [os.path.join(socket_dir, "worker-%d.sock" % index) for index in xrange(workers)]
+
+def listen_shared(port_number, site):
+    """Listen on a port that other worker processes also listen
+        on. The kernel shares incoming connections between them."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    sock.bind(("", port_number))
+    sock.listen(128)
+    sock.setblocking(False)
+    port = reactor.adoptStreamPort(sock.fileno(), socket.AF_INET, site)
+    # The reactor has its own copy of the socket now.
+    sock.close()
+    return port
+
+def run_workers(workers, argv):
+    """Start "workers" copies of the server, each running with the
+        given arguments plus its own worker index, and wait for
+        them all to exit. Stopping this process stops them all, and
+        sending it SIGUSR1 has each of them write a snapshot."""
+    children = []
+    for index in xrange(workers):
+        children.append(subprocess.Popen([sys.executable, "-m", "pypublishsubscribe.publishsubscribeserver"] +
+                argv + ["--worker_index", str(index)]))
+    def stop(signum, frame):
+        for child in children:
+            if child.poll() is None:
+                child.terminate()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    def snapshot(signum, frame):
+        for child in children:
+            if child.poll() is None:
+                child.send_signal(signal.SIGUSR1)
+    signal.signal(signal.SIGUSR1, snapshot)
+    for child in children:
+        child.wait()
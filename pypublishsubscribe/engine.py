@@ -0,0 +1,671 @@
+"""The core of the publish-subscribe server: its topics,
+subscriptions and consumer groups, with no knowledge of how
+requests reach it. Each front end (the Twisted resource in
+publishsubscribeserver.py, or the asyncore server in
+asyncoreserver.py) turns requests into calls on an engine.
+
+An engine isn't thread-safe. It should only be used from the
+thread running the front end's event loop."""
+import time
+import thread
+from pypublishsubscribe.topic import Topic, MemoryBudget, ServerFull, TopicFull, is_valid_name, \
+        DROP_OLDEST, REJECT, SPILL
+from pypublishsubscribe.spill import SpillingTopic
+from pypublishsubscribe.metrics import ServerMetrics, SamplingProfiler
+from pypublishsubscribe.patterns import SubscriptionTrie, is_pattern
+from pypublishsubscribe.timerwheel import TimerWheel
+from pypublishsubscribe.payload import prepare_message
+from pypublishsubscribe.snapshot import SnapshotWriter, read_snapshot
+from pypublishsubscribe.filters import FILTER_SEPARATOR, Filter, parse_document, view_name, view_topic, \
+        view_filter
+
+# How often, in seconds, a front end should call expire. Leases
+# and messages expire up to this long after their deadline.
+EXPIRY_TICK = 0.1
+
+# The reserved path under which a user's messages from all of their
+# subscriptions are fetched. It can't be used as a topic name.
+USER_PATH = "_user"
+
+class UserSubscriptions(object):
+    """The topics one user is subscribed to, in the order they take
+        turns in when the user fetches from all of them at once."""
+
+    def __init__(self):
+        self.topics = []
+        # The name each subscription is kept under, by topic: the
+        # topic itself or, for a filtered subscription, the name of
+        # its view (see filters.py).
+        self.names = {}
+        # The position in "topics" of the one to be served first
+        # next time.
+        self.next_turn = 0
+
+    def add(self, topic, name):
+        self.topics.append(topic)
+        self.names[topic] = name
+
+    def remove(self, topic):
+        position = self.topics.index(topic)
+        del self.topics[position]
+        del self.names[topic]
+        if position < self.next_turn:
+            self.next_turn -= 1
+
+class PublishSubscribeEngine(object):
+    """Holds every topic, and the operations on them that the
+        front ends share."""
+
+    # "max_messages" is the max number that can be posted
+    # for one topic. Once this limit is reached we delete
+    # the oldest message when adding the new one. Failure
+    # to do this would leave open a possible attack vector
+    # where an unlimited number of messages could be posted
+    # to a topic without messages ever being pulled off the
+    # queue by subscribers.
+    #
+    # "storage", if given, is a SegmentStore used to keep topics
+    # on disk so that they survive a restart. Any topics it holds
+    # are recovered here.
+    #
+    # "metrics_max_topics" is the number of topics that metrics
+    # are reported for individually. Metrics for any further
+    # topics are reported together, so that the number of
+    # metrics stays bounded however many topics there are.
+    #
+    # "max_topic_bytes" limits the size of the messages held by
+    # each topic, and "max_total_bytes" that of all topics together.
+    # "overflow" is the policy applied when a publish would break a
+    # limit (see topic.py). Under SPILL, messages that don't fit in
+    # memory are moved to files in "spill_directory". A message
+    # published to several subscriptions counts against the budget
+    # once for each, though it is only held once.
+    #
+    # "topic_ttls", if given, maps topic names or patterns to the
+    # time-to-live, in seconds, of messages published to matching
+    # topics. Where several match, the shortest applies.
+    #
+    # "compress_min_bytes", if given, is the size from which
+    # messages are compressed as they are published, to be sent
+    # compressed to clients that accept it (see payload.py).
+    def __init__(self, max_messages=500, storage=None, metrics_max_topics=100, max_topic_bytes=None,
+            max_total_bytes=None, overflow=DROP_OLDEST, spill_directory=None, topic_ttls=None,
+            compress_min_bytes=None):
+        if overflow == SPILL and storage is not None:
+            raise ValueError("Durable topics are already on disk, so can't spill")
+        self.max_messages = max_messages
+        self.storage = storage
+        self.max_topic_bytes = max_topic_bytes
+        self.overflow = overflow
+        self.spill_directory = spill_directory
+        self.compress_min_bytes = compress_min_bytes
+        self.budget = None
+        if max_total_bytes is not None:
+            self.budget = MemoryBudget(max_total_bytes)
+        # The backing data structure here is a dict of
+        # Topic objects, keyed by topic name. Each Topic
+        # holds a single log of messages shared by all of its
+        # subscribers, along with a read cursor per subscriber
+        # (see topic.py). A topic only exists while it has at
+        # least one subscriber.
+        #
+        # A subscription to a wildcard pattern (see patterns.py) is
+        # kept in the same way, keyed by the pattern, so that it has
+        # its own log of every message published to a matching topic.
+        # The patterns are also indexed in a trie, to find those that
+        # match a topic when a message is published.
+        #
+        # A filtered subscription (see filters.py) is kept in the
+        # same way too, keyed by its view's name, with a log of just
+        # the messages matching its filter. "views" holds the names
+        # of the views of each topic or pattern.
+        self.topics = {}
+        self.patterns = SubscriptionTrie()
+        self.views = {}
+        # The subscriptions of each user, by username, so that they
+        # can fetch from all of them at once (see take_user_messages).
+        self.user_subscriptions = {}
+        self.topic_ttls = topic_ttls or {}
+        self.ttl_patterns = SubscriptionTrie()
+        for pattern in self.topic_ttls:
+            self.ttl_patterns.add(pattern)
+        if storage is not None:
+            self.topics.update(storage.recover(max_messages, max_topic_bytes, overflow, self.budget))
+            for topic, topic_entry in self.topics.iteritems():
+                self.register_topic(topic, topic_entry, view_filter(topic))
+                self.index_subscribers(topic, topic_entry)
+            storage.start()
+        self.metrics_max_topics = metrics_max_topics
+        self.metrics = ServerMetrics(self.topics, metrics_max_topics)
+        self.profiler = None
+        # The child writing a snapshot, if there is one (see snapshot).
+        self.snapshot_writer = None
+        # The deadline of every lease (see lease_messages), and of
+        # every batch of messages with a time-to-live. Holding them
+        # in timer wheels, rather than scheduling a call for each,
+        # keeps expiring them cheap however many there are.
+        self.lease_wheel = TimerWheel(EXPIRY_TICK, now=time.time())
+        self.message_wheel = TimerWheel(EXPIRY_TICK, now=time.time())
+
+    def publish(self, topic, messages, ttl=None):
+        """Append messages to a topic, and to every wildcard
+            subscription matching it, returning their sequence
+            numbers. These are the numbers given to the messages
+            in the topic itself or, if it only has wildcard
+            subscribers, in the first matching pattern (in sorted
+            order). A message only taken by filtered subscriptions
+            is numbered by the first of those that takes it. If
+            nobody is subscribed to the topic, or every filter
+            leaves a message out, it is dropped, and its sequence
+            number is None.
+
+            If "ttl" is given, the messages expire after that many
+            seconds, or sooner if their topic's own TTL is shorter.
+
+            Under the REJECT policy, raises TopicFull or ServerFull,
+            having published nothing, if there isn't room."""
+        targets = self.targets(topic)
+        if not targets:
+            self.metrics.dropped.inc((self.metrics.topic_labels(topic),), len(messages))
+            return [None] * len(messages)
+        deliveries = self.deliveries(targets, messages)
+        if self.overflow == REJECT:
+            try:
+                self.check_room([(deliveries, messages)])
+            except (TopicFull, ServerFull):
+                self.metrics.rejected.inc((self.metrics.topic_labels(topic),), len(messages))
+                raise
+        return self.append(topic, deliveries, messages, ttl)
+
+    def targets(self, topic):
+        """Return the names of the topic, and the wildcard and
+            filtered subscriptions, that a message published to
+            "topic" may be appended to."""
+        if FILTER_SEPARATOR in topic:
+            # Nobody can subscribe to such a name.
+            return []
+        topics = [] if is_pattern(topic) else [topic]
+        if self.patterns:
+            topics.extend(sorted(self.patterns.match(topic)))
+        targets = []
+        for name in topics:
+            if name in self.topics:
+                targets.append(name)
+            if name in self.views:
+                targets.extend(sorted(self.views[name]))
+        return targets
+
+    def deliveries(self, targets, messages):
+        """Return the messages each target takes, as a list of
+            (target, indexes) pairs. "indexes" are the positions in
+            "messages" of those the target's filter matches, or None
+            for a target without a filter, which takes them all.
+            Each message is parsed at most once, and tested once
+            against each distinct filter, however many targets share
+            it."""
+        deliveries = []
+        documents = None
+        selections = {}
+        for target in targets:
+            message_filter = self.topics[target].filter
+            if message_filter is None:
+                deliveries.append((target, None))
+                continue
+            indexes = selections.get(message_filter.source)
+            if indexes is None:
+                if documents is None:
+                    documents = [parse_document(message) for message in messages]
+                indexes = selections[message_filter.source] = [index for index, document in enumerate(documents)
+                        if message_filter.matches(document)]
+            deliveries.append((target, indexes))
+        return deliveries
+
+    def check_room(self, batches):
+        """Raise TopicFull or ServerFull if there isn't room for
+            every batch of messages in the targets that take them,
+            given as a list of (deliveries, messages) pairs (see
+            deliveries)."""
+        needed = {}
+        total = 0
+        for deliveries, messages in batches:
+            for target, indexes in deliveries:
+                taken = messages if indexes is None else [messages[index] for index in indexes]
+                size = sum(map(len, taken))
+                count, target_size = needed.get(target, (0, 0))
+                needed[target] = (count + len(taken), target_size + size)
+                total += size
+        for target, (count, size) in needed.iteritems():
+            self.topics[target].check_room(count, size)
+        # Each topic only checks the budget for its own
+        # messages, not those going to the other targets.
+        if self.budget is not None and self.budget.used + total > self.budget.max_bytes:
+            raise ServerFull("Server is full")
+
+    def append(self, topic, deliveries, messages, ttl=None):
+        # Append messages published to "topic" to the targets that
+        # take them (see deliveries), returning their sequence
+        # numbers.
+        labels = (self.metrics.topic_labels(topic),)
+        self.metrics.published.inc(labels, len(messages))
+        if self.compress_min_bytes is not None:
+            messages = [prepare_message(message, self.compress_min_bytes) for message in messages]
+        # Each target appends the same message objects, so however
+        # many subscriptions match, each message is held only once.
+        now = time.time()
+        sequence_numbers = [None] * len(messages)
+        unnumbered = len(messages)
+        for target, indexes in deliveries:
+            topic_entry = self.topics[target]
+            if indexes is None:
+                taken = messages
+                indexes = xrange(len(messages))
+            else:
+                if len(indexes) < len(messages):
+                    self.metrics.filtered.inc(labels, len(messages) - len(indexes))
+                if not indexes:
+                    continue
+                taken = [messages[index] for index in indexes]
+            target_ttl = ttl
+            if topic_entry.ttl is not None and (ttl is None or topic_entry.ttl < ttl):
+                target_ttl = topic_entry.ttl
+            expires = now + target_ttl if target_ttl is not None else None
+            seqs = topic_entry.extend(taken, expires)
+            if expires is not None:
+                self.message_wheel.add(expires, (target, topic_entry))
+            if unnumbered:
+                for index, seq in zip(indexes, seqs):
+                    if sequence_numbers[index] is None:
+                        sequence_numbers[index] = seq
+                        unnumbered -= 1
+        return sequence_numbers
+
+    def publish_multi_topic(self, frames, ttl=None):
+        """Publish messages to many topics, given a list alternating
+            between topic name and message. Returns the messages'
+            sequence numbers, in the order they were given. "ttl" is
+            as for publish. Under the REJECT policy, raises TopicFull or ServerFull, having
+            published nothing, if any of them don't fit. Raises
+            ValueError, having published nothing, if any topic is a
+            wildcard pattern, as messages must go to a single topic."""
+        for index in xrange(0, len(frames), 2):
+            if is_pattern(frames[index]):
+                raise ValueError("Can't publish to a pattern")
+        # Group the messages by topic so that each topic is
+        # appended to just once, then put the sequence numbers
+        # back into the order the messages arrived in.
+        by_topic = {}
+        for index in xrange(0, len(frames), 2):
+            by_topic.setdefault(frames[index], []).append(index // 2)
+        sequence_numbers = [None] * (len(frames) // 2)
+        batches = []
+        for topic, indexes in by_topic.iteritems():
+            messages = [frames[index * 2 + 1] for index in indexes]
+            batches.append((topic, indexes, self.deliveries(self.targets(topic), messages), messages))
+        if self.overflow == REJECT:
+            try:
+                self.check_room([(batch[2], batch[3]) for batch in batches])
+            except (TopicFull, ServerFull):
+                for batch in batches:
+                    self.metrics.rejected.inc((self.metrics.topic_labels(batch[0]),), len(batch[3]))
+                raise
+        for topic, indexes, deliveries, messages in batches:
+            if not deliveries:
+                self.metrics.dropped.inc((self.metrics.topic_labels(topic),), len(messages))
+                continue
+            for index, seq in zip(indexes, self.append(topic, deliveries, messages, ttl)):
+                sequence_numbers[index] = seq
+        return sequence_numbers
+
+    def subscribe(self, topic, username, conditions=None):
+        """Subscribe a user to a topic or, if a list of filter
+            conditions is given, to just the messages published to it
+            that meet them all (see filters.py). A user already
+            subscribed to the topic stays subscribed as before.
+            Raises ValueError if the username, topic name or any
+            condition can't be used."""
+        if not is_valid_name(username):
+            raise ValueError("Invalid username")
+        if FILTER_SEPARATOR in topic:
+            raise ValueError("Invalid topic")
+        message_filter = Filter(conditions) if conditions else None
+        if self.subscription_name(topic, username) is not None:
+            return
+        name = topic if message_filter is None else view_name(topic, message_filter)
+        self.get_or_create_topic(name, message_filter).subscribe(username)
+        self.user_subscriptions.setdefault(username, UserSubscriptions()).add(topic, name)
+
+    def unsubscribe(self, topic, username):
+        # Remove the user's cursor from this topic. Any messages
+        # that were only being kept for this user are released.
+        name = self.subscription_name(topic, username)
+        topic_entry = self.topics[name]
+        # The index is updated first, as unsubscribing wakes anyone
+        # waiting on the topic.
+        self.unindex_subscription(topic, username)
+        topic_entry.unsubscribe(username)
+        self.remove_topic_if_unused(name)
+
+    def subscription_name(self, topic, username):
+        """Return the name that a user's subscription to a topic is
+            kept under in "topics": the topic itself or, if it is
+            filtered, its view. Returns None if the user isn't
+            subscribed to the topic."""
+        subscriptions = self.user_subscriptions.get(username)
+        if subscriptions is None:
+            return None
+        return subscriptions.names.get(topic)
+
+    def index_subscribers(self, name, topic_entry):
+        # Add the subscribers of a recovered or restored topic to
+        # the index of each user's subscriptions. Consumer groups'
+        # cursors aren't for a user, and are left out.
+        topic = view_topic(name)
+        for username in topic_entry.cursors:
+            if is_valid_name(username):
+                self.user_subscriptions.setdefault(username, UserSubscriptions()).add(topic, name)
+
+    def unindex_subscription(self, topic, username):
+        subscriptions = self.user_subscriptions[username]
+        subscriptions.remove(topic)
+        if not subscriptions.topics:
+            del self.user_subscriptions[username]
+
+    def join_group(self, topic, group, member):
+        """Add a member to a consumer group on a topic. Raises
+            ValueError if the group or member name can't be used."""
+        if not is_valid_name(group) or not is_valid_name(member):
+            raise ValueError("Invalid group or member")
+        if FILTER_SEPARATOR in topic:
+            raise ValueError("Invalid topic")
+        self.get_or_create_topic(topic).join_group(group, member)
+
+    def leave_group(self, topic, group, member):
+        # Any messages the member hadn't acknowledged go to the
+        # rest of the group. The group goes with its last member.
+        self.topics[topic].leave_group(group, member)
+        self.remove_topic_if_unused(topic)
+
+    def get_or_create_topic(self, topic, message_filter=None):
+        # "topic" is the name the topic is kept under, which for a
+        # filtered subscription is its view's name, and
+        # "message_filter" its compiled filter.
+        if topic not in self.topics:
+            # If the topic doesn't exist then add it,
+            # with an empty log.
+            topic_entry = self.topics[topic] = self.new_topic(topic)
+            self.register_topic(topic, topic_entry, message_filter)
+        return self.topics[topic]
+
+    def register_topic(self, name, topic_entry, message_filter):
+        # Set up a topic created, recovered or restored under "name".
+        # A filtered subscription has its topic's time-to-live, and
+        # one to a pattern is found through the pattern in the trie.
+        topic = view_topic(name)
+        topic_entry.ttl = self.topic_ttl(topic)
+        topic_entry.filter = message_filter
+        if message_filter is not None:
+            self.views.setdefault(topic, set()).add(name)
+        if is_pattern(topic):
+            self.patterns.add(topic)
+
+    def new_topic(self, topic):
+        """Create the storage for a newly subscribed topic."""
+        if self.storage is not None:
+            return self.storage.create_topic(topic, self.max_messages, self.max_topic_bytes, self.overflow,
+                    self.budget)
+        if self.overflow == SPILL:
+            return SpillingTopic(self.max_messages, self.max_topic_bytes, self.budget, self.spill_directory)
+        return Topic(self.max_messages, self.max_topic_bytes, self.overflow, self.budget)
+
+    def topic_ttl(self, topic):
+        """Return the time-to-live of messages published to a
+            topic, or None if they don't expire."""
+        if not self.topic_ttls:
+            return None
+        ttls = [self.topic_ttls[pattern] for pattern in self.ttl_patterns.match(topic)]
+        return min(ttls) if ttls else None
+
+    def remove_topic_if_unused(self, topic):
+        if not self.topics[topic].cursors:
+            # If there are no more subscribers to this topic
+            # then remove it.
+            self.remove_topic(topic)
+
+    def remove_topic(self, name):
+        topic_entry = self.topics.pop(name)
+        topic = view_topic(name)
+        if topic_entry.filter is not None:
+            views = self.views[topic]
+            views.discard(name)
+            if not views:
+                del self.views[topic]
+        # A pattern stays in the trie while anything is subscribed
+        # to it, filtered or not.
+        if is_pattern(topic) and topic not in self.topics and topic not in self.views:
+            self.patterns.remove(topic)
+        for username in topic_entry.cursors:
+            if is_valid_name(username):
+                self.unindex_subscription(topic, username)
+        self.metrics.topic_removed(name, topic_entry)
+        # Whatever messages it still held no longer count
+        # against the budget.
+        topic_entry._add_bytes(-topic_entry.bytes)
+        if self.budget is not None:
+            self.budget.topics.discard(topic_entry)
+        if self.storage is not None:
+            self.storage.delete_topic(topic_entry)
+        else:
+            topic_entry.close()
+
+    def is_valid_username_and_topic(self, topic, username):
+        return self.subscription_name(topic, username) is not None
+
+    def is_valid_user(self, username):
+        """Return True if a user is subscribed to any topic."""
+        return username in self.user_subscriptions
+
+    def user_topics(self, username):
+        """Return the topics a user is subscribed to."""
+        subscriptions = self.user_subscriptions.get(username)
+        return list(subscriptions.topics) if subscriptions is not None else []
+
+    def is_valid_member(self, topic, group, member):
+        return topic in self.topics and self.topics[topic].is_group_member(group, member)
+
+    def get_and_remove_next_message(self, topic, username):
+        # Return the next message for this user on this topic,
+        # moving their cursor past it, or None if they have
+        # already received every message.
+        start = time.time()
+        topic_entry = self.topics[self.subscription_name(topic, username)]
+        topic_entry.expire(start)
+        the_message = topic_entry.next_message(username)
+        labels = (self.metrics.topic_labels(topic),)
+        self.metrics.fetch_seconds.observe(time.time() - start, labels)
+        if the_message is not None:
+            self.metrics.delivered.inc(labels)
+        return the_message
+
+    def take_messages(self, topic, username, max_count, max_bytes=None):
+        # As get_and_remove_next_message, but taking up to
+        # "max_count" messages (and "max_bytes" bytes) at once.
+        start = time.time()
+        topic_entry = self.topics[self.subscription_name(topic, username)]
+        topic_entry.expire(start)
+        messages = topic_entry.next_messages(username, max_count, max_bytes)
+        labels = (self.metrics.topic_labels(topic),)
+        self.metrics.fetch_seconds.observe(time.time() - start, labels)
+        if messages:
+            self.metrics.delivered.inc(labels, len(messages))
+        return messages
+
+    def take_user_messages(self, username, max_count):
+        """Take up to "max_count" messages from across every topic a
+            user is subscribed to, returned as (topic, message) pairs.
+            The topics take turns, giving one message each, so that a
+            busy topic can't crowd out the rest, and each fetch carries
+            on from the topic after the last one served. A topic that
+            has nothing for the user drops out of the turns straight
+            away, so a fetch costs one look at each topic, plus one for
+            each message taken."""
+        subscriptions = self.user_subscriptions[username]
+        topics = subscriptions.topics
+        topic_entries = [self.topics[subscriptions.names[topic]] for topic in topics]
+        now = time.time()
+        for topic_entry in topic_entries:
+            topic_entry.expire(now)
+        count = len(topics)
+        positions = [(subscriptions.next_turn + offset) % count for offset in xrange(count)]
+        taken = []
+        delivered = {}
+        while positions and len(taken) < max_count:
+            ready = []
+            for position in positions:
+                if len(taken) == max_count:
+                    break
+                topic = topics[position]
+                messages = topic_entries[position].next_messages(username, 1)
+                if messages:
+                    taken.append((topic, messages[0]))
+                    delivered[topic] = delivered.get(topic, 0) + 1
+                    subscriptions.next_turn = (position + 1) % count
+                    ready.append(position)
+            positions = ready
+        for topic, delivered_count in delivered.iteritems():
+            self.metrics.delivered.inc((self.metrics.topic_labels(topic),), delivered_count)
+        return taken
+
+    def take_group_messages(self, topic, group, member, max_count, max_bytes=None):
+        # As take_messages, but for a member of a consumer group.
+        start = time.time()
+        topic_entry = self.topics[topic]
+        topic_entry.expire(start)
+        messages = topic_entry.next_group_messages(group, member, max_count, max_bytes)
+        labels = (self.metrics.topic_labels(topic),)
+        self.metrics.fetch_seconds.observe(time.time() - start, labels)
+        if messages:
+            self.metrics.delivered.inc(labels, len(messages))
+        return messages
+
+    def lease_messages(self, topic, username, max_count, timeout, max_bytes=None):
+        """Lease messages to a user for at-least-once delivery (see
+            Topic.lease_messages), returning a delivery id and the
+            messages, or (None, []). Unless the delivery id is
+            acknowledged within "timeout" seconds, the messages will
+            be given to the user again. With a "timeout" of None the
+            lease lasts until it is acknowledged or released."""
+        name = self.subscription_name(topic, username)
+        start = time.time()
+        topic_entry = self.topics[name]
+        topic_entry.expire(start)
+        deadline = start + timeout if timeout is not None else None
+        delivery_id, messages = topic_entry.lease_messages(username, max_count, max_bytes, deadline)
+        labels = (self.metrics.topic_labels(topic),)
+        self.metrics.fetch_seconds.observe(time.time() - start, labels)
+        if delivery_id is not None:
+            if deadline is not None:
+                self.lease_wheel.add(deadline, (name, topic_entry, username, delivery_id))
+            self.metrics.delivered.inc(labels, len(messages))
+        return delivery_id, messages
+
+    def acknowledge(self, topic, username, delivery_id):
+        """Acknowledge a delivery id returned by lease_messages.
+            Returns False if there is no such lease."""
+        return self.topics[self.subscription_name(topic, username)].acknowledge(username, delivery_id)
+
+    def release_lease(self, topic, username, delivery_id):
+        """Give the messages leased under a delivery id back to the
+            user at once (see Topic.release_lease). Returns False if
+            there is no such lease."""
+        return self.topics[self.subscription_name(topic, username)].release_lease(username, delivery_id)
+
+    def expire(self):
+        """Expire every lease and message whose deadline has passed.
+            The front end should call this every EXPIRY_TICK seconds.
+            Messages are also expired from a topic whenever messages
+            are taken from it, so none are delivered late."""
+        now = time.time()
+        for topic, topic_entry, username, delivery_id in self.lease_wheel.expire(now):
+            # The lease may have been acknowledged, or its topic
+            # removed (and perhaps created again), since.
+            if self.topics.get(topic) is topic_entry and topic_entry.expire_lease(username, delivery_id, now):
+                self.metrics.leases_expired.inc((self.metrics.topic_labels(topic),))
+        for topic, topic_entry in self.message_wheel.expire(now):
+            if self.topics.get(topic) is topic_entry:
+                topic_entry.expire(now)
+        if self.snapshot_writer is not None:
+            written = self.snapshot_writer.poll()
+            if written is not None:
+                self.metrics.snapshots.inc(("ok" if written else "failed",))
+                self.snapshot_writer = None
+
+    def snapshot(self, path):
+        """Start writing a snapshot of every topic to "path" (see
+            snapshot.py), from a forked child, so that requests are
+            served as usual while it is written. Returns False, doing
+            nothing, if the last snapshot is still being written.
+            The child is waited for by expire."""
+        if self.storage is not None or self.overflow == SPILL:
+            raise ValueError("Only topics held in memory can be snapshotted")
+        if self.snapshot_writer is not None:
+            return False
+        self.snapshot_writer = SnapshotWriter(self.topics, path)
+        return True
+
+    def restore(self, path):
+        """Restore the topics in a snapshot written by "snapshot".
+            This should be done before anything is subscribed to."""
+        if self.storage is not None or self.overflow == SPILL:
+            raise ValueError("Only topics held in memory can be restored")
+        self.topics.update(read_snapshot(path, self.max_messages, self.max_topic_bytes, self.overflow, self.budget))
+        for topic, topic_entry in self.topics.iteritems():
+            self.register_topic(topic, topic_entry, view_filter(topic))
+            self.index_subscribers(topic, topic_entry)
+            for deadline, first, stop in topic_entry.expiries:
+                self.message_wheel.add(deadline, (topic, topic_entry))
+
+    def add_waiter(self, topic, callback):
+        """Call "callback" once, the next time a topic, or any
+            filtered subscription to it, changes."""
+        for name in self.names(topic):
+            self.topics[name].add_waiter(callback)
+
+    def remove_waiter(self, topic, callback):
+        # The topic may have gone while the waiter was waiting.
+        for name in self.names(topic):
+            self.topics[name].remove_waiter(callback)
+
+    def names(self, topic):
+        # Return the names of every subscription to a topic, filtered
+        # or not.
+        names = list(self.views.get(topic, ()))
+        if topic in self.topics:
+            names.append(topic)
+        return names
+
+    def start_profiler(self, interval):
+        if self.profiler is not None:
+            self.profiler.stop()
+        # Profile the calling thread, which is the one
+        # running the front end's event loop.
+        self.profiler = SamplingProfiler(thread.get_ident(), interval)
+        self.profiler.start()
+
+    def _clear(self):
+        # Allow to fully clear the data structure.
+        # For use in unit testing.
+        for topic in list(self.topics):
+            self.remove_topic(topic)
+        self.metrics = ServerMetrics(self.topics, self.metrics_max_topics)
+
+def get_positive_arg(args, name, default, convert=int):
+    """Return the positive (by default integer) value of a query
+        string argument, or "default" if it wasn't given. "args"
+        maps each argument's name to a list of its values. Raises
+        ValueError if the value isn't a positive number."""
+    if name not in args:
+        return default
+    value = convert(args[name][0])
+    if value <= 0:
+        raise ValueError("%s must be positive" % name)
+    return value
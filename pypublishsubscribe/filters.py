@@ -0,0 +1,178 @@
+"""Filtered subscriptions, which only take the messages they want.
+
+A filter is a list of conditions on the fields of a message, read
+as a JSON object, all of which must hold. Each condition is a field
+and, optionally, a comparison with a value:
+
+    region=eu           the field equals the value
+    region!=eu          the field is there but doesn't equal the value
+    price>100           also <, <= and >=, between two numbers or
+                        two strings
+    alert               the field is there, whatever its value
+
+A field inside another is named by a path such as "reading.temp",
+and an item of a list by its index, such as "tags.0". Values are
+read as JSON where they can be ("100", "true", "null", '"100"'),
+and as a plain string where not. A message that isn't a JSON
+object, or that lacks a field being compared, matches nothing.
+
+Each distinct filter on a topic (or pattern) is kept by the engine
+as a subscription of its own, with its own log, shared by every
+subscriber using that filter. It is keyed by the topic and the
+filter's source, joined by FILTER_SEPARATOR, which can't appear in a
+topic name. A message is only appended to the logs of the filters it
+matches, so the others never hold it. A filter is compiled once,
+when its subscription is created, and each message published is
+parsed once, and tested against each distinct filter once, however
+many subscriptions and subscribers share it."""
+import json
+import operator
+
+FILTER_SEPARATOR = "\0"
+
+# Two-character operators come first, so that "<=" isn't read as
+# "<" followed by a value starting with "=".
+OPERATORS = [
+    ("!=", operator.ne),
+    ("<=", operator.le),
+    (">=", operator.ge),
+    ("=", operator.eq),
+    ("<", operator.lt),
+    (">", operator.gt),
+]
+
+ORDERINGS = (operator.lt, operator.le, operator.gt, operator.ge)
+
+# The kinds of field that can be ordered against each other. A bool
+# is an int too, but is never ordered against, or equal to, a number.
+NUMBERS = (int, long, float)
+STRINGS = (unicode,)
+
+MISSING = object()
+
+class Filter(object):
+    """A compiled filter, made from a list of conditions. Raises
+        ValueError if any of them can't be understood."""
+
+    def __init__(self, conditions):
+        tests = {}
+        for condition in conditions:
+            source, test = compile_condition(condition)
+            tests[source] = test
+        if not tests:
+            raise ValueError("A filter needs at least one condition")
+        # The same conditions, in any order, make the same filter.
+        self.source = FILTER_SEPARATOR.join(sorted(tests))
+        self.conditions = sorted(tests)
+        self.tests = [tests[source] for source in self.conditions]
+
+    def matches(self, document):
+        """Return True if a message, as parsed by parse_document,
+            meets every condition."""
+        if document is None:
+            return False
+        for test in self.tests:
+            if not test(document):
+                return False
+        return True
+
+def compile_condition(condition):
+    # Return the condition's canonical source, and a function testing
+    # whether a parsed message meets it.
+    try:
+        condition = condition.decode("utf-8")
+    except UnicodeDecodeError:
+        raise ValueError("Filter conditions must be UTF-8")
+    if FILTER_SEPARATOR in condition:
+        raise ValueError("Invalid filter condition")
+    for index in xrange(len(condition)):
+        for symbol, compare in OPERATORS:
+            if condition.startswith(symbol, index):
+                path = parse_path(condition[:index])
+                value_source = condition[index + len(symbol):].strip()
+                value = parse_value(value_source)
+                source = u"%s%s%s" % (u".".join(path), symbol, value_source)
+                return source.encode("utf-8"), make_comparison(path, compare, value)
+    path = parse_path(condition)
+    return u".".join(path).encode("utf-8"), lambda document: lookup(document, path) is not MISSING
+
+def parse_path(source):
+    path = source.strip().split(u".")
+    for name in path:
+        if not name or name != name.strip():
+            raise ValueError("Invalid field in filter: %r" % source)
+    return path
+
+def parse_value(source):
+    if not source:
+        raise ValueError("Missing value in filter")
+    try:
+        value = json.loads(source)
+    except ValueError:
+        return source
+    if isinstance(value, (dict, list)):
+        raise ValueError("Filters can't compare objects or lists")
+    return value
+
+def make_comparison(path, compare, value):
+    if compare in ORDERINGS:
+        if isinstance(value, bool) or not isinstance(value, NUMBERS + STRINGS):
+            raise ValueError("Only numbers and strings can be ordered")
+        kind = NUMBERS if isinstance(value, NUMBERS) else STRINGS
+        def test(document):
+            field = lookup(document, path)
+            return isinstance(field, kind) and not isinstance(field, bool) and compare(field, value)
+    else:
+        equal = compare is operator.eq
+        def test(document):
+            field = lookup(document, path)
+            return field is not MISSING and equal_values(field, value) == equal
+    return test
+
+def equal_values(field, value):
+    # Return True if a field equals a value as JSON sees it, where
+    # true and 1 are different.
+    if isinstance(field, bool) or isinstance(value, bool):
+        return field is value
+    return field == value
+
+def lookup(document, path):
+    # Return the field at "path" in a parsed message, or MISSING.
+    field = document
+    for name in path:
+        if isinstance(field, dict):
+            field = field.get(name, MISSING)
+        elif isinstance(field, list) and name.isdigit() and int(name) < len(field):
+            field = field[int(name)]
+        else:
+            return MISSING
+        if field is MISSING:
+            return MISSING
+    return field
+
+def parse_document(message):
+    """Parse a message for filters to test, returning None if it
+        isn't a JSON object."""
+    try:
+        document = json.loads(message)
+    except ValueError:
+        return None
+    return document if isinstance(document, dict) else None
+
+def view_name(topic, message_filter):
+    """Return the name a filtered subscription to "topic" is kept
+        under."""
+    return topic + FILTER_SEPARATOR + message_filter.source
+
+def view_topic(name):
+    """Return the topic (or pattern) that a subscription kept under
+        "name" is for."""
+    return name.partition(FILTER_SEPARATOR)[0]
+
+def view_filter(name):
+    """Return the filter of a subscription kept under "name", or
+        None if it isn't filtered."""
+    topic, separator, source = name.partition(FILTER_SEPARATOR)
+    if not separator:
+        return None
+    return Filter(source.split(FILTER_SEPARATOR))
@@ -0,0 +1,60 @@
+"""Framing used to carry several messages in a single HTTP body.
+
+Each message is written as its length in bytes (in ASCII decimal),
+a newline, the message itself, and a closing newline:
+
+    6\\ncloudy\\n5\\nsunny\\n
+
+Because every frame is length-prefixed, messages may themselves
+contain newlines or any other bytes."""
+
+# The content type used for framed request and response bodies.
+FRAMED_CONTENT_TYPE = "application/x-pubsub-frames"
+
+def encode_frames(messages):
+    """Encode a sequence of messages into a single framed string."""
+    return "".join(frame_parts(messages))
+
+def frame_parts(messages):
+    """Return the strings that, joined, make up the framing of a
+        sequence of messages. The messages themselves are among
+        them, so a front end that can write each in turn needn't
+        copy them into a single string."""
+    parts = []
+    for message in messages:
+        parts.append("%d\n" % len(message))
+        parts.append(message)
+        parts.append("\n")
+    return parts
+
+def decode_frames(data):
+    """Decode a framed string back into a list of messages.
+        Raises ValueError if the data is not correctly framed."""
+    messages = []
+    position = 0
+    end = len(data)
+    while position < end:
+        newline = data.find("\n", position)
+        if newline == -1:
+            raise ValueError("Missing frame length at offset %d" % position)
+        length_field = data[position:newline]
+        if not length_field.isdigit():
+            raise ValueError("Invalid frame length at offset %d" % position)
+        start = newline + 1
+        stop = start + int(length_field)
+        if stop >= end or data[stop] != "\n":
+            raise ValueError("Truncated frame at offset %d" % position)
+        messages.append(data[start:stop])
+        position = stop + 1
+    return messages
+
+def is_framed_request(request):
+    """Return True if a request's body holds framed messages."""
+    content_type = request.getHeader("Content-Type") or ""
+    return content_type.split(";")[0].strip() == FRAMED_CONTENT_TYPE
+
+def encode_event(message):
+    """Encode a message as a Server-Sent Event. A message
+        spanning several lines is sent as several "data" lines,
+        which the client joins back together."""
+    return "".join("data: %s\n" % line for line in message.split("\n")) + "\n"
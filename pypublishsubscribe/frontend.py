@@ -0,0 +1,116 @@
+"""What the HTTP front ends share, beyond the engine itself: the
+parts of a long poll, an event stream and a fetch from all of a
+user's topics that don't depend on how requests arrive or are
+answered. Each front end (publishsubscribeserver.py for Twisted,
+asyncoreserver.py for asyncore) wraps these in its own request
+handling, timers and connection-lost hooks."""
+from pypublishsubscribe.engine import get_positive_arg
+from pypublishsubscribe.framing import encode_event
+
+class TopicWatch(object):
+    """Watches the topics a parked GET is for, fetching as soon as
+        a message is published to any of them.
+
+        "topics" is called for the topics to watch, "is_subscribed"
+        to check that whoever is waiting is still subscribed, and
+        "fetch" to try to fetch messages for them, returning None if
+        there were none. "finish" is called, once, with the response
+        code and what "fetch" returned (None for a 404)."""
+
+    def __init__(self, engine, topics, is_subscribed, fetch, finish):
+        self.engine = engine
+        self.topics = topics
+        self.is_subscribed = is_subscribed
+        self.fetch = fetch
+        self.finish = finish
+        # Every topic watched so far, which the waiter must be
+        # removed from at the end.
+        self.watched = set()
+
+    def watch(self):
+        for topic in self.topics():
+            self.engine.add_waiter(topic, self.on_topic_changed)
+            self.watched.add(topic)
+
+    def unwatch(self):
+        for topic in self.watched:
+            self.engine.remove_waiter(topic, self.on_topic_changed)
+
+    def on_topic_changed(self):
+        if not self.is_subscribed():
+            # The user unsubscribed while we were waiting.
+            self.finish(404, None)
+            return
+        result = self.fetch()
+        if result is None:
+            # Another request for this user got there first,
+            # so keep waiting.
+            self.watch()
+        else:
+            self.finish(200, result)
+
+class TopicStream(object):
+    """Pushes each of a user's messages on a topic, encoded as a
+        Server-Sent Event, to "write" as soon as it is published.
+        "end" is called when the user unsubscribes. "stop" must be
+        called once the response has finished, however it ended."""
+
+    def __init__(self, engine, topic, username, write, end):
+        self.engine = engine
+        self.topic = topic
+        self.username = username
+        self.write = write
+        self.end = end
+        self.stopped = False
+
+    def on_topic_changed(self):
+        if self.stopped:
+            return
+        if not self.engine.is_valid_username_and_topic(self.topic, self.username):
+            self.end()
+            return
+        messages = self.engine.take_messages(self.topic, self.username, self.engine.max_messages)
+        if messages:
+            self.write("".join(encode_event(message) for message in messages))
+        self.engine.add_waiter(self.topic, self.on_topic_changed)
+
+    def stop(self):
+        self.stopped = True
+        self.engine.remove_waiter(self.topic, self.on_topic_changed)
+
+class UserFetch(object):
+    """A GET of /_user/<username>, fetching from all of the user's
+        topics at once (see PublishSubscribeServer.render_user).
+        "error" is the response code the request fails with, or
+        None if it is valid."""
+
+    def __init__(self, engine, postpath, args):
+        self.engine = engine
+        self.error = None
+        if len(postpath) != 2 or not engine.is_valid_user(postpath[1]):
+            self.error = 404
+            return
+        self.username = postpath[1]
+        try:
+            self.max_count = get_positive_arg(args, "max", engine.max_messages)
+            self.wait = get_positive_arg(args, "wait", None, float)
+        except ValueError:
+            self.error = 400
+            return
+        if "stream" in args or "lease" in args or "max_bytes" in args:
+            self.error = 400
+
+    def topics(self):
+        return self.engine.user_topics(self.username)
+
+    def is_subscribed(self):
+        return self.engine.is_valid_user(self.username)
+
+    def take(self):
+        """Take the user's next messages, returning the frames of
+            the response body, alternating between a topic and a
+            message from it, or None if there were none."""
+        taken = self.engine.take_user_messages(self.username, self.max_count)
+        if not taken:
+            return None
+        return [part for pair in taken for part in pair]
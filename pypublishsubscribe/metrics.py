@@ -0,0 +1,268 @@
+"""Low-overhead runtime metrics, exposed in the Prometheus text
+format, and a sampling profiler that can be switched on and off
+while the server is running."""
+import sys
+import time
+import threading
+from bisect import bisect_left
+from pypublishsubscribe.filters import view_topic
+
+# The reserved path under which metrics are served. It can't
+# be used as a topic name.
+METRICS_PATH = "_metrics"
+
+# Label value used for every topic beyond the cardinality limit.
+OTHER_TOPICS = "_other"
+
+# Bucket upper bounds, in seconds, used for timings.
+TIMING_BUCKETS = [0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0]
+
+class TopicLabels(object):
+    """Limits the number of distinct topics that metrics are
+        labelled with. The first "max_topics" topics seen get their
+        own label, and every topic after that shares one."""
+
+    def __init__(self, max_topics):
+        self.max_topics = max_topics
+        self.topics = set()
+
+    def __call__(self, topic):
+        # Filtered subscriptions are reported as part of their topic.
+        topic = view_topic(topic)
+        if topic in self.topics:
+            return topic
+        if len(self.topics) < self.max_topics:
+            self.topics.add(topic)
+            return topic
+        return OTHER_TOPICS
+
+class Counter(object):
+    """A count that only goes up, for each combination of labels."""
+
+    type = "counter"
+
+    def __init__(self, name, help, label_names=()):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.values = {}
+
+    def inc(self, labels=(), amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in self.values.iteritems():
+            yield self.name, zip(self.label_names, labels), value
+
+class Histogram(object):
+    """Counts of observed values falling into fixed buckets, along
+        with their sum, for each combination of labels."""
+
+    type = "histogram"
+
+    def __init__(self, name, help, label_names=(), buckets=TIMING_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, value, labels=()):
+        series = self.series.get(labels)
+        if series is None:
+            # One count per bucket, plus one for +Inf, then the sum.
+            series = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def samples(self):
+        for labels, series in self.series.iteritems():
+            label_pairs = zip(self.label_names, labels)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ["+Inf"], series):
+                cumulative += count
+                yield self.name + "_bucket", label_pairs + [("le", str(bound))], cumulative
+            yield self.name + "_sum", label_pairs, series[-1]
+            yield self.name + "_count", label_pairs, cumulative
+
+class Gauge(object):
+    """A value computed only when metrics are collected, by calling
+        "collect", which returns (labels, value) pairs."""
+
+    type = "gauge"
+
+    def __init__(self, name, help, label_names, collect):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.collect = collect
+
+    def samples(self):
+        for labels, value in self.collect():
+            yield self.name, zip(self.label_names, labels), value
+
+class CollectedCounter(Gauge):
+    """A count that only goes up, but which is kept elsewhere and
+        computed by calling "collect" when metrics are collected."""
+
+    type = "counter"
+
+class Registry(object):
+    """A collection of metrics, rendered together."""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Render every metric in the Prometheus text format."""
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP %s %s" % (metric.name, metric.help))
+            lines.append("# TYPE %s %s" % (metric.name, metric.type))
+            for name, label_pairs, value in metric.samples():
+                if label_pairs:
+                    labels = ",".join('%s="%s"' % (label, escape_label_value(label_value))
+                            for label, label_value in label_pairs)
+                    lines.append("%s{%s} %s" % (name, labels, format_value(value)))
+                else:
+                    lines.append("%s %s" % (name, format_value(value)))
+        return "\n".join(lines) + "\n"
+
+def escape_label_value(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+def sum_by_topic(topic_labels, pairs):
+    """Sum (topic, value) pairs by their topic label, so that every
+        topic beyond the cardinality limit is reported together."""
+    totals = {}
+    for topic, value in pairs:
+        label = topic_labels(topic)
+        totals[label] = totals.get(label, 0) + value
+    return [((label,), value) for label, value in totals.iteritems()]
+
+class ServerMetrics(object):
+    """The metrics kept by a PublishSubscribeServer. The depth,
+        subscriber count, evictions and expiries of each topic are read from
+        the topics themselves when metrics are collected, so they
+        cost nothing while serving requests."""
+
+    def __init__(self, topics, max_topics=100):
+        self.topics = topics
+        self.topic_labels = TopicLabels(max_topics)
+        # Evictions and expiries from topics that have since
+        # been removed.
+        self.retired_evictions = {}
+        self.retired_expiries = {}
+        self.registry = Registry()
+        register = self.registry.register
+        self.requests = register(Counter("pubsub_requests_total",
+                "Requests handled, by method and response code.", ("method", "code")))
+        self.request_seconds = register(Histogram("pubsub_request_seconds",
+                "Time spent rendering requests, by method.", ("method",)))
+        self.published = register(Counter("pubsub_messages_published_total",
+                "Messages appended to a topic.", ("topic",)))
+        self.dropped = register(Counter("pubsub_messages_dropped_total",
+                "Messages posted to a topic with no subscribers.", ("topic",)))
+        self.rejected = register(Counter("pubsub_messages_rejected_total",
+                "Messages refused because a topic, or the server, was full.", ("topic",)))
+        self.filtered = register(Counter("pubsub_messages_filtered_total",
+                "Messages left out of a filtered subscription to their topic, once for each such subscription.",
+                ("topic",)))
+        self.delivered = register(Counter("pubsub_messages_delivered_total",
+                "Messages delivered to subscribers.", ("topic",)))
+        self.fetch_seconds = register(Histogram("pubsub_fetch_seconds",
+                "Time spent taking messages from a topic for a subscriber.", ("topic",)))
+        self.leases_expired = register(Counter("pubsub_leases_expired_total",
+                "Leased messages not acknowledged in time, and so redelivered.", ("topic",)))
+        self.snapshots = register(Counter("pubsub_snapshots_total",
+                "Snapshots written, by whether they succeeded.", ("result",)))
+        register(Gauge("pubsub_topics", "Topics with at least one subscriber.", (),
+                lambda: [((), len(self.topics))]))
+        register(Gauge("pubsub_topic_messages", "Messages held in each topic.", ("topic",),
+                lambda: sum_by_topic(self.topic_labels,
+                        ((name, len(topic)) for name, topic in self.topics.iteritems()))))
+        register(Gauge("pubsub_topic_bytes", "Bytes of messages held in memory by each topic.", ("topic",),
+                lambda: sum_by_topic(self.topic_labels,
+                        ((name, topic.bytes) for name, topic in self.topics.iteritems()))))
+        register(Gauge("pubsub_topic_subscribers", "Subscribers to each topic.", ("topic",),
+                lambda: sum_by_topic(self.topic_labels,
+                        ((name, len(topic.cursors)) for name, topic in self.topics.iteritems()))))
+        register(CollectedCounter("pubsub_messages_evicted_total",
+                "Messages dropped, unread, because a topic was full.", ("topic",),
+                self.collect_evictions))
+        register(CollectedCounter("pubsub_messages_expired_total",
+                "Messages dropped, unread, because their time-to-live had passed.", ("topic",),
+                self.collect_expiries))
+
+    def collect_evictions(self):
+        return sum_by_topic(self.topic_labels,
+                [(name, topic.evicted) for name, topic in self.topics.iteritems()] +
+                self.retired_evictions.items())
+
+    def collect_expiries(self):
+        return sum_by_topic(self.topic_labels,
+                [(name, topic.expired) for name, topic in self.topics.iteritems()] +
+                self.retired_expiries.items())
+
+    def topic_removed(self, name, topic):
+        if topic.evicted:
+            label = self.topic_labels(name)
+            self.retired_evictions[label] = self.retired_evictions.get(label, 0) + topic.evicted
+        if topic.expired:
+            label = self.topic_labels(name)
+            self.retired_expiries[label] = self.retired_expiries.get(label, 0) + topic.expired
+
+    def render(self):
+        return self.registry.render()
+
+class SamplingProfiler(object):
+    """Samples the stack of one thread (normally the reactor's) at
+        a fixed interval, from a separate thread. Samples are kept
+        as counts of each distinct stack, and reported in the
+        "collapsed" format used by flame graph tools."""
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {}
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        while self.running:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("%s:%s" % (code.co_filename, code.co_name))
+                    frame = frame.f_back
+                key = ";".join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            time.sleep(self.interval)
+
+    def render(self):
+        # The sampling thread may add stacks meanwhile, so work from
+        # a copy, which "items" makes without releasing the GIL.
+        return "".join("%s %d\n" % (stack, count)
+                for stack, count in sorted(self.stacks.items(), key=lambda item: -item[1]))
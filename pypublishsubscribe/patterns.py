@@ -0,0 +1,88 @@
+"""Hierarchical topic names and wildcard subscriptions.
+
+Topic names are made up of words separated by dots, such as
+"orders.eu.fr". A subscription may be to a pattern rather than a
+single topic, in which "*" matches exactly one word and "#"
+matches any number of words (including none). For example,
+"orders.*.fr" matches "orders.eu.fr", and "orders.#" matches
+"orders", "orders.eu" and "orders.eu.fr"."""
+
+SEPARATOR = "."
+ONE_WORD = "*"
+ANY_WORDS = "#"
+
+def is_pattern(name):
+    """Return True if a name is a wildcard pattern rather than
+        a single topic."""
+    for word in name.split(SEPARATOR):
+        if word == ONE_WORD or word == ANY_WORDS:
+            return True
+    return False
+
+class TrieNode(object):
+    __slots__ = ("children", "patterns")
+
+    def __init__(self):
+        self.children = {}
+        # The patterns that end at this node.
+        self.patterns = set()
+
+class SubscriptionTrie(object):
+    """An index of wildcard patterns, arranged as a trie of their
+        words. Finding the patterns that match a topic walks down
+        the trie one word at a time, so it takes time proportional
+        to the depth of the topic (and the number of wildcards on
+        the way), not the number of patterns."""
+
+    def __init__(self):
+        self.root = TrieNode()
+
+    def __nonzero__(self):
+        return bool(self.root.children)
+
+    def add(self, pattern):
+        node = self.root
+        for word in pattern.split(SEPARATOR):
+            child = node.children.get(word)
+            if child is None:
+                child = node.children[word] = TrieNode()
+            node = child
+        node.patterns.add(pattern)
+
+    def remove(self, pattern):
+        # Walk down, remembering the path, then prune any nodes
+        # left with no patterns and no children.
+        path = []
+        node = self.root
+        for word in pattern.split(SEPARATOR):
+            path.append((node, word))
+            node = node.children[word]
+        node.patterns.discard(pattern)
+        for parent, word in reversed(path):
+            child = parent.children[word]
+            if child.patterns or child.children:
+                break
+            del parent.children[word]
+
+    def match(self, topic):
+        """Return the set of patterns matching a topic."""
+        matches = set()
+        self._match(self.root, topic.split(SEPARATOR), 0, matches)
+        return matches
+
+    def _match(self, node, words, index, matches):
+        any_words = node.children.get(ANY_WORDS)
+        if any_words is not None:
+            # "#" can match any number of the remaining words,
+            # including none of them.
+            for next_index in xrange(index, len(words) + 1):
+                self._match(any_words, words, next_index, matches)
+        if index == len(words):
+            matches.update(node.patterns)
+            return
+        child = node.children.get(words[index])
+        if child is not None:
+            self._match(child, words, index + 1, matches)
+        one_word = node.children.get(ONE_WORD)
+        if one_word is not None:
+            self._match(one_word, words, index + 1, matches)
@@ -0,0 +1,114 @@
+"""Large messages, and the compressed forms they are sent in.
+
+A message at least as large as the engine's "compress_min_bytes" is
+held as a Payload. That is still the message's own bytes, so it is
+stored, framed and counted like any other message, but it also
+keeps the message compressed in each encoding a client has asked
+for. gzip, which every client that compresses accepts, is made as
+the message is published. A message published to many subscriptions
+is one Payload, so each encoding is made once and then shared by
+every response that sends the message in it.
+
+Only responses holding a single message are compressed: a framed
+body is made up afresh for each response, so has nothing to share."""
+import zlib
+
+def gzip_compress(data):
+    # zlib writes a gzip header and trailer, rather than its own,
+    # when given 16 more than the window size.
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+# What HTTP calls "deflate" is the zlib format.
+COMPRESSORS = {
+    "gzip": gzip_compress,
+    "deflate": zlib.compress,
+}
+
+# Older names for the same encodings.
+ENCODING_ALIASES = {
+    "x-gzip": "gzip",
+}
+
+# The encodings an Accept-Encoding of "*" stands for, most preferred
+# first, unless the header names them itself.
+WILDCARD_ENCODINGS = ("gzip", "deflate")
+
+class Payload(str):
+    """A message large enough to be worth compressing."""
+
+    def __new__(cls, message):
+        payload = str.__new__(cls, message)
+        # The message in each encoding asked for so far, or None
+        # where compressing didn't make it any smaller.
+        payload.encodings = {}
+        return payload
+
+    def encoded(self, encoding):
+        """Return the message compressed in "encoding", or None if
+            that isn't supported or doesn't make it smaller."""
+        if encoding not in self.encodings:
+            compress = COMPRESSORS.get(encoding)
+            if compress is None:
+                return None
+            body = compress(self)
+            self.encodings[encoding] = body if len(body) < len(self) else None
+        return self.encodings[encoding]
+
+def prepare_message(message, min_bytes):
+    """Return a published message as a Payload, already compressed
+        with gzip, if it is at least "min_bytes" long, or as it is
+        if not."""
+    if len(message) < min_bytes or isinstance(message, Payload):
+        return message
+    payload = Payload(message)
+    payload.encoded("gzip")
+    return payload
+
+def accepted_encodings(header):
+    """Return the encodings an Accept-Encoding header allows, most
+        preferred first. Encodings given a quality of 0 are left
+        out. "*" stands for each of WILDCARD_ENCODINGS that the
+        header doesn't name, whatever quality it gives them."""
+    choices = []
+    named = set()
+    wildcards = []
+    for index, item in enumerate((header or "").split(",")):
+        fields = item.split(";")
+        encoding = fields[0].strip().lower()
+        quality = 1.0
+        for parameter in fields[1:]:
+            name, _, value = parameter.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        encoding = ENCODING_ALIASES.get(encoding, encoding)
+        if encoding == "*":
+            wildcards.append((quality, index))
+            continue
+        named.add(encoding)
+        if encoding and quality > 0:
+            choices.append((-quality, index, 0, encoding))
+    # The rest of the header has been read, so we know which
+    # encodings "*" doesn't cover.
+    for quality, index in wildcards:
+        if quality > 0:
+            choices.extend((-quality, index, order, encoding)
+                    for order, encoding in enumerate(WILDCARD_ENCODINGS) if encoding not in named)
+    return [choice[3] for choice in sorted(choices)]
+
+def encode_message(message, accept_encoding):
+    """Return (encoding, body) for a response holding just "message".
+        The body is the message in the encoding the client most
+        prefers, of those it can be sent in, or the message itself,
+        with an encoding of None."""
+    if isinstance(message, Payload):
+        for encoding in accepted_encodings(accept_encoding):
+            if encoding == "identity":
+                break
+            body = message.encoded(encoding)
+            if body is not None:
+                return encoding, body
+    return None, message
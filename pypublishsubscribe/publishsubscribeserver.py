@@ -1,161 +1,486 @@
+import os
 import sys
+import signal
 from twisted.web import server, resource
-from twisted.internet import reactor
-from collections import deque
-from copy import copy
+from twisted.internet import reactor, task
+from pypublishsubscribe.engine import PublishSubscribeEngine, get_positive_arg, EXPIRY_TICK, USER_PATH
+from pypublishsubscribe.storage import SegmentStore
+from pypublishsubscribe.framing import encode_frames, decode_frames, is_framed_request, FRAMED_CONTENT_TYPE
+from pypublishsubscribe.frontend import TopicWatch, TopicStream, UserFetch
+from pypublishsubscribe.binaryserver import BinaryProtocolFactory
+from pypublishsubscribe.cluster import ShardedPublishSubscribeServer, listen_shared, run_workers, worker_socket_paths
+from pypublishsubscribe.metrics import METRICS_PATH
+from pypublishsubscribe.patterns import is_pattern
+from pypublishsubscribe.payload import encode_message
+from pypublishsubscribe.topic import TopicFull, ServerFull, OVERFLOW_POLICIES, DROP_OLDEST, SPILL
+from pypublishsubscribe import asyncoreserver
 import argparse
+import json
+import time
 
 class PublishSubscribeServer(resource.Resource):
     """A simple Publish-Subscribe server, allowing
         users to subscribe to messages on specific
-        topics."""
-    
-    # "max_messages" is the max number that can be posted
-    # for one topic. Once this limit is reached we delete
-    # the oldest message when adding the new one. Failure
-    # to do this would leave open a possible attack vector
-    # where an unlimited number of messages could be posted
-    # to a topic without messages ever being pulled off the
-    # queue by subscribers.
-    def __init__(self, max_messages=500):
-	self.max_messages = max_messages
-
-    # The backing data structure here consists of
-    # a dict of tuples. The key is the topic
-    # name. The value is a tuple of a set
-    # of strings (the current subscribers),
-    # and deque of tuples (the messages).
-    # Each message tuple takes the form:
-    # (message, {subscriber_name_1, subscriber_name_2, ...})
-    # When a new message is published we copy the current set
-    # of subscribers into a new tuple.
-    topics = {}
+        topics.
+
+        This is the Twisted front end to a PublishSubscribeEngine
+        (see engine.py), which holds the topics themselves. The
+        arguments are as for the engine, which is created here
+        unless an existing one is given."""
+
+    def __init__(self, max_messages=500, storage=None, metrics_max_topics=100, engine=None):
+        resource.Resource.__init__(self)
+        if engine is None:
+            engine = PublishSubscribeEngine(max_messages, storage, metrics_max_topics)
+        self.engine = engine
+        self.expiry = task.LoopingCall(engine.expire)
+        self.expiry.start(EXPIRY_TICK, now=False)
 
     isLeaf = True
 
+    def render(self, request):
+        """Dispatch a request to the matching render method,
+            recording how long it took and its response code."""
+        if request.postpath[0] == METRICS_PATH:
+            return self.render_metrics(request)
+        start = time.time()
+        if request.postpath[0] == USER_PATH:
+            result = self.render_user(request)
+        else:
+            result = resource.Resource.render(self, request)
+        self.engine.metrics.request_seconds.observe(time.time() - start, (request.method,))
+        if result is server.NOT_DONE_YET:
+            # The response code isn't known until the response
+            # is finished.
+            request.notifyFinish().addBoth(self.count_request, request)
+        else:
+            self.count_request(None, request)
+        return result
+
+    def count_request(self, result, request):
+        self.engine.metrics.requests.inc((request.method, str(request.code)))
+
+    def render_metrics(self, request):
+        """Handle a request to the reserved /_metrics path. A GET
+            of /_metrics returns the server's metrics in the
+            Prometheus text format. /_metrics/profile controls a
+            sampling profiler: a POST starts it, sampling every
+            "interval" seconds, a DELETE stops it, and a GET returns
+            the samples taken so far as collapsed stacks."""
+        if request.postpath == [METRICS_PATH] and request.method == "GET":
+            request.setHeader("Content-Type", "text/plain; version=0.0.4")
+            return self.engine.metrics.render()
+        if request.postpath != [METRICS_PATH, "profile"]:
+            request.setResponseCode(404)
+            return ""
+        profiler = self.engine.profiler
+        if request.method == "POST":
+            try:
+                interval = get_positive_arg(request.args, "interval", 0.005, float)
+            except ValueError:
+                request.setResponseCode(400)
+                return ""
+            self.engine.start_profiler(interval)
+            return ""
+        if request.method == "DELETE" and profiler is not None:
+            profiler.stop()
+            return ""
+        if request.method == "GET" and profiler is not None:
+            request.setHeader("Content-Type", "text/plain")
+            return profiler.render()
+        request.setResponseCode(404)
+        return ""
+
+    def render_user(self, request):
+        """Handle a request to the reserved /_user path. A GET of
+            /_user/<username> fetches the user's messages from every
+            topic they are subscribed to at once. They come in a
+            single framed body, alternating between a topic's name
+            and a message from it, as for a POST to many topics. The
+            topics take turns, so that each gets its share of the
+            (up to) "max" messages returned. "wait" works as for a
+            single topic, returning as soon as any of the topics has
+            a message. A user with no subscriptions gets a 404."""
+        if request.method != "GET":
+            request.setHeader("Allow", "GET")
+            request.setResponseCode(405)
+            return ""
+        user_fetch = UserFetch(self.engine, request.postpath, request.args)
+        if user_fetch.error is not None:
+            request.setResponseCode(user_fetch.error)
+            return ""
+        def fetch():
+            frames = user_fetch.take()
+            if frames is None:
+                return None
+            request.setResponseCode(200)
+            request.setHeader("Content-Type", FRAMED_CONTENT_TYPE)
+            return encode_frames(frames)
+        body = fetch()
+        if body is not None:
+            return body
+        if user_fetch.wait:
+            LongPoll(self.engine, request, user_fetch.topics, user_fetch.is_subscribed, fetch, user_fetch.wait)
+            return server.NOT_DONE_YET
+        request.setResponseCode(204)
+        return ""
+
     def render_GET(self, request):
         """Handle a GET, which is a request by a user
             for any outstanding messages. A valid request
             will return a 200, and an invalid request will
-            return a 404."""
+            return a 404.
+
+            Adding "max" and/or "max_bytes" fetches several
+            messages at once, in a single framed body. Adding
+            "wait" holds the request open for up to that many
+            seconds until a message arrives, rather than returning
+            a 204 straight away. Adding "stream" turns the response
+            into a stream of Server-Sent Events, which pushes each
+            message as soon as it is published.
+
+            Adding "lease" gives at-least-once delivery: the
+            messages are returned with an X-Delivery-Id header, and
+            are given out again unless that id is acknowledged
+            (see render_POST) within "lease" seconds.
+
+            A GET of /<topic>/<group>/<member> fetches messages for
+            a member of a consumer group instead."""
+        if len(request.postpath) == 3:
+            return self.render_group_GET(request)
         if len(request.postpath) != 2:
-            # The only valid target for a GET
-            # is /<topic>/<username>
+            # The only valid targets for a GET are
+            # /<topic>/<username> and /<topic>/<group>/<member>
             request.setResponseCode(404)
             return ""
         topic = request.postpath[0]
         username = request.postpath[1]
-        if not self.is_valid_username_and_topic(topic, username):
+        if not self.engine.is_valid_username_and_topic(topic, username):
             # If a valid subscription doesn't exist
             # then return a 404.
             request.setResponseCode(404)
             return ""
-        message_generator = self.get_and_remove_next_message(topic, username)
-	the_message = message_generator.next()
-	if the_message:
-	    request.setResponseCode(200)
-            return the_message
-	else:
-	    request.setResponseCode(204)
-	    return ""
+        try:
+            max_count = get_positive_arg(request.args, "max", None)
+            max_bytes = get_positive_arg(request.args, "max_bytes", None)
+            wait = get_positive_arg(request.args, "wait", None, float)
+            lease = get_positive_arg(request.args, "lease", None, float)
+        except ValueError:
+            request.setResponseCode(400)
+            return ""
+        if "stream" in request.args:
+            if lease is not None:
+                # A stream has no way to acknowledge.
+                request.setResponseCode(400)
+                return ""
+            EventStream(self.engine, request, topic, username)
+            return server.NOT_DONE_YET
+        if lease is not None:
+            fetch = lambda: self.lease_messages(request, topic, username, max_count, max_bytes, lease)
+        elif max_count is None and max_bytes is None:
+            fetch = lambda: self.fetch_message(request, topic, username)
+        else:
+            fetch = lambda: self.fetch_messages(request, topic, username, max_count, max_bytes)
+        body = fetch()
+        if body is not None:
+            return body
+        if wait:
+            LongPoll(self.engine, request, lambda: [topic],
+                    lambda: self.engine.is_valid_username_and_topic(topic, username), fetch, wait)
+            return server.NOT_DONE_YET
+        request.setResponseCode(204)
+        return ""
+
+    def render_group_GET(self, request):
+        """Handle a GET by a member of a consumer group. This takes
+            the group's next messages, which no other member of the
+            group will be given, and acknowledges the messages the
+            member was given last time. "max", "max_bytes" and
+            "wait" work as for a subscriber, but "stream" isn't
+            supported, as a stream has no way to acknowledge."""
+        topic, group, member = request.postpath
+        if not self.engine.is_valid_member(topic, group, member):
+            request.setResponseCode(404)
+            return ""
+        try:
+            max_count = get_positive_arg(request.args, "max", None)
+            max_bytes = get_positive_arg(request.args, "max_bytes", None)
+            wait = get_positive_arg(request.args, "wait", None, float)
+        except ValueError:
+            request.setResponseCode(400)
+            return ""
+        if "stream" in request.args or "lease" in request.args:
+            request.setResponseCode(400)
+            return ""
+        framed = max_count is not None or max_bytes is not None
+        if not framed:
+            max_count = 1
+        elif max_count is None:
+            max_count = self.engine.max_messages
+        def fetch():
+            messages = self.engine.take_group_messages(topic, group, member, max_count, max_bytes)
+            if not messages:
+                return None
+            request.setResponseCode(200)
+            if not framed:
+                return self.message_body(request, messages[0])
+            request.setHeader("Content-Type", FRAMED_CONTENT_TYPE)
+            return encode_frames(messages)
+        body = fetch()
+        if body is not None:
+            return body
+        if wait:
+            LongPoll(self.engine, request, lambda: [topic], lambda: self.engine.is_valid_member(topic, group, member),
+                    fetch, wait)
+            return server.NOT_DONE_YET
+        request.setResponseCode(204)
+        return ""
+
+    def fetch_message(self, request, topic, username):
+        """Return the user's next message as the response body,
+            or None if they have no outstanding messages."""
+        the_message = self.engine.get_and_remove_next_message(topic, username)
+        if the_message is None:
+            return None
+        request.setResponseCode(200)
+        return self.message_body(request, the_message)
+
+    def fetch_messages(self, request, topic, username, max_count, max_bytes):
+        """Return up to "max_count" of the user's outstanding
+            messages (and, if given, at most "max_bytes" of them)
+            framed as a single response body, or None if they have
+            no outstanding messages."""
+        if max_count is None:
+            max_count = self.engine.max_messages
+        messages = self.engine.take_messages(topic, username, max_count, max_bytes)
+        if not messages:
+            return None
+        request.setResponseCode(200)
+        request.setHeader("Content-Type", FRAMED_CONTENT_TYPE)
+        return encode_frames(messages)
+
+    def lease_messages(self, request, topic, username, max_count, max_bytes, lease):
+        """As fetch_message, or fetch_messages if "max_count" or
+            "max_bytes" is given, but leasing the messages for
+            "lease" seconds, with the delivery id in a header."""
+        framed = max_count is not None or max_bytes is not None
+        if not framed:
+            max_count = 1
+        elif max_count is None:
+            max_count = self.engine.max_messages
+        delivery_id, messages = self.engine.lease_messages(topic, username, max_count, lease, max_bytes)
+        if delivery_id is None:
+            return None
+        request.setResponseCode(200)
+        request.setHeader("X-Delivery-Id", str(delivery_id))
+        if not framed:
+            return self.message_body(request, messages[0])
+        request.setHeader("Content-Type", FRAMED_CONTENT_TYPE)
+        return encode_frames(messages)
+
+    def message_body(self, request, message):
+        """Return the body of a response holding just "message",
+            compressed if it has been compressed in an encoding that
+            the client accepts. The body is the string held by the
+            topic, or its cached compressed form, so nothing is
+            copied before Twisted writes it out."""
+        encoding, body = encode_message(message, request.getHeader("Accept-Encoding"))
+        if encoding is not None:
+            request.setHeader("Content-Encoding", encoding)
+        if self.engine.compress_min_bytes is not None:
+            request.setHeader("Vary", "Accept-Encoding")
+        return body
 
     def render_POST(self, request):
+        def publish(publish_function, *args):
+            """Publish, with the time-to-live given by "ttl", if any.
+                Returns a 429 if the topic is full (so that the
+                publisher slows down until subscribers catch up) or
+                a 503 if the server is."""
+            try:
+                ttl = get_positive_arg(request.args, "ttl", None, float)
+            except ValueError:
+                return 400, None
+            try:
+                return 200, publish_function(*(args + (ttl,)))
+            except TopicFull:
+                return 429, None
+            except ServerFull:
+                return 503, None
         def new_message(topic, message):
             """Post a new message to a topic."""
-            if topic in self.topics:
-                # If topic has been subscribed to then add a new entry,
-                # copying the set of current subscribers.
-                topic_entry = self.topics[topic]
-		subscribers = set(topic_entry[0])
-		messages = topic_entry[1]
-                messages.append((message, subscribers))
-            return 200, ""
+            if is_pattern(topic):
+                # Messages must go to a single topic.
+                return 400, ""
+            return publish(self.engine.publish, topic, [message])[0], ""
+        def new_messages(topic, body):
+            """Post a framed batch of messages to a topic,
+                returning their sequence numbers as JSON."""
+            if is_pattern(topic):
+                return 400, ""
+            try:
+                messages = decode_frames(body)
+            except ValueError:
+                return 400, ""
+            response_code, sequence_numbers = publish(self.engine.publish, topic, messages)
+            return response_code, json.dumps(sequence_numbers) if response_code == 200 else ""
+        def new_messages_multi_topic(body):
+            """Post a framed batch of messages to many topics.
+                The frames alternate between a topic name and a
+                message for that topic. Returns the messages'
+                sequence numbers as JSON, in the order they
+                were given."""
+            try:
+                frames = decode_frames(body)
+            except ValueError:
+                return 400, ""
+            if len(frames) % 2:
+                return 400, ""
+            if any(is_pattern(frames[index]) for index in xrange(0, len(frames), 2)):
+                # Messages must go to a single topic.
+                return 400, ""
+            response_code, sequence_numbers = publish(self.engine.publish_multi_topic, frames)
+            return response_code, json.dumps(sequence_numbers) if response_code == 200 else ""
         def new_subscription(topic, username):
-            """Subscribe a user to a topic."""
-            if topic in self.topics:
-                # If the topic already exists then simply
-                # add the user to the set of subscribers.
-		subscribers = self.topics[topic][0] 
-                subscribers.add(username)
-            else:
-                # If the topic doesn't exist then add it,
-                # and initialize the set of subscribers as the set
-                # containing just this user, with messages
-                # as an empty deque.
-		subscribers = set()
-		subscribers.add(username)
-                self.topics[topic] = (subscribers, deque(maxlen=self.max_messages))
+            """Subscribe a user to a topic, filtered by any "filter"
+                conditions given (see filters.py)."""
+            try:
+                self.engine.subscribe(topic, username, request.args.get("filter"))
+            except ValueError:
+                return 400, ""
+            return 200, ""
+        def acknowledge(topic, username, delivery_id):
+            """Acknowledge messages leased to a user by a GET with
+                "lease", committing them. Acknowledging an expired
+                lease returns a 404, as its messages will be given
+                out again."""
+            if not self.engine.is_valid_username_and_topic(topic, username):
+                return 404, ""
+            try:
+                delivery_id = int(delivery_id)
+            except ValueError:
+                return 400, ""
+            if not self.engine.acknowledge(topic, username, delivery_id):
+                return 404, ""
+            return 200, ""
+        def join_group(topic, group, member):
+            """Add a member to a consumer group on a topic."""
+            try:
+                self.engine.join_group(topic, group, member)
+            except ValueError:
+                return 400, ""
             return 200, ""
         postpath_length = len(request.postpath)
-        if postpath_length == 1:
+        is_framed = is_framed_request(request)
+        if request.postpath == [""] and is_framed:
+            response_code, status_message = new_messages_multi_topic(request.content.read())
+        elif postpath_length == 1 and is_framed:
+            response_code, status_message = new_messages(request.postpath[0], request.content.read())
+        elif postpath_length == 1:
             response_code, status_message = new_message(request.postpath[0], request.content.read())
+        elif postpath_length == 2 and "ack" in request.args:
+            response_code, status_message = acknowledge(request.postpath[0], request.postpath[1],
+                    request.args["ack"][0])
         elif postpath_length == 2:
             response_code, status_message = new_subscription(request.postpath[0], request.postpath[1])
+        elif postpath_length == 3:
+            response_code, status_message = join_group(*request.postpath)
         else:
-            # The only valid targets are
-            # /<topic> and /<topic>/<username>
+            # The only valid targets are /<topic>,
+            # /<topic>/<username> and /<topic>/<group>/<member>
             request.setResponseCode(404)
             return ""
-        request.setResponseCode(response_code)
-        return status_message
-
+        return self.respond_when_durable(request, response_code, status_message)
 
     def render_DELETE(self, request):
-        if len(request.postpath) != 2:
-            request.setResponseCode(404)
-            return ""
-        topic = request.postpath[0]
-        username = request.postpath[1]
-        if not self.is_valid_username_and_topic(topic, username):
-            # If this isn't a valid topic, or if user is not subscribed.
+        if len(request.postpath) == 3:
+            topic, group, member = request.postpath
+            if not self.engine.is_valid_member(topic, group, member):
+                request.setResponseCode(404)
+                return ""
+            self.engine.leave_group(topic, group, member)
+        elif len(request.postpath) == 2:
+            topic = request.postpath[0]
+            username = request.postpath[1]
+            if not self.engine.is_valid_username_and_topic(topic, username):
+                # If this isn't a valid topic, or if user is not subscribed.
+                request.setResponseCode(404)
+                return ""
+            self.engine.unsubscribe(topic, username)
+        else:
             request.setResponseCode(404)
             return ""
-        # Remove the user from the set of subscribers
-        # to this topic.
-	subscribers = self.topics[topic][0] 
-        subscribers.remove(username)
-        if not subscribers:
-            # If there are no more subscribers to this topic
-            # then remove it.
-	    del self.topics[topic]
-        else:
-            # There are still subscribers. However we must
-            # remove this user from any messages they are currently
-            # subscribed to on this topic, otherwise this message will never
-            # be deleted, and effectively leaks memory.
-            message_generator = self.get_and_remove_next_message(topic, username)
-	    # Remove any messages for this user by iterating over the
-	    # generator until we get None.
-	    while message_generator.next(): pass
-        request.setResponseCode(200)
-        return ""
-        
-    def is_valid_username_and_topic(self, topic, username):
-        return topic in self.topics and username in self.topics[topic][0]
-        
-    def get_and_remove_next_message(self, topic, username):
-	topic_entry = self.topics[topic]
-	messages = topic_entry[1]
-        for index, message in enumerate(copy(messages)):
-        # Enumerate over *copy* to allow removal.
-            subscribers = message[1]
-            if username in subscribers:
-            # Note the message content to return.
-                the_message = message[0]
-                # Remove from *original* using index.
-                subscribers = messages[index][1] 
-                subscribers.remove(username)
-                if not subscribers:
-                    # If all users have received then
-                    # delete the message, *from original list*.
-                    del messages[index]
-                yield the_message
-        yield None
-                
+        return self.respond_when_durable(request, 200, "")
+
+    def respond_when_durable(self, request, response_code, body):
+        """Respond to a request that changed a topic. When topics
+            are stored on disk the response is held back until the
+            change has been synced, so that a client is never told
+            of a change that could be lost."""
+        request.setResponseCode(response_code)
+        storage = self.engine.storage
+        if storage is None:
+            return body
+        connection_lost = []
+        request.notifyFinish().addErrback(connection_lost.append)
+        def synced(result):
+            if not connection_lost:
+                request.write(body)
+                request.finish()
+        def failed(failure):
+            if not connection_lost:
+                request.setResponseCode(500)
+                request.finish()
+        storage.when_synced().addCallbacks(synced, failed)
+        return server.NOT_DONE_YET
+
     def _clear(self):
         # Allow to fully clear the data structure.
         # For use in unit testing.
-        self.topics.clear()
+        self.engine._clear()
+
+class LongPoll(object):
+    """A GET that found no messages, parked until a message is
+        published to the topics it is for or "wait" seconds have
+        passed. The arguments are as for a TopicWatch (see
+        frontend.py), with "fetch" returning the response body."""
+
+    def __init__(self, engine, request, topics, is_subscribed, fetch, wait):
+        self.request = request
+        self.topic_watch = TopicWatch(engine, topics, is_subscribed, fetch, self.finish)
+        self.timeout = reactor.callLater(wait, self.finish, 204, None)
+        self.topic_watch.watch()
+        request.notifyFinish().addErrback(self.on_connection_lost)
+
+    def finish(self, response_code, body):
+        if self.timeout.active():
+            self.timeout.cancel()
+        self.topic_watch.unwatch()
+        self.request.setResponseCode(response_code)
+        if body is not None:
+            self.request.write(body)
+        self.request.finish()
+
+    def on_connection_lost(self, failure):
+        if self.timeout.active():
+            self.timeout.cancel()
+        self.topic_watch.unwatch()
+
+class EventStream(object):
+    """A GET that stays open, pushing each of the user's messages
+        to them as a Server-Sent Event as soon as it is published.
+        The stream ends when the user unsubscribes."""
+
+    def __init__(self, engine, request, topic, username):
+        stream = TopicStream(engine, topic, username, request.write, request.finish)
+        request.setResponseCode(200)
+        request.setHeader("Content-Type", "text/event-stream")
+        request.setHeader("Cache-Control", "no-cache")
+        request.notifyFinish().addBoth(lambda result: stream.stop())
+        # Start the response with a comment, so that the client
+        # sees the stream open even if no messages are waiting.
+        request.write(":\n\n")
+        stream.on_topic_changed()
 
 def main():
     # Simple main method to allow the server to run, binding
@@ -165,10 +490,139 @@ def main():
     parser.add_argument("--max_messages", metavar="MAX_MESSAGES",type=int,default=500,
 	    help="Maximum number of messages allowed to build up in a topic before we "
 	         "begin to clear out oldest messages.")
+    parser.add_argument("--max_topic_bytes", metavar="MAX_TOPIC_BYTES", type=int, default=None,
+            help="Maximum total size of the messages held by one topic. Unlimited by default.")
+    parser.add_argument("--max_total_bytes", metavar="MAX_TOTAL_BYTES", type=int, default=None,
+            help="Maximum total size of the messages held by all topics together. "
+                 "Unlimited by default. With --workers, this applies to each worker.")
+    parser.add_argument("--overflow", choices=OVERFLOW_POLICIES, default=DROP_OLDEST,
+            help="What to do when a publish would break a limit: drop the topic's oldest "
+                 "messages, reject the publish (with a 429 if the topic is full, or a 503 "
+                 "if the server is), or spill the oldest messages to disk. Spilled messages "
+                 "are read back as they are fetched. --max_messages always drops the oldest "
+                 "messages, unless publishes are being rejected.")
+    parser.add_argument("--spill_dir", metavar="SPILL_DIR", default=None,
+            help="Directory for the files holding spilled messages. Defaults to the "
+                 "system's temporary directory.")
+    parser.add_argument("--topic_ttl", metavar="TOPIC=SECONDS", action="append", default=[],
+            help="Expire messages published to a topic after this many seconds, if they "
+                 "haven't been received by then. The topic may be a wildcard pattern. "
+                 "Can be given more than once; where several match, the shortest applies.")
+    parser.add_argument("--compress_min_bytes", metavar="COMPRESS_MIN_BYTES", type=int, default=None,
+            help="Compress messages of at least this many bytes once, as they are published, "
+                 "and send them compressed to clients whose Accept-Encoding allows gzip or "
+                 "deflate. Off by default.")
+    parser.add_argument("--data_dir", metavar="DATA_DIR", default=None,
+            help="Keep topics, subscriptions and messages in this directory, so that "
+                 "they survive a restart. By default everything is kept in memory.")
+    parser.add_argument("--snapshot", metavar="SNAPSHOT_FILE", default=None,
+            help="Write a snapshot of every topic held in memory to this file whenever the "
+                 "server is sent SIGUSR1, and every --snapshot_interval seconds. Snapshots "
+                 "are written by a forked child, so the server isn't held up. With --workers, "
+                 "each worker writes its own file, named for its index.")
+    parser.add_argument("--snapshot_interval", metavar="SECONDS", type=float, default=None,
+            help="Write a snapshot this often. By default, only on SIGUSR1.")
+    parser.add_argument("--restore", action="store_true",
+            help="Restore the topics in the --snapshot file, if there is one, on startup.")
+    parser.add_argument("--segment_bytes", metavar="SEGMENT_BYTES", type=int, default=64 * 1024 * 1024,
+            help="Size at which a topic's current segment file is closed and a new one started.")
+    parser.add_argument("--metrics_max_topics", metavar="METRICS_MAX_TOPICS", type=int, default=100,
+            help="Number of topics to report metrics for individually on /_metrics. "
+                 "Metrics for any further topics are reported together.")
+    parser.add_argument("--workers", metavar="WORKERS", type=int, default=1,
+            help="Number of worker processes to run. Each topic is owned by one worker, "
+                 "and requests reaching the wrong worker are forwarded to its owner.")
+    parser.add_argument("--socket_dir", metavar="SOCKET_DIR", default=None,
+            help="Directory holding the UNIX sockets that workers use to forward requests "
+                 "to each other. Defaults to a directory under /tmp named for the port.")
+    parser.add_argument("--frontend", choices=["twisted", "asyncore"], default="twisted",
+            help="The HTTP server to run. The asyncore front end keeps everything in "
+                 "memory, and can't be used with --data_dir or --workers.")
+    parser.add_argument("--binary_port", metavar="BINARY_PORT", type=int, default=None,
+            help="Also listen on this port for the binary protocol (see binaryprotocol.py). "
+                 "Not available with --workers or the asyncore front end.")
+    # Set on each worker process started by "--workers".
+    parser.add_argument("--worker_index", type=int, default=None, help=argparse.SUPPRESS)
     args = parser.parse_args()
-    site = server.Site(PublishSubscribeServer(args.max_messages))
-    reactor.listenTCP(args.port_number, site)
-    print "Starting server. Listening on %d...." % args.port_number
+    topic_ttls = {}
+    for rule in args.topic_ttl:
+        topic, _, seconds = rule.rpartition("=")
+        try:
+            topic_ttls[topic] = float(seconds)
+        except ValueError:
+            parser.error("--topic_ttl should be given as TOPIC=SECONDS")
+        if not topic or topic_ttls[topic] <= 0:
+            parser.error("--topic_ttl should be given as TOPIC=SECONDS")
+    if args.compress_min_bytes is not None and args.compress_min_bytes < 1:
+        parser.error("--compress_min_bytes should be positive")
+    if args.snapshot is None and (args.restore or args.snapshot_interval is not None):
+        parser.error("--restore and --snapshot_interval need --snapshot")
+    if args.snapshot is not None and (args.data_dir is not None or args.overflow == SPILL):
+        parser.error("--snapshot can't be used with --data_dir or --overflow spill, which keep messages on disk")
+    if args.snapshot_interval is not None and args.snapshot_interval <= 0:
+        parser.error("--snapshot_interval should be positive")
+    if args.overflow == SPILL and args.data_dir is not None:
+        parser.error("--overflow spill can't be used with --data_dir, which keeps messages on disk already")
+    if args.binary_port is not None and (args.workers > 1 or args.frontend != "twisted"):
+        parser.error("--binary_port needs the twisted front end, without --workers")
+    if args.frontend == "asyncore":
+        if args.data_dir is not None or args.workers > 1:
+            parser.error("--data_dir and --workers need the twisted front end")
+        engine = PublishSubscribeEngine(args.max_messages, None, args.metrics_max_topics, args.max_topic_bytes,
+                args.max_total_bytes, args.overflow, args.spill_dir, topic_ttls, args.compress_min_bytes)
+        if args.restore and os.path.exists(args.snapshot):
+            engine.restore(args.snapshot)
+        print "Starting asyncore server. Listening on %d...." % args.port_number
+        asyncoreserver.serve(engine, args.port_number, snapshot_path=args.snapshot,
+                snapshot_interval=args.snapshot_interval)
+        return
+    if args.workers > 1 and args.worker_index is None:
+        print "Starting %d workers. Listening on %d...." % (args.workers, args.port_number)
+        run_workers(args.workers, sys.argv[1:])
+        return
+    data_dir = args.data_dir
+    if data_dir is not None and args.worker_index is not None:
+        # Each worker keeps the topics it owns separately.
+        data_dir = os.path.join(data_dir, "worker-%d" % args.worker_index)
+    storage = None
+    if data_dir is not None:
+        storage = SegmentStore(data_dir, args.segment_bytes)
+    engine = PublishSubscribeEngine(args.max_messages, storage, args.metrics_max_topics, args.max_topic_bytes,
+            args.max_total_bytes, args.overflow, args.spill_dir, topic_ttls, args.compress_min_bytes)
+    snapshot_path = args.snapshot
+    if snapshot_path is not None:
+        if args.worker_index is not None:
+            snapshot_path = "%s.worker-%d" % (snapshot_path, args.worker_index)
+        if args.restore and os.path.exists(snapshot_path):
+            engine.restore(snapshot_path)
+        # The snapshot is started from the reactor, not in the
+        # middle of whatever the signal interrupted.
+        signal.signal(signal.SIGUSR1, lambda signum, frame: reactor.callFromThread(engine.snapshot, snapshot_path))
+        if args.snapshot_interval is not None:
+            task.LoopingCall(engine.snapshot, snapshot_path).start(args.snapshot_interval, now=False)
+    publisher = PublishSubscribeServer(engine=engine)
+    if args.worker_index is None:
+        reactor.listenTCP(args.port_number, server.Site(publisher))
+        print "Starting server. Listening on %d...." % args.port_number
+        if args.binary_port is not None:
+            reactor.listenTCP(args.binary_port, BinaryProtocolFactory(publisher.engine))
+            print "Listening for the binary protocol on %d...." % args.binary_port
+    else:
+        socket_dir = args.socket_dir or "/tmp/pypublishsubscribe-%d" % args.port_number
+        if not os.path.isdir(socket_dir):
+            try:
+                os.makedirs(socket_dir)
+            except OSError:
+                # Another worker created it first.
+                pass
+        socket_paths = worker_socket_paths(socket_dir, args.workers)
+        # Requests forwarded from other workers are for topics this
+        # worker owns, so they go straight to the publisher.
+        if os.path.exists(socket_paths[args.worker_index]):
+            os.remove(socket_paths[args.worker_index])
+        reactor.listenUNIX(socket_paths[args.worker_index], server.Site(publisher))
+        sharded = ShardedPublishSubscribeServer(publisher, args.worker_index, socket_paths)
+        listen_shared(args.port_number, server.Site(sharded))
     reactor.run()
 
 if __name__ == "__main__":
@@ -0,0 +1,279 @@
+"""Snapshots of the topics held in memory, for a warm restart.
+
+A snapshot holds every topic's messages, subscribers, consumer
+groups and expiry deadlines. It is written by a forked child,
+which sees the topics as they were at the fork, so the front end
+carries on serving requests while it is written. The file is
+written under a temporary name and then renamed, so there is
+always a whole snapshot in place.
+
+A snapshot is restored by mapping the file into memory. Each topic
+records the offset of every message, so restoring reads those
+offsets in one go, and leaves the messages themselves in the file
+until they are fetched: however big the snapshot, restoring only
+does work for each topic and subscriber, not for each message.
+
+The file starts with a header (see HEADER), followed by each topic:
+
+    TOPIC, then the topic's name
+    each subscriber's cursor: CURSOR, then the username
+    each consumer group: GROUP, then its name, each member's name
+        (as a STRING), a COUNT of the messages to be given out
+        again, and for each of those a SEQ and the message (as a
+        STRING)
+    the expiry batches' deadlines, first sequence numbers and
+        sequence numbers after the last, as three arrays
+    the sequence numbers of expired messages, as an array
+    the offsets of the messages, as an array, with one more
+        entry giving the end of the last message
+    the messages
+
+Numbers are little-endian, except for the arrays, which are
+written as they are held in memory. Snapshots can only be
+restored on the kind of machine that wrote them."""
+import os
+import sys
+import mmap
+import heapq
+import struct
+import itertools
+import traceback
+from array import array
+from pypublishsubscribe.topic import Topic, ConsumerGroup, DROP_OLDEST
+
+MAGIC = "PUBSNAP1"
+
+# The magic string, the size of an array item, whether arrays are
+# little-endian, and the number of topics.
+HEADER = struct.Struct("<8sBBI")
+# The length of the topic's name, its first sequence number and the
+# one after its last, its evicted and expired counts, its next
+# delivery id, and the number of cursors, groups, expiry batches and
+# expired messages.
+TOPIC = struct.Struct("<IQQQQQIIII")
+# A cursor's sequence number and the length of its username.
+CURSOR = struct.Struct("<QI")
+# The length of a group's name, and its number of members.
+GROUP = struct.Struct("<II")
+STRING = struct.Struct("<I")
+COUNT = struct.Struct("<I")
+SEQ = struct.Struct("<Q")
+
+def write_snapshot(topics, path):
+    """Write a snapshot of a dict of topics, by name, to "path"."""
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "wb") as snapshot_file:
+        snapshot_file.write(HEADER.pack(MAGIC, array("L").itemsize, sys.byteorder == "little", len(topics)))
+        for name, topic in topics.iteritems():
+            write_topic(snapshot_file, name, topic)
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+    os.rename(temporary_path, path)
+
+def write_topic(snapshot_file, name, topic):
+    write = snapshot_file.write
+    first_seq = topic.first_seq
+    next_seq = topic.next_seq
+    # Taking the next delivery id uses it up, but that doesn't
+    # matter in the child that normally writes the snapshot.
+    write(TOPIC.pack(len(name), first_seq, next_seq, topic.evicted, topic.expired, next(topic.delivery_ids),
+            len(topic.cursors), len(topic.groups), len(topic.expiries), len(topic.expired_seqs)))
+    write(name)
+    for username in topic.cursors:
+        write(CURSOR.pack(topic._cursor(username), len(username)))
+        write(username)
+    for group_name, group in topic.groups.iteritems():
+        write(GROUP.pack(len(group_name), len(group.in_flight)))
+        write(group_name)
+        for member in group.in_flight:
+            write(STRING.pack(len(member)))
+            write(member)
+        # Messages in flight haven't been acknowledged, so they
+        # will be given out again after a restore.
+        redelivery = list(group.redelivery)
+        for in_flight in group.in_flight.itervalues():
+            redelivery.extend(in_flight)
+        write(COUNT.pack(len(redelivery)))
+        for seq, message in redelivery:
+            write(SEQ.pack(seq))
+            write(STRING.pack(len(message)))
+            write(message)
+    write(array("d", [expiry[0] for expiry in topic.expiries]).tostring())
+    write(array("L", [expiry[1] for expiry in topic.expiries]).tostring())
+    write(array("L", [expiry[2] for expiry in topic.expiries]).tostring())
+    write(array("L", topic.expired_seqs).tostring())
+    log = topic.log
+    offsets = array("L", [0])
+    position = 0
+    for seq in xrange(first_seq, next_seq):
+        position += len(log[seq])
+        offsets.append(position)
+    write(offsets.tostring())
+    for seq in xrange(first_seq, next_seq):
+        write(log[seq])
+
+class SnapshotReader(object):
+    """Reads the parts of a snapshot in turn."""
+
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def unpack(self, layout):
+        values = layout.unpack_from(self.data, self.position)
+        self.position += layout.size
+        return values
+
+    def string(self, length=None):
+        if length is None:
+            length, = self.unpack(STRING)
+        self.position += length
+        return self.data[self.position - length:self.position]
+
+    def array(self, typecode, count):
+        values = array(typecode)
+        values.fromstring(self.string(count * values.itemsize))
+        return values
+
+def read_snapshot(path, max_messages=500, max_bytes=None, overflow=DROP_OLDEST, budget=None):
+    """Restore the topics in a snapshot, returning a dict of them by
+        name. The topics are given the limits passed in, and any
+        messages beyond them are dropped. Raises ValueError if the
+        file isn't a snapshot that can be restored here."""
+    with open(path, "rb") as snapshot_file:
+        data = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+    reader = SnapshotReader(data)
+    if len(data) < HEADER.size:
+        raise ValueError("%s is not a snapshot" % path)
+    magic, item_size, little_endian, topic_count = reader.unpack(HEADER)
+    if magic != MAGIC:
+        raise ValueError("%s is not a snapshot" % path)
+    if item_size != array("L").itemsize or bool(little_endian) != (sys.byteorder == "little"):
+        raise ValueError("%s was written on a different kind of machine" % path)
+    topics = {}
+    for index in xrange(topic_count):
+        name, topic = read_topic(reader, max_messages, max_bytes, overflow, budget)
+        topics[name] = topic
+    return topics
+
+def read_topic(reader, max_messages, max_bytes, overflow, budget):
+    (name_length, first_seq, next_seq, evicted, expired, delivery_id,
+            cursor_count, group_count, expiry_count, expired_count) = reader.unpack(TOPIC)
+    name = reader.string(name_length)
+    topic = RestoredTopic(max_messages, max_bytes, overflow, budget)
+    topic.first_seq = first_seq
+    topic.next_seq = next_seq
+    topic.evicted = evicted
+    topic.expired = expired
+    topic.delivery_ids = itertools.count(delivery_id)
+    for index in xrange(cursor_count):
+        seq, username_length = reader.unpack(CURSOR)
+        topic.cursors[reader.string(username_length)] = seq
+        topic._add_to_count(seq)
+    for index in xrange(group_count):
+        group_name_length, member_count = reader.unpack(GROUP)
+        group = topic.groups[reader.string(group_name_length)] = ConsumerGroup()
+        for member_index in xrange(member_count):
+            group.in_flight[reader.string()] = []
+        count, = reader.unpack(COUNT)
+        for message_index in xrange(count):
+            seq, = reader.unpack(SEQ)
+            group.redelivery.append((seq, reader.string()))
+    deadlines = reader.array("d", expiry_count)
+    starts = reader.array("L", expiry_count)
+    stops = reader.array("L", expiry_count)
+    topic.expiries = zip(deadlines, starts, stops)
+    heapq.heapify(topic.expiries)
+    topic.expired_seqs = set(reader.array("L", expired_count))
+    offsets = reader.array("L", next_seq - first_seq + 1)
+    topic.log = SnapshotLog(reader.data, reader.position, offsets, first_seq)
+    reader.position += offsets[-1]
+    # Expired messages were written as empty strings, so this is the
+    # size of the messages still to be delivered.
+    topic._add_bytes(offsets[-1])
+    topic._trim()
+    topic._make_room()
+    return name, topic
+
+class SnapshotLog(object):
+    """A restored topic's message log. The messages restored from a
+        snapshot stay in the mapped file, from "start" on, and are
+        only copied out of it as they are read. Messages published
+        since, and restored messages that have expired since, are
+        held in the "memory" dict. It is used as a Topic's "log"
+        (see Topic)."""
+
+    def __init__(self, data, start, offsets, first_seq):
+        self.data = data
+        self.start = start
+        self.offsets = offsets
+        # The restored messages run from "base" up to "end".
+        self.base = first_seq
+        self.end = first_seq + len(offsets) - 1
+        self.memory = {}
+
+    def __setitem__(self, seq, message):
+        self.memory[seq] = message
+
+    def __getitem__(self, seq):
+        if self.base <= seq < self.end and seq not in self.memory:
+            index = seq - self.base
+            return self.data[self.start + self.offsets[index]:self.start + self.offsets[index + 1]]
+        return self.memory[seq]
+
+    def __delitem__(self, seq):
+        # Messages are only ever removed from the start of the log,
+        # so nothing needs doing for a restored one.
+        self.memory.pop(seq, None)
+
+    def clear(self):
+        self.memory.clear()
+        # Let go of the file, once every topic restored from it has.
+        self.base = self.end = 0
+        self.data = None
+        self.offsets = array("L", [0])
+
+    def is_restored(self, seq):
+        return self.base <= seq < self.end and seq not in self.memory
+
+    def size(self, seq):
+        index = seq - self.base
+        return self.offsets[index + 1] - self.offsets[index]
+
+class RestoredTopic(Topic):
+    """A Topic restored from a snapshot. Its messages are read from
+        the snapshot as they are fetched (see SnapshotLog), but count
+        against its limits just as if they were held in memory."""
+
+    def _size(self, seq):
+        if self.log.is_restored(seq):
+            return self.log.size(seq)
+        return len(self.log[seq])
+
+class SnapshotWriter(object):
+    """Writes a snapshot of a dict of topics, by name, to "path" from
+        a forked child. The topics can be changed straight away: the
+        child has its own copy of them, as they were at the fork."""
+
+    def __init__(self, topics, path):
+        self.path = path
+        self.pid = os.fork()
+        if self.pid == 0:
+            status = 1
+            try:
+                write_snapshot(topics, path)
+                status = 0
+            except Exception:
+                traceback.print_exc()
+            finally:
+                # Leave without running anything the parent set up
+                # to be run at exit.
+                os._exit(status)
+
+    def poll(self):
+        """Return None while the snapshot is being written, and
+            afterwards True if it was written, or False if not."""
+        pid, status = os.waitpid(self.pid, os.WNOHANG)
+        if pid == 0:
+            return None
+        return status == 0
@@ -0,0 +1,174 @@
+import tempfile
+from array import array
+from pypublishsubscribe.topic import Topic, SPILL
+
+# Once this many bytes at the start of an overflow file belong to
+# messages that have gone, the file is rewritten without them.
+COMPACT_BYTES = 1024 * 1024
+
+class OverflowFile(object):
+    """A temporary file holding a run of consecutive messages, the
+        first of which has the sequence number "base". Messages are
+        added at the end and removed from the start."""
+
+    def __init__(self, directory, base):
+        self.directory = directory
+        self.base = base
+        self.file = tempfile.TemporaryFile(prefix="pubsub-overflow-", dir=directory)
+        # The offset of each message in the file, indexed by
+        # (sequence number - base), and the offset the next will
+        # be written at.
+        self.offsets = array("L")
+        self.size = 0
+        self.dirty = False
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def clear(self, base):
+        self.offsets = array("L")
+        self.file.truncate(0)
+        self.size = 0
+        self.base = base
+
+    def append(self, message):
+        self.file.seek(self.size)
+        self.file.write(message)
+        self.offsets.append(self.size)
+        self.size += len(message)
+        self.dirty = True
+
+    def read(self, seq):
+        index = seq - self.base
+        start = self.offsets[index]
+        end = self.offsets[index + 1] if index + 1 < len(self.offsets) else self.size
+        if self.dirty:
+            self.file.flush()
+            self.dirty = False
+        self.file.seek(start)
+        return self.file.read(end - start)
+
+    def remove_first(self):
+        del self.offsets[0]
+        self.base += 1
+        if not self.offsets:
+            # Empty again, so the file can start from scratch.
+            self.file.truncate(0)
+            self.size = 0
+        elif self.offsets[0] >= COMPACT_BYTES and self.offsets[0] * 2 >= self.size:
+            self.compact()
+
+    def compact(self):
+        # Copy what is left to a new file. This happens at most
+        # once for each time the live messages' size is consumed,
+        # so the copying is constant time per message on average.
+        start = self.offsets[0]
+        replacement = tempfile.TemporaryFile(prefix="pubsub-overflow-", dir=self.directory)
+        self.file.flush()
+        self.file.seek(start)
+        while True:
+            data = self.file.read(65536)
+            if not data:
+                break
+            replacement.write(data)
+        self.file.close()
+        self.file = replacement
+        self.offsets = array("L", (offset - start for offset in self.offsets))
+        self.size -= start
+        self.dirty = True
+
+    def close(self):
+        # The file is deleted as it is closed.
+        self.file.close()
+
+class OverflowLog(object):
+    """A topic's message log, with its oldest messages kept in an
+        overflow file rather than in memory. It is used as a Topic's
+        "log" (see Topic), so spilled messages are read back without
+        the topic having to know where they are."""
+
+    # Messages from "overflow.base" up to "memory_start" are in the
+    # file, and from there on in the "memory" dict.
+    def __init__(self, directory, first_seq=0):
+        self.overflow = OverflowFile(directory, first_seq)
+        self.memory = {}
+        self.memory_start = first_seq
+
+    def __setitem__(self, seq, message):
+        if self.memory_start is None:
+            # The log was cleared, so this is its first message.
+            self.memory_start = seq
+            self.overflow.clear(seq)
+        self.memory[seq] = message
+
+    def __getitem__(self, seq):
+        if seq < self.memory_start:
+            return self.overflow.read(seq)
+        return self.memory[seq]
+
+    def __delitem__(self, seq):
+        # Messages are only ever removed from the start of the log.
+        if seq < self.memory_start:
+            self.overflow.remove_first()
+        else:
+            del self.memory[seq]
+            self.memory_start = seq + 1
+            self.overflow.base = self.memory_start
+
+    def clear(self):
+        # The next message appended sets where the log starts.
+        self.memory.clear()
+        self.memory_start = None
+
+    def is_spilled(self, seq):
+        return seq < self.memory_start
+
+    def spill_oldest(self):
+        """Move the oldest message held in memory to the overflow
+            file, returning its size, or None if there are none."""
+        message = self.memory.pop(self.memory_start, None)
+        if message is None:
+            return None
+        self.overflow.append(message)
+        self.memory_start += 1
+        return len(message)
+
+    def close(self):
+        self.overflow.close()
+
+class SpillingTopic(Topic):
+    """A Topic under the SPILL policy. Rather than dropping messages
+        to stay within its byte limits, it moves its oldest messages
+        into an overflow file in "directory" (by default, the system's
+        temporary directory), and reads them back from there when
+        they are fetched. The count limit still applies, to the
+        messages in memory and on disk together."""
+
+    def __init__(self, max_messages=500, max_bytes=None, budget=None, directory=None):
+        Topic.__init__(self, max_messages, max_bytes, SPILL, budget)
+        self.log = OverflowLog(directory)
+        # The number of messages moved out of memory.
+        self.spilled = 0
+
+    def _size(self, seq):
+        # Spilled messages take no memory.
+        if self.log.is_spilled(seq):
+            return 0
+        return len(self.log[seq])
+
+    def _discard(self, seq):
+        if not self.log.is_spilled(seq):
+            self.log.memory[seq] = ""
+
+    def _make_room(self):
+        Topic._make_room(self)
+        while self._over_bytes():
+            size = self.log.spill_oldest()
+            if size is None:
+                # Nothing of this topic's is left in memory.
+                break
+            self._add_bytes(-size)
+            self.spilled += 1
+
+    def close(self):
+        self.log.close()
@@ -0,0 +1,557 @@
+import os
+import mmap
+import shutil
+import struct
+import zlib
+import binascii
+from array import array
+from bisect import bisect_right
+from twisted.internet import reactor, threads, defer
+from pypublishsubscribe.topic import Topic, ConsumerGroup, DROP_OLDEST, GROUP_CURSOR_PREFIX
+
+# Each message is stored in a segment file as a record made up
+# of a fixed-size header followed by the message itself. The
+# header holds a CRC32 of the sequence number, length and message
+# (so that a record left half-written by a crash can be detected),
+# the message's sequence number, and its length in bytes.
+RECORD_HEADER = struct.Struct(">IQI")
+SEQUENCE_AND_LENGTH = struct.Struct(">QI")
+
+# Each change to a topic's subscriptions is stored in its journal
+# as an operation code, the length of the username, the username
+# itself, and the subscriber's new cursor. A member joining or
+# leaving a consumer group is stored in the same way, with the
+# group and member names, joined by MEMBER_SEPARATOR, in place of
+# the username, and a cursor of 0.
+JOURNAL_HEADER = struct.Struct(">BH")
+JOURNAL_CURSOR = struct.Struct(">Q")
+CURSOR_MOVED = 1
+UNSUBSCRIBED = 2
+MEMBER_JOINED = 3
+MEMBER_LEFT = 4
+MEMBER_SEPARATOR = "\0"
+
+SEGMENT_SUFFIX = ".seg"
+JOURNAL_NAME = "subscriptions.journal"
+
+class Segment(object):
+    """A single append-only file of message records, the first
+        of which has the sequence number "base"."""
+
+    def __init__(self, path, base):
+        self.path = path
+        self.base = base
+        # The offset of each record in the file, indexed
+        # by (sequence number - base).
+        self.offsets = array("L")
+        self.size = 0
+        self.file = None
+        self.map = None
+        # Messages written since the file was last flushed, so
+        # that they can be read back without remapping the file.
+        self.unflushed = {}
+
+    def open_for_append(self):
+        self.file = open(self.path, "ab")
+
+    def append(self, seq, message):
+        """Write a record to the end of the file. It is only
+            buffered until the next call to flush()."""
+        sequence_and_length = SEQUENCE_AND_LENGTH.pack(seq, len(message))
+        crc = zlib.crc32(message, zlib.crc32(sequence_and_length)) & 0xffffffff
+        self.file.write(struct.pack(">I", crc))
+        self.file.write(sequence_and_length)
+        self.file.write(message)
+        self.offsets.append(self.size)
+        self.size += RECORD_HEADER.size + len(message)
+        self.unflushed[seq] = message
+
+    def read(self, seq):
+        """Read the message with this sequence number, straight
+            out of the memory-mapped file.
+
+            The message is copied out of the map into a str, once.
+            It isn't returned as a buffer over the map: messages are
+            compared, framed and joined as strs throughout, Twisted's
+            transport joins whatever it is given into one str before
+            sending it, and a buffer would stop working as soon as
+            "remap" or "close" closed the map under it."""
+        if seq in self.unflushed:
+            return self.unflushed[seq]
+        offset = self.offsets[seq - self.base]
+        if self.map is None or offset + RECORD_HEADER.size > len(self.map):
+            self.remap()
+        length = RECORD_HEADER.unpack_from(self.map, offset)[2]
+        start = offset + RECORD_HEADER.size
+        if start + length > len(self.map):
+            self.remap()
+        return self.map[start:start + length]
+
+    def length(self, seq):
+        """The length of the message with this sequence number,
+            found without reading it."""
+        index = seq - self.base
+        end = self.offsets[index + 1] if index + 1 < len(self.offsets) else self.size
+        return end - self.offsets[index] - RECORD_HEADER.size
+
+    def flush(self):
+        self.file.flush()
+        self.unflushed = {}
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def remap(self):
+        # The file has grown since it was last mapped, so map it again.
+        if self.map is not None:
+            self.map.close()
+        with open(self.path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def recover(self):
+        """Scan the file, rebuilding the offset index. A record at
+            the end of the file that is incomplete or fails its CRC
+            check was being written during a crash, so it and
+            anything after it is truncated away."""
+        size = os.path.getsize(self.path)
+        offset = 0
+        if size:
+            with open(self.path, "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            seq = self.base
+            while offset + RECORD_HEADER.size <= size:
+                crc, record_seq, length = RECORD_HEADER.unpack_from(data, offset)
+                start = offset + RECORD_HEADER.size
+                if record_seq != seq or start + length > size or \
+                        zlib.crc32(data[start:start + length], zlib.crc32(data[offset + 4:start])) & 0xffffffff != crc:
+                    break
+                self.offsets.append(offset)
+                offset = start + length
+                seq += 1
+            data.close()
+        if offset != size:
+            with open(self.path, "r+b") as f:
+                f.truncate(offset)
+        self.size = offset
+
+    @property
+    def next_seq(self):
+        return self.base + len(self.offsets)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.unflushed = {}
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    def delete(self):
+        self.close()
+        os.remove(self.path)
+
+class SegmentLog(object):
+    """A topic's message log, stored in a series of segment files
+        rather than in memory. It is used as a Topic's "log" (see
+        Topic)."""
+
+    def __init__(self, store, directory, segments):
+        self.store = store
+        self.directory = directory
+        self.segments = segments
+        self.bases = [segment.base for segment in segments]
+        if segments:
+            segments[-1].open_for_append()
+
+    def __setitem__(self, seq, message):
+        if not self.segments or self.segments[-1].size >= self.store.segment_bytes:
+            self.roll(seq)
+        active = self.segments[-1]
+        active.append(seq, message)
+        self.store.mark_dirty(active)
+
+    def __getitem__(self, seq):
+        return self.segments[bisect_right(self.bases, seq) - 1].read(seq)
+
+    def size(self, seq):
+        return self.segments[bisect_right(self.bases, seq) - 1].length(seq)
+
+    def __delitem__(self, seq):
+        # Messages are only ever removed from the start of the log,
+        # so once the last message of the oldest segment goes the
+        # whole file can be deleted.
+        oldest = self.segments[0]
+        if seq == oldest.next_seq - 1 and oldest.file is None:
+            oldest.delete()
+            del self.segments[0]
+            del self.bases[0]
+
+    def clear(self):
+        """Delete every segment. The next message appended
+            starts a new one."""
+        for segment in self.segments:
+            if segment.file is not None:
+                self.store.forget(segment)
+            segment.delete()
+        self.segments = []
+        self.bases = []
+
+    def roll(self, seq):
+        """Close the active segment and start a new one."""
+        if self.segments:
+            self.store.forget(self.segments[-1])
+            self.segments[-1].close()
+        segment = Segment(os.path.join(self.directory, "%020d%s" % (seq, SEGMENT_SUFFIX)), seq)
+        segment.open_for_append()
+        self.segments.append(segment)
+        self.bases.append(seq)
+
+    def close(self):
+        for segment in self.segments:
+            if segment.file is not None:
+                self.store.forget(segment)
+            segment.close()
+
+class Journal(object):
+    """An append-only record of a topic's subscribers and their
+        cursors, replayed on startup to recover them."""
+
+    def __init__(self, store, path):
+        self.store = store
+        self.path = path
+        self.file = open(path, "ab")
+        self.size = os.path.getsize(path)
+
+    def record(self, op, username, cursor=0):
+        record = JOURNAL_HEADER.pack(op, len(username)) + username + JOURNAL_CURSOR.pack(cursor)
+        self.file.write(record)
+        self.size += len(record)
+        self.store.mark_dirty(self)
+
+    @staticmethod
+    def replay(path):
+        """Read a journal, returning a dict of each current
+            subscriber's cursor, and a dict of the members of each
+            consumer group, as lists. A record left incomplete by a
+            crash is ignored."""
+        cursors = {}
+        members = {}
+        if not os.path.exists(path):
+            return cursors, members
+        with open(path, "rb") as f:
+            data = f.read()
+        offset = 0
+        while offset + JOURNAL_HEADER.size <= len(data):
+            op, name_length = JOURNAL_HEADER.unpack_from(data, offset)
+            start = offset + JOURNAL_HEADER.size
+            end = start + name_length + JOURNAL_CURSOR.size
+            if end > len(data):
+                break
+            username = data[start:start + name_length]
+            if op == CURSOR_MOVED:
+                cursors[username] = JOURNAL_CURSOR.unpack_from(data, start + name_length)[0]
+            elif op == UNSUBSCRIBED:
+                cursors.pop(username, None)
+            else:
+                group, member = username.split(MEMBER_SEPARATOR, 1)
+                group_members = members.setdefault(group, [])
+                if member in group_members:
+                    group_members.remove(member)
+                if op == MEMBER_JOINED:
+                    group_members.append(member)
+                elif not group_members:
+                    del members[group]
+            offset = end
+        return cursors, members
+
+    def compact(self, cursors, members):
+        """Rewrite the journal so that it holds just one record
+            for each current subscriber and group member."""
+        self.store.forget(self)
+        self.file.close()
+        write_journal(self.path, cursors, members)
+        self.file = open(self.path, "ab")
+        self.size = os.path.getsize(self.path)
+
+    def flush(self):
+        self.file.flush()
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.store.forget(self)
+        self.file.close()
+
+def write_journal(path, cursors, members):
+    # Write to a temporary file and rename it into place, so that
+    # a crash part way through leaves the old journal intact.
+    # "members" maps each consumer group to its members' names.
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        for username, cursor in cursors.iteritems():
+            f.write(JOURNAL_HEADER.pack(CURSOR_MOVED, len(username)) + username +
+                    JOURNAL_CURSOR.pack(cursor))
+        for group, group_members in members.iteritems():
+            for member in group_members:
+                name = group + MEMBER_SEPARATOR + member
+                f.write(JOURNAL_HEADER.pack(MEMBER_JOINED, len(name)) + name + JOURNAL_CURSOR.pack(0))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(temp_path, path)
+
+class DurableTopic(Topic):
+    """A Topic whose messages are kept in segment files, and whose
+        subscribers and cursors are recorded in a journal, so that
+        it can be recovered after a restart."""
+
+    def __init__(self, max_messages, store, directory, segments=(), max_bytes=None, overflow=DROP_OLDEST,
+            budget=None):
+        Topic.__init__(self, max_messages, max_bytes, overflow, budget)
+        self.directory = directory
+        self.log = SegmentLog(store, directory, list(segments))
+        self.journal = Journal(store, os.path.join(directory, JOURNAL_NAME))
+
+    def subscribe(self, username):
+        if username not in self.cursors:
+            Topic.subscribe(self, username)
+            self.journal.record(CURSOR_MOVED, username, self.next_seq)
+
+    def unsubscribe(self, username):
+        Topic.unsubscribe(self, username)
+        self.journal.record(UNSUBSCRIBED, username)
+        self.maybe_compact_journal()
+
+    def _move_cursor(self, username, old, new):
+        Topic._move_cursor(self, username, old, new)
+        self.journal.record(CURSOR_MOVED, username, new)
+        self.maybe_compact_journal()
+
+    def join_group(self, group, member):
+        if not self.is_group_member(group, member):
+            Topic.join_group(self, group, member)
+            self.journal.record(MEMBER_JOINED, group + MEMBER_SEPARATOR + member)
+
+    def leave_group(self, group, member):
+        # Recorded first, so that when the last member leaves, the
+        # group's cursor is removed after its members on replay.
+        self.journal.record(MEMBER_LEFT, group + MEMBER_SEPARATOR + member)
+        Topic.leave_group(self, group, member)
+        self.maybe_compact_journal()
+
+    def _size(self, seq):
+        # Work the size out from the segment's index, rather than
+        # reading the message back just to find its length.
+        return self.log.size(seq)
+
+    def _discard(self, seq):
+        # Expired messages are left in their segment, which is
+        # deleted once every message in it has gone.
+        pass
+
+    def maybe_compact_journal(self):
+        # Every fetch adds a record to the journal, so once it is
+        # much larger than its live contents, rewrite it.
+        live_size = (len(self.cursors) + sum(len(group.in_flight) for group in self.groups.itervalues())) * 64
+        if self.journal.size > max(self.journal.store.journal_bytes, 4 * live_size):
+            self.journal.compact(self.cursors, self.group_members())
+
+    def group_members(self):
+        return dict((name, list(group.in_flight)) for name, group in self.groups.iteritems())
+
+    def close(self):
+        self.log.close()
+        self.journal.close()
+
+class SegmentStore(object):
+    """Durable storage for all topics, kept under one directory.
+        Each topic has its own subdirectory holding its segment
+        files and journal."""
+
+    # Writes are not made durable one at a time. Instead every
+    # write made during one pass of the reactor is flushed, and
+    # then a single fsync of each file written to is made in a
+    # thread (a "group commit"). Anything waiting on when_synced()
+    # is told once the fsync that covers its writes completes.
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024, journal_bytes=4 * 1024 * 1024):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.journal_bytes = journal_bytes
+        self.dirty = set()
+        self.sync_waiters = []
+        self.started = False
+        self.commit_scheduled = False
+        self.commit_in_progress = False
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def start(self):
+        """Start committing writes from the reactor."""
+        self.started = True
+        if self.dirty or self.sync_waiters:
+            self.schedule_commit()
+
+    def topic_directory(self, name):
+        # Topic names can hold any character, so hex-encode them
+        # to get a safe directory name.
+        return os.path.join(self.directory, binascii.hexlify(name))
+
+    def create_topic(self, name, max_messages, max_bytes=None, overflow=DROP_OLDEST, budget=None):
+        directory = self.topic_directory(name)
+        if os.path.isdir(directory):
+            # Left behind by a topic that was being deleted.
+            shutil.rmtree(directory)
+        os.makedirs(directory)
+        return DurableTopic(max_messages, self, directory, (), max_bytes, overflow, budget)
+
+    def delete_topic(self, topic):
+        topic.close()
+        shutil.rmtree(topic.directory)
+
+    def recover(self, max_messages, max_bytes=None, overflow=DROP_OLDEST, budget=None):
+        """Load every topic from disk, returning a dict of
+            topic name to DurableTopic. The limits are as for
+            create_topic, and are applied to what is recovered."""
+        topics = {}
+        for entry in sorted(os.listdir(self.directory)):
+            directory = os.path.join(self.directory, entry)
+            if not os.path.isdir(directory):
+                continue
+            topic = self.recover_topic(directory, max_messages, max_bytes, overflow, budget)
+            if topic is None:
+                shutil.rmtree(directory)
+            else:
+                topics[binascii.unhexlify(entry)] = topic
+        return topics
+
+    def recover_topic(self, directory, max_messages, max_bytes, overflow, budget):
+        journal_path = os.path.join(directory, JOURNAL_NAME)
+        cursors, members = Journal.replay(journal_path)
+        # A group's cursor is only of use with members to read from
+        # it. Without any, it would hold on to the topic's messages
+        # until someone joined again, so it goes.
+        for username in list(cursors):
+            if username.startswith(GROUP_CURSOR_PREFIX) and username[len(GROUP_CURSOR_PREFIX):] not in members:
+                del cursors[username]
+        for group in list(members):
+            if GROUP_CURSOR_PREFIX + group not in cursors:
+                del members[group]
+        if not cursors:
+            # Everyone had unsubscribed, so the topic was deleted.
+            return None
+        segments = []
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(SEGMENT_SUFFIX):
+                segment = Segment(os.path.join(directory, name), int(name[:-len(SEGMENT_SUFFIX)]))
+                if segments and segment.base != segments[-1].next_seq:
+                    # A gap means the end of an earlier segment was
+                    # lost in a crash, so only the segments after it
+                    # can be used.
+                    for old in segments:
+                        os.remove(old.path)
+                    segments = []
+                segment.recover()
+                segments.append(segment)
+        if segments:
+            first_seq = segments[0].base
+            next_seq = segments[-1].next_seq
+        else:
+            first_seq = next_seq = max(cursors.itervalues())
+        # If the end of the log was lost, any cursors beyond it
+        # are moved back to the new end of the log.
+        for username, cursor in cursors.iteritems():
+            cursors[username] = min(cursor, next_seq)
+        write_journal(journal_path, cursors, members)
+        topic = DurableTopic(max_messages, self, directory, segments, max_bytes, overflow, budget)
+        topic.first_seq = first_seq
+        topic.next_seq = next_seq
+        topic._add_bytes(sum(topic._size(seq) for seq in xrange(first_seq, next_seq)))
+        for username, cursor in cursors.iteritems():
+            topic.cursors[username] = cursor
+            topic._add_to_count(max(cursor, first_seq))
+        # Messages the members had been given, but hadn't
+        # acknowledged, aren't kept, so aren't given out again.
+        for group, group_members in members.iteritems():
+            consumer_group = topic.groups[group] = ConsumerGroup()
+            for member in group_members:
+                consumer_group.in_flight[member] = []
+        # Remove anything every subscriber had already received,
+        # and then anything beyond the topic's limits.
+        topic._trim()
+        topic._make_room()
+        return topic
+
+    def mark_dirty(self, writer):
+        """Note that a segment or journal has been written to, and
+            so needs to be flushed and synced at the next commit."""
+        self.dirty.add(writer)
+        if self.started and not self.commit_scheduled:
+            self.schedule_commit()
+
+    def forget(self, writer):
+        # A file about to be closed must be synced here, as it
+        # won't be part of the next commit.
+        if writer in self.dirty:
+            self.dirty.discard(writer)
+            writer.flush()
+            os.fsync(writer.fileno())
+
+    def when_synced(self):
+        """Return a Deferred that fires once every write made
+            so far is safely on disk."""
+        d = defer.Deferred()
+        self.sync_waiters.append(d)
+        if self.started and not self.commit_scheduled:
+            self.schedule_commit()
+        return d
+
+    def schedule_commit(self):
+        self.commit_scheduled = True
+        reactor.callLater(0, self.commit)
+
+    def commit(self):
+        self.commit_scheduled = False
+        if self.commit_in_progress:
+            # This will run again once the current commit finishes.
+            return
+        waiters = self.sync_waiters
+        self.sync_waiters = []
+        # Flush from the reactor thread, but sync duplicates of the
+        # file descriptors, as the files may be closed before the
+        # sync completes.
+        descriptors = []
+        for writer in self.dirty:
+            writer.flush()
+            descriptors.append(os.dup(writer.fileno()))
+        self.dirty = set()
+        self.commit_in_progress = True
+        def committed(result):
+            for waiter in waiters:
+                waiter.callback(None)
+        def failed(failure):
+            for waiter in waiters:
+                waiter.errback(failure)
+        def finished(result):
+            self.commit_in_progress = False
+            if (self.sync_waiters or self.dirty) and not self.commit_scheduled:
+                self.schedule_commit()
+        d = threads.deferToThread(sync_descriptors, descriptors)
+        d.addCallbacks(committed, failed)
+        d.addBoth(finished)
+
+    def sync_now(self):
+        """Flush and sync every outstanding write, blocking
+            until it is done."""
+        for writer in self.dirty:
+            writer.flush()
+            os.fsync(writer.fileno())
+        self.dirty = set()
+
+def sync_descriptors(descriptors):
+    try:
+        for fd in descriptors:
+            os.fsync(fd)
+    finally:
+        for fd in descriptors:
+            os.close(fd)
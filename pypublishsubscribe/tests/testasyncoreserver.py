@@ -0,0 +1,180 @@
+import os
+import socket
+import unittest
+import requests
+from threading import Thread
+from Queue import Queue
+import time
+from pypublishsubscribe.engine import PublishSubscribeEngine
+from pypublishsubscribe.asyncoreserver import EventLoop, HTTPServer, AsyncoreFrontEnd
+from pypublishsubscribe.framing import decode_frames, encode_frames, FRAMED_CONTENT_TYPE
+
+class AsyncoreServerTest(unittest.TestCase):
+    """Tests for the asyncore front end, which should behave
+       just as the Twisted one does."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.engine = PublishSubscribeEngine()
+        cls.loop = EventLoop()
+        server = HTTPServer(AsyncoreFrontEnd(cls.engine, cls.loop), cls.loop, 0)
+        cls.url = "http://localhost:%d" % server.port_number()
+        cls.thread = Thread(target=cls.loop.run)
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.loop.stop()
+        cls.thread.join()
+
+    def tearDown(self):
+        # The engine isn't thread-safe, so clear it from the
+        # loop's own thread.
+        done = Queue()
+        self.loop.call_later(0, lambda: done.put(self.engine._clear()))
+        done.get(timeout=5)
+
+    def testSubscribeAndPostMessage(self):
+        session = requests.Session()
+        self.assertEqual(session.post(self.url + "/weather/bob").status_code, 200)
+        self.assertEqual(session.post(self.url + "/weather", data='cloudy').status_code, 200)
+        response = session.get(self.url + "/weather/bob")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.text, 'cloudy')
+        self.assertEqual(session.get(self.url + "/weather/bob").status_code, 204)
+        self.assertEqual(session.delete(self.url + "/weather/bob").status_code, 200)
+        self.assertEqual(session.get(self.url + "/weather/bob").status_code, 404)
+
+    def testBatchPostAndGet(self):
+        requests.post(self.url + "/weather/bob")
+        response = requests.post(self.url + "/", data=encode_frames(['weather', 'cloudy', 'news', 'none', 'weather', 'sunny']),
+                headers={'Content-Type': FRAMED_CONTENT_TYPE})
+        self.assertEqual(response.json(), [0, None, 1])
+        response = requests.get(self.url + "/weather/bob?max=10")
+        self.assertEqual(response.headers['Content-Type'], FRAMED_CONTENT_TYPE)
+        self.assertEqual(decode_frames(response.content), ['cloudy', 'sunny'])
+        self.assertEqual(requests.get(self.url + "/weather/bob?max=0").status_code, 400)
+        self.assertEqual(requests.post(self.url + "/weather.*", data='cloudy').status_code, 400)
+        response = requests.post(self.url + "/", data=encode_frames(['weather', 'cloudy', 'weather.#', 'sunny']),
+                headers={'Content-Type': FRAMED_CONTENT_TYPE})
+        self.assertEqual(response.status_code, 400)
+
+    def testPipelinedRequestsAnsweredInOrder(self):
+        requests.post(self.url + "/weather/bob")
+        sock = socket.create_connection(("localhost", int(self.url.rsplit(":", 1)[1])))
+        # Send three requests in one go, on one connection.
+        sock.sendall("POST /weather HTTP/1.1\r\nHost: x\r\nContent-Length: 6\r\n\r\ncloudy"
+                     "POST /weather HTTP/1.1\r\nHost: x\r\nContent-Length: 5\r\n\r\nsunny"
+                     "GET /weather/bob?max=10 HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n")
+        data = ""
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+        sock.close()
+        responses = data.split("HTTP/1.1 ")[1:]
+        self.assertEqual(len(responses), 3)
+        self.assertTrue(responses[0].startswith("200"))
+        self.assertTrue(responses[2].endswith("6\ncloudy\n5\nsunny\n"))
+
+    def testLongPollReturnsWhenMessagePosted(self):
+        requests.post(self.url + "/weather/bob")
+        responses = Queue()
+        def longPoll():
+            responses.put(requests.get(self.url + "/weather/bob?wait=10"))
+        t = Thread(target=longPoll)
+        t.daemon = True
+        t.start()
+        time.sleep(0.2)
+        requests.post(self.url + "/weather", data='cloudy')
+        response = responses.get(timeout=5)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.text, 'cloudy')
+        start = time.time()
+        self.assertEqual(requests.get(self.url + "/weather/bob?wait=0.3").status_code, 204)
+        self.assertTrue(time.time() - start >= 0.3)
+
+    def testEventStream(self):
+        requests.post(self.url + "/weather/bob")
+        requests.post(self.url + "/weather", data='cloudy')
+        response = requests.get(self.url + "/weather/bob?stream", stream=True)
+        self.assertEqual(response.headers['Content-Type'], 'text/event-stream')
+        lines = response.iter_lines()
+        self.assertEqual(next(lines), ':')
+        self.assertEqual(next(lines), '')
+        self.assertEqual(next(lines), 'data: cloudy')
+        requests.delete(self.url + "/weather/bob")
+        # The stream should end once Bob unsubscribes.
+        self.assertEqual(list(lines), [''])
+
+    def testConsumerGroup(self):
+        requests.post(self.url + "/jobs/workers/w1")
+        requests.post(self.url + "/jobs/workers/w2")
+        requests.post(self.url + "/jobs", data=encode_frames(['a', 'b']), headers={'Content-Type': FRAMED_CONTENT_TYPE})
+        self.assertEqual(requests.get(self.url + "/jobs/workers/w1").text, 'a')
+        self.assertEqual(requests.get(self.url + "/jobs/workers/w2").text, 'b')
+
+    def testLeaseAndAcknowledge(self):
+        requests.post(self.url + "/jobs/bob")
+        requests.post(self.url + "/jobs", data='a')
+        response = requests.get(self.url + "/jobs/bob?lease=0.2")
+        self.assertEqual(response.text, 'a')
+        time.sleep(0.5)
+        response = requests.get(self.url + "/jobs/bob?lease=10")
+        self.assertEqual(response.text, 'a')
+        delivery_id = response.headers['X-Delivery-Id']
+        self.assertEqual(requests.post(self.url + "/jobs/bob?ack=" + delivery_id).status_code, 200)
+        self.assertEqual(requests.post(self.url + "/jobs/bob?ack=" + delivery_id).status_code, 404)
+        self.assertEqual(requests.get(self.url + "/jobs/bob").status_code, 204)
+
+    def testLargeMessages(self):
+        self.engine.compress_min_bytes = 100
+        try:
+            message = '{"reading": 12.5}' * 100000
+            incompressible = os.urandom(300000)
+            requests.post(self.url + "/weather/bob")
+            requests.post(self.url + "/weather", data=encode_frames([message, incompressible, message]),
+                    headers={'Content-Type': FRAMED_CONTENT_TYPE})
+            response = requests.get(self.url + "/weather/bob", headers={'Accept-Encoding': 'deflate'})
+            self.assertEqual(response.headers['Content-Encoding'], 'deflate')
+            self.assertEqual(response.content, message)
+            response = requests.get(self.url + "/weather/bob", headers={'Accept-Encoding': 'gzip'})
+            self.assertFalse('Content-Encoding' in response.headers)
+            self.assertEqual(response.content, incompressible)
+            response = requests.get(self.url + "/weather/bob?max=10")
+            self.assertEqual(decode_frames(response.content), [message])
+        finally:
+            self.engine.compress_min_bytes = None
+
+    def testUserFetch(self):
+        requests.post(self.url + "/weather/bob")
+        requests.post(self.url + "/news/bob")
+        requests.post(self.url + "/weather", data='cloudy')
+        requests.post(self.url + "/news", data='nothing new')
+        response = requests.get(self.url + "/_user/bob")
+        self.assertEqual(decode_frames(response.content), ['weather', 'cloudy', 'news', 'nothing new'])
+        responses = Queue()
+        Thread(target=lambda: responses.put(requests.get(self.url + "/_user/bob?wait=5"))).start()
+        time.sleep(0.2)
+        requests.delete(self.url + "/weather/bob")
+        requests.delete(self.url + "/news/bob")
+        # Once the user has no subscriptions left, the wait ends.
+        self.assertEqual(responses.get(timeout=5).status_code, 404)
+
+    def testFilteredSubscription(self):
+        requests.post(self.url + "/prices/bob", params={'filter': 'price>100'})
+        self.assertEqual(requests.post(self.url + "/prices/alice", params={'filter': 'price>'}).status_code, 400)
+        requests.post(self.url + "/prices", data='{"price": 50}')
+        requests.post(self.url + "/prices", data='{"price": 150}')
+        self.assertEqual(requests.get(self.url + "/prices/bob").content, '{"price": 150}')
+        self.assertEqual(requests.get(self.url + "/prices/bob").status_code, 204)
+
+    def testMetrics(self):
+        requests.post(self.url + "/weather/bob")
+        response = requests.get(self.url + "/_metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('pubsub_requests_total{method="POST",code="200"} 1' in response.text)
+
+if __name__ == '__main__':
+    unittest.main()
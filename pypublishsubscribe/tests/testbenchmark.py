@@ -0,0 +1,32 @@
+import unittest
+from pypublishsubscribe.benchmark import parse_args, run_benchmark, percentile
+
+class BenchmarkTest(unittest.TestCase):
+
+    def testPercentile(self):
+        values = range(1, 1001)
+        self.assertEqual(percentile(values, 50), 501)
+        self.assertEqual(percentile(values, 99.9), 999)
+        self.assertEqual(percentile([], 50), None)
+
+    def testSmallRunDeliversEverything(self):
+        config = parse_args(['--producers', '2', '--consumers', '2', '--topics', '3', '--fanout', '2',
+                             '--messages', '20', '--backlog', '5', '--publish_batch', '4', '--fetch_batch', '8'])
+        results = run_benchmark(config)
+        self.assertEqual(results['published'], 40)
+        # Every subscriber should get the backlog plus everything
+        # published to its topic.
+        self.assertEqual(results['expected'], 3 * 2 * 5 + 2 * 40)
+        self.assertEqual(results['consumed'], results['expected'])
+        self.assertEqual(results['end_to_end_latency_ms']['count'], results['expected'])
+
+    def testSmallBinaryRunDeliversEverything(self):
+        config = parse_args(['--protocol', 'binary', '--producers', '2', '--consumers', '2', '--topics', '3',
+                             '--fanout', '2', '--messages', '20', '--backlog', '5', '--publish_batch', '4',
+                             '--window', '8'])
+        results = run_benchmark(config)
+        self.assertEqual(results['published'], 40)
+        self.assertEqual(results['consumed'], results['expected'])
+
+if __name__ == '__main__':
+    unittest.main()
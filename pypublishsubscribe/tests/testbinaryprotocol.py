@@ -0,0 +1,140 @@
+import sys
+import time
+import unittest
+import subprocess
+import requests
+from pypublishsubscribe.binaryprotocol import encode_frame, decode_frame, PUBLISH, DELIVER
+from pypublishsubscribe.client import BinaryClient, ProtocolError
+from pypublishsubscribe.benchmark import free_port
+
+class FrameTest(unittest.TestCase):
+
+    def testRoundTrip(self):
+        frame = encode_frame(PUBLISH, 7, ('weather',), messages=['cloudy', '', 'sunny\n'])
+        self.assertEqual(decode_frame(frame), (PUBLISH, 7, ['weather'], 0, ['cloudy', '', 'sunny\n']))
+        frame = encode_frame(DELIVER, 0, ('weather', 'bob'), messages=['cloudy'])
+        self.assertEqual(decode_frame(frame), (DELIVER, 0, ['weather', 'bob'], 0, ['cloudy']))
+
+    def testMalformedFrames(self):
+        frame = encode_frame(PUBLISH, 7, ('weather',), messages=['cloudy'])
+        self.assertRaises(ValueError, decode_frame, frame[:-1])
+        self.assertRaises(ValueError, decode_frame, frame + 'x')
+        self.assertRaises(ValueError, decode_frame, '\xff' + frame[1:])
+
+class BinaryServerTest(unittest.TestCase):
+    """Runs the server with a binary protocol listener, and drives
+       it with the client library alongside HTTP."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.port_number = free_port()
+        cls.binary_port = free_port()
+        cls.server = subprocess.Popen([sys.executable, '-m', 'pypublishsubscribe.publishsubscribeserver',
+                str(cls.port_number), '--binary_port', str(cls.binary_port)])
+        for attempt in range(50):
+            try:
+                requests.get("http://localhost:%d/" % cls.port_number)
+                break
+            except requests.ConnectionError:
+                time.sleep(0.1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.terminate()
+        cls.server.wait()
+
+    def setUp(self):
+        self.client = BinaryClient('localhost', self.binary_port, timeout=5)
+
+    def tearDown(self):
+        self.client.close()
+
+    def testSubscribePublishAndFetch(self):
+        self.client.subscribe('weather', 'bob')
+        self.assertEqual(self.client.publish('weather', ['cloudy', 'sunny']), [0, 1])
+        self.assertEqual(self.client.publish('news', ['nothing new']), [None])
+        self.assertEqual(self.client.fetch('weather', 'bob', 10), ['cloudy', 'sunny'])
+        self.assertEqual(self.client.fetch('weather', 'bob', 10), [])
+        self.client.unsubscribe('weather', 'bob')
+        try:
+            self.client.fetch('weather', 'bob')
+            self.fail("Expected a ProtocolError")
+        except ProtocolError as e:
+            self.assertEqual(e.code, 404)
+
+    def testPipelinedRequests(self):
+        self.client.send_subscribe('weather', 'bob')
+        for i in range(100):
+            self.client.send_publish('weather', ['message %d' % i])
+        self.client.send_fetch('weather', 'bob', 1000)
+        results = self.client.wait_all()
+        self.assertEqual(len(results), 102)
+        self.assertEqual(results[100], [99])
+        self.assertEqual(results[-1], ['message %d' % i for i in range(100)])
+        self.client.unsubscribe('weather', 'bob')
+
+    def testPushDeliveryWithWindow(self):
+        self.client.subscribe('weather', 'bob', window=2)
+        publisher = BinaryClient('localhost', self.binary_port, timeout=5)
+        publisher.publish('weather', ['cloudy', 'sunny', 'windy'])
+        publisher.close()
+        # Only two messages fit in the window...
+        self.assertEqual(self.client.next_delivery(), ('weather', 'bob', ['cloudy', 'sunny']))
+        # ...until they are acknowledged.
+        self.client.ack('weather', 'bob', 2)
+        self.assertEqual(self.client.next_delivery(), ('weather', 'bob', ['windy']))
+        self.client.unsubscribe('weather', 'bob')
+
+    def testOverAcknowledgingKeepsWindow(self):
+        self.client.subscribe('weather', 'bob', window=2)
+        self.client.publish('weather', ['message %d' % i for i in range(5)])
+        self.assertEqual(self.client.next_delivery(), ('weather', 'bob', ['message 0', 'message 1']))
+        # Only the two messages outstanding are acknowledged, so
+        # no more than two are pushed next.
+        self.client.ack('weather', 'bob', 1000)
+        self.assertEqual(self.client.next_delivery(), ('weather', 'bob', ['message 2', 'message 3']))
+        self.client.ack('weather', 'bob', 2)
+        self.assertEqual(self.client.next_delivery(), ('weather', 'bob', ['message 4']))
+        self.client.unsubscribe('weather', 'bob')
+
+    def testUnacknowledgedPushesRedelivered(self):
+        self.client.subscribe('weather', 'bob', window=10)
+        self.client.publish('weather', ['cloudy', 'sunny'])
+        self.assertEqual(self.client.next_delivery(), ('weather', 'bob', ['cloudy', 'sunny']))
+        # Acknowledging part of a push doesn't commit any of it.
+        self.client.ack('weather', 'bob', 1)
+        self.client.close()
+        self.client = BinaryClient('localhost', self.binary_port, timeout=5)
+        # The server may not have seen the connection close yet.
+        for attempt in range(50):
+            messages = self.client.fetch('weather', 'bob', 10)
+            if messages:
+                break
+            time.sleep(0.1)
+        self.assertEqual(messages, ['cloudy', 'sunny'])
+        self.client.subscribe('weather', 'bob', window=10)
+        self.client.publish('weather', ['windy'])
+        self.assertEqual(self.client.next_delivery(), ('weather', 'bob', ['windy']))
+        self.client.ack('weather', 'bob', 1)
+        self.client.close()
+        self.client = BinaryClient('localhost', self.binary_port, timeout=5)
+        self.assertEqual(self.client.fetch('weather', 'bob', 10), [])
+        self.client.unsubscribe('weather', 'bob')
+
+    def testSharedWithHttp(self):
+        self.client.subscribe('weather', 'bob')
+        response = requests.post("http://localhost:%d/weather" % self.port_number, data='cloudy')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.fetch('weather', 'bob'), ['cloudy'])
+        response = requests.delete("http://localhost:%d/weather/bob" % self.port_number)
+        self.assertEqual(response.status_code, 200)
+
+    def testPublishToPatternGives400(self):
+        try:
+            self.client.publish('weather.*', ['cloudy'])
+            self.fail("Expected a ProtocolError")
+        except ProtocolError as e:
+            self.assertEqual(e.code, 400)
+
+if __name__ == '__main__':
+    unittest.main()
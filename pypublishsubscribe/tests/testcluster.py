@@ -0,0 +1,98 @@
+import sys
+import time
+import socket
+import shutil
+import tempfile
+import unittest
+import subprocess
+import requests
+from pypublishsubscribe.cluster import HashRing
+from pypublishsubscribe.framing import decode_frames, encode_frames, FRAMED_CONTENT_TYPE
+
+class HashRingTest(unittest.TestCase):
+
+    def testOwnerIsStable(self):
+        ring = HashRing(range(4))
+        owners = [ring.owner('topic%d' % i) for i in range(100)]
+        self.assertEqual(owners, [HashRing(range(4)).owner('topic%d' % i) for i in range(100)])
+
+    def testTopicsSpreadOverAllNodes(self):
+        ring = HashRing(range(4))
+        owners = set(ring.owner('topic%d' % i) for i in range(1000))
+        self.assertEqual(owners, set(range(4)))
+
+    def testAddingNodeMovesFewTopics(self):
+        # With consistent hashing, adding a fifth node should move
+        # roughly a fifth of the topics, rather than most of them.
+        before = HashRing(range(4))
+        after = HashRing(range(5))
+        moved = sum(1 for i in range(1000) if before.owner('topic%d' % i) != after.owner('topic%d' % i))
+        self.assertTrue(moved < 350)
+
+class WorkersTest(unittest.TestCase):
+    """Runs the server with several worker processes, and checks
+       that requests for any topic work whichever worker they
+       happen to reach."""
+
+    @classmethod
+    def setUpClass(cls):
+        # Find a free port for the workers to share.
+        sock = socket.socket()
+        sock.bind(('', 0))
+        cls.port_number = sock.getsockname()[1]
+        sock.close()
+        cls.socket_dir = tempfile.mkdtemp()
+        cls.server = subprocess.Popen([sys.executable, '-m', 'pypublishsubscribe.publishsubscribeserver',
+                str(cls.port_number), '--workers', '3', '--socket_dir', cls.socket_dir])
+        for attempt in range(50):
+            try:
+                requests.get("http://localhost:%d/" % cls.port_number)
+                break
+            except requests.ConnectionError:
+                time.sleep(0.1)
+        # Give every worker time to start listening.
+        time.sleep(0.5)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.terminate()
+        cls.server.wait()
+        shutil.rmtree(cls.socket_dir)
+
+    def testManyTopics(self):
+        topics = ['topic%d' % i for i in range(20)]
+        for topic in topics:
+            response = requests.post("http://localhost:%d/%s/bob" % (self.port_number, topic), data='')
+            self.assertEqual(response.status_code, 200)
+        for topic in topics:
+            for message in ['cloudy', 'sunny']:
+                response = requests.post("http://localhost:%d/%s" % (self.port_number, topic),
+                        data='%s in %s' % (message, topic))
+                self.assertEqual(response.status_code, 200)
+        for topic in topics:
+            for message in ['cloudy', 'sunny']:
+                response = requests.get("http://localhost:%d/%s/bob" % (self.port_number, topic))
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.text, '%s in %s' % (message, topic))
+            response = requests.get("http://localhost:%d/%s/bob" % (self.port_number, topic))
+            self.assertEqual(response.status_code, 204)
+
+    def testBatchPostToManyTopics(self):
+        topics = ['batch%d' % i for i in range(10)]
+        for topic in topics:
+            response = requests.post("http://localhost:%d/%s/bob" % (self.port_number, topic), data='')
+            self.assertEqual(response.status_code, 200)
+        frames = []
+        for topic in topics:
+            frames.extend([topic, 'first in ' + topic, topic, 'second in ' + topic])
+        frames.extend(['nobody', 'dropped'])
+        response = requests.post("http://localhost:%d/" % self.port_number,
+                data=encode_frames(frames), headers={'Content-Type': FRAMED_CONTENT_TYPE})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), [0, 1] * len(topics) + [None])
+        for topic in topics:
+            response = requests.get("http://localhost:%d/%s/bob?max=10" % (self.port_number, topic))
+            self.assertEqual(decode_frames(response.content), ['first in ' + topic, 'second in ' + topic])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+import time
+import unittest
+from pypublishsubscribe.engine import PublishSubscribeEngine, get_positive_arg
+from pypublishsubscribe.topic import TopicFull, ServerFull, REJECT
+from pypublishsubscribe.payload import Payload
+
+class EngineTest(unittest.TestCase):
+    """Tests for the engine shared by the front ends, used
+       directly, without any HTTP in the way."""
+
+    def testPublishAndFetch(self):
+        engine = PublishSubscribeEngine()
+        engine.subscribe('weather', 'bob')
+        self.assertEqual(engine.publish('weather', ['cloudy', 'sunny']), [0, 1])
+        self.assertEqual(engine.publish('news', ['dropped']), [None])
+        self.assertEqual(engine.take_messages('weather', 'bob', 10), ['cloudy', 'sunny'])
+
+    def testTopicRemovedWithLastSubscriber(self):
+        engine = PublishSubscribeEngine()
+        engine.subscribe('weather.*', 'bob')
+        engine.join_group('weather.*', 'workers', 'w1')
+        engine.unsubscribe('weather.*', 'bob')
+        self.assertTrue('weather.*' in engine.topics)
+        engine.leave_group('weather.*', 'workers', 'w1')
+        self.assertFalse('weather.*' in engine.topics)
+        self.assertFalse(engine.patterns)
+
+    def testInvalidNamesRejected(self):
+        engine = PublishSubscribeEngine()
+        self.assertRaises(ValueError, engine.subscribe, 'weather', 'b\0b')
+        self.assertRaises(ValueError, engine.join_group, 'weather', 'workers', 'w\0')
+
+    def testRejectedPublishHasNoEffect(self):
+        engine = PublishSubscribeEngine(max_topic_bytes=10, max_total_bytes=15, overflow=REJECT)
+        engine.subscribe('weather', 'bob')
+        engine.subscribe('news', 'bob')
+        engine.subscribe('sport', 'bob')
+        engine.publish('weather', ['cloudy'])
+        self.assertRaises(TopicFull, engine.publish, 'weather', ['sunny'])
+        # Each topic has room, but the server doesn't, so none of
+        # the messages are published.
+        self.assertRaises(ServerFull, engine.publish_multi_topic, ['news', 'nothing', 'sport', 'a goal'])
+        self.assertEqual(len(engine.topics['news']), 0)
+        self.assertEqual(engine.publish_multi_topic(['news', 'nothing', 'other', 'dropped']), [0, None])
+        self.assertTrue('pubsub_messages_rejected_total{topic="weather"} 1' in engine.metrics.render())
+        # Messages can't be published to a pattern, even in a batch.
+        self.assertRaises(ValueError, engine.publish_multi_topic, ['news', 'nothing', 'news.#', 'x'])
+        self.assertEqual(len(engine.topics['news']), 1)
+        self.assertEqual(engine.budget.used, 13)
+        engine.unsubscribe('news', 'bob')
+        self.assertEqual(engine.budget.used, 6)
+
+    def testBudgetShared(self):
+        engine = PublishSubscribeEngine(max_total_bytes=20)
+        engine.subscribe('a', 'bob')
+        engine.subscribe('b', 'bob')
+        engine.publish('a', ['x' * 20])
+        # The message to "b" is kept, and "a" makes room for it.
+        self.assertEqual(engine.publish('b', ['hello']), [0])
+        self.assertEqual(engine.take_messages('b', 'bob', 10), ['hello'])
+        self.assertEqual(engine.take_messages('a', 'bob', 10), [])
+        self.assertEqual(engine.budget.used, 0)
+        engine.unsubscribe('a', 'bob')
+        self.assertEqual(len(engine.budget.topics), 1)
+
+    def testTimeToLive(self):
+        engine = PublishSubscribeEngine(topic_ttls={'weather.*': 0.05, '#': 10})
+        engine.subscribe('weather.uk', 'bob')
+        engine.subscribe('news', 'bob')
+        engine.publish('weather.uk', ['cloudy'])
+        engine.publish('news', ['old news'], ttl=0.05)
+        engine.publish('news', ['news'])
+        time.sleep(0.1)
+        self.assertEqual(engine.take_messages('weather.uk', 'bob', 10), [])
+        self.assertEqual(engine.take_messages('news', 'bob', 10), ['news'])
+        self.assertTrue('pubsub_messages_expired_total{topic="news"} 1' in engine.metrics.render())
+
+    def testLargeMessagesCompressedOnce(self):
+        engine = PublishSubscribeEngine(compress_min_bytes=100)
+        engine.subscribe('weather.uk', 'bob')
+        engine.subscribe('weather.*', 'alice')
+        engine.publish('weather.uk', ['cloudy', 'sunny' * 100])
+        small, large = engine.take_messages('weather.uk', 'bob', 10)
+        self.assertFalse(isinstance(small, Payload))
+        self.assertEqual(large, 'sunny' * 100)
+        self.assertTrue('gzip' in large.encodings)
+        # Both subscriptions share the message, and its compressed form.
+        self.assertTrue(engine.take_messages('weather.*', 'alice', 10)[1] is large)
+
+    def testUserMessagesTakeTurns(self):
+        engine = PublishSubscribeEngine()
+        for topic in ('weather', 'news', 'sport'):
+            engine.subscribe(topic, 'bob')
+        engine.subscribe('news', 'alice')
+        self.assertEqual(engine.user_topics('bob'), ['weather', 'news', 'sport'])
+        engine.publish('weather', ['cloudy', 'sunny', 'windy'])
+        engine.publish('sport', ['a goal'])
+        self.assertEqual(engine.take_user_messages('bob', 2), [('weather', 'cloudy'), ('sport', 'a goal')])
+        engine.publish('news', ['nothing new'])
+        # Carrying on from the topic after the last one served.
+        self.assertEqual(engine.take_user_messages('bob', 10),
+                [('weather', 'sunny'), ('news', 'nothing new'), ('weather', 'windy')])
+        self.assertEqual(engine.take_user_messages('bob', 10), [])
+        engine.unsubscribe('weather', 'bob')
+        self.assertEqual(engine.user_topics('bob'), ['news', 'sport'])
+        engine._clear()
+        self.assertFalse(engine.is_valid_user('bob'))
+        self.assertFalse(engine.is_valid_user('alice'))
+
+    def testFilteredSubscriptions(self):
+        engine = PublishSubscribeEngine()
+        engine.subscribe('prices.uk', 'bob', ['price>100'])
+        engine.subscribe('prices.*', 'alice', ['price>100'])
+        engine.subscribe('prices.uk', 'carol', ['price>100'])
+        engine.subscribe('prices.uk', 'dave')
+        # Bob and Carol share one log, holding only what they want.
+        self.assertEqual(len(engine.topics), 3)
+        self.assertEqual(engine.publish('prices.uk', ['{"price": 50}', '{"price": 150}']), [0, 1])
+        self.assertEqual(len(engine.topics['prices.uk']), 2)
+        self.assertEqual(engine.take_messages('prices.uk', 'bob', 10), ['{"price": 150}'])
+        self.assertEqual(engine.take_messages('prices.uk', 'carol', 10), ['{"price": 150}'])
+        self.assertEqual(engine.take_messages('prices.*', 'alice', 10), ['{"price": 150}'])
+        engine.unsubscribe('prices.uk', 'dave')
+        # Messages no filter matches aren't held anywhere.
+        self.assertEqual(engine.publish('prices.uk', ['{"price": 50}', '{"price": 200}']), [None, 1])
+        self.assertEqual(engine.user_topics('alice'), ['prices.*'])
+        self.assertTrue('pubsub_messages_filtered_total{topic="prices.uk"} 4' in engine.metrics.render())
+        # Subscribing again leaves the filter as it was.
+        engine.subscribe('prices.uk', 'bob')
+        self.assertEqual(engine.publish('prices.uk', ['{"price": 1}']), [None])
+        self.assertRaises(ValueError, engine.subscribe, 'prices.uk', 'erin', ['price>'])
+        self.assertRaises(ValueError, engine.subscribe, engine.subscription_name('prices.uk', 'bob'), 'erin')
+        for username in ('bob', 'carol'):
+            engine.unsubscribe('prices.uk', username)
+        engine.unsubscribe('prices.*', 'alice')
+        self.assertEqual(engine.topics, {})
+        self.assertEqual(engine.views, {})
+        self.assertFalse(engine.patterns)
+
+    def testGetPositiveArg(self):
+        self.assertEqual(get_positive_arg({}, 'max', None), None)
+        self.assertEqual(get_positive_arg({'wait': ['0.5']}, 'wait', None, float), 0.5)
+        self.assertRaises(ValueError, get_positive_arg, {'max': ['0']}, 'max', None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+from pypublishsubscribe.filters import Filter, parse_document, view_name, view_topic, view_filter
+
+def matches(conditions, message):
+    return Filter(conditions).matches(parse_document(message))
+
+class FilterTest(unittest.TestCase):
+
+    def testComparisons(self):
+        message = '{"region": "eu", "price": 120, "urgent": true, "reading": {"temp": 12.5}, "tags": ["a", "b"]}'
+        self.assertTrue(matches(['region=eu'], message))
+        self.assertFalse(matches(['region!=eu'], message))
+        self.assertTrue(matches(['price>100', 'price<=120'], message))
+        self.assertFalse(matches(['price>100', 'region=us'], message))
+        self.assertTrue(matches(['reading.temp>=12.5'], message))
+        self.assertTrue(matches(['tags.1=b'], message))
+        self.assertTrue(matches(['region<fr'], message))
+        self.assertTrue(matches(['urgent=true'], message))
+        # true isn't the number 1, and "120" isn't the number 120.
+        self.assertFalse(matches(['urgent=1'], message))
+        self.assertFalse(matches(['price="120"'], message))
+        self.assertFalse(matches(['price>"100"'], message))
+
+    def testMissingFields(self):
+        message = '{"region": "eu"}'
+        self.assertTrue(matches(['region'], message))
+        self.assertFalse(matches(['price'], message))
+        self.assertFalse(matches(['price!=100'], message))
+        self.assertFalse(matches(['region.name=eu'], message))
+        # A message that isn't a JSON object matches nothing.
+        self.assertFalse(matches(['region'], 'not json'))
+        self.assertFalse(matches(['0=1'], '[1]'))
+
+    def testInvalidConditions(self):
+        for conditions in ([], [''], ['=eu'], ['price>'], ['a..b=1'], ['price>true'], ['tags=[1]'],
+                ['region=\0'], ['region=\xff']):
+            self.assertRaises(ValueError, Filter, conditions)
+
+    def testSameConditionsSameFilter(self):
+        first = Filter(['price > 100', 'region=eu'])
+        second = Filter(['region=eu', 'price>100', 'region=eu'])
+        self.assertEqual(first.source, second.source)
+        name = view_name('weather.*', first)
+        self.assertEqual(view_topic(name), 'weather.*')
+        self.assertEqual(view_filter(name).source, first.source)
+        self.assertEqual(view_topic('weather.*'), 'weather.*')
+        self.assertEqual(view_filter('weather.*'), None)
+
+if __name__ == '__main__':
+    unittest.main()
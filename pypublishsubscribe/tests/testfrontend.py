@@ -0,0 +1,49 @@
+import unittest
+from pypublishsubscribe.engine import PublishSubscribeEngine
+from pypublishsubscribe.frontend import TopicWatch, TopicStream, UserFetch
+
+class FrontEndTest(unittest.TestCase):
+    """Tests for what the front ends share, without any HTTP."""
+
+    def testTopicWatch(self):
+        engine = PublishSubscribeEngine()
+        engine.subscribe('weather', 'bob')
+        finished = []
+        fetch = lambda: engine.take_messages('weather', 'bob', 10) or None
+        watch = TopicWatch(engine, lambda: ['weather'], lambda: engine.is_valid_username_and_topic('weather', 'bob'),
+                fetch, lambda code, result: finished.append((code, result)))
+        watch.watch()
+        engine.publish('weather', ['cloudy'])
+        self.assertEqual(finished, [(200, ['cloudy'])])
+        watch.watch()
+        engine.unsubscribe('weather', 'bob')
+        self.assertEqual(finished[1:], [(404, None)])
+
+    def testTopicStream(self):
+        engine = PublishSubscribeEngine()
+        engine.subscribe('weather', 'bob')
+        written = []
+        ended = []
+        stream = TopicStream(engine, 'weather', 'bob', written.append, lambda: ended.append(True))
+        stream.on_topic_changed()
+        engine.publish('weather', ['cloudy'])
+        self.assertEqual(written, ['data: cloudy\n\n'])
+        stream.stop()
+        engine.publish('weather', ['sunny'])
+        self.assertEqual(len(written), 1)
+        self.assertFalse(ended)
+
+    def testUserFetch(self):
+        engine = PublishSubscribeEngine()
+        engine.subscribe('weather', 'bob')
+        self.assertEqual(UserFetch(engine, ['_user', 'alice'], {}).error, 404)
+        self.assertEqual(UserFetch(engine, ['_user', 'bob'], {'max': ['0']}).error, 400)
+        self.assertEqual(UserFetch(engine, ['_user', 'bob'], {'lease': ['5']}).error, 400)
+        user_fetch = UserFetch(engine, ['_user', 'bob'], {'wait': ['1']})
+        self.assertEqual(user_fetch.error, None)
+        self.assertEqual(user_fetch.take(), None)
+        engine.publish('weather', ['cloudy'])
+        self.assertEqual(user_fetch.take(), ['weather', 'cloudy'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import time
+import thread
+import threading
+import unittest
+from pypublishsubscribe.metrics import Counter, Histogram, Registry, TopicLabels, OTHER_TOPICS, \
+        SamplingProfiler
+
+class MetricsTest(unittest.TestCase):
+
+    def testTopicLabelsLimited(self):
+        labels = TopicLabels(2)
+        self.assertEqual(labels('weather'), 'weather')
+        self.assertEqual(labels('news'), 'news')
+        self.assertEqual(labels('sport'), OTHER_TOPICS)
+        # Topics already seen keep their own label.
+        self.assertEqual(labels('weather'), 'weather')
+
+    def testRenderCounter(self):
+        registry = Registry()
+        counter = registry.register(Counter('requests_total', 'Requests.', ('method',)))
+        counter.inc(('GET',))
+        counter.inc(('GET',), 2)
+        self.assertEqual(registry.render(),
+                '# HELP requests_total Requests.\n'
+                '# TYPE requests_total counter\n'
+                'requests_total{method="GET"} 3\n')
+
+    def testRenderHistogram(self):
+        registry = Registry()
+        histogram = registry.register(Histogram('seconds', 'Timings.', buckets=[0.1, 1.0]))
+        histogram.observe(0.05)
+        histogram.observe(0.1)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        lines = registry.render().splitlines()
+        self.assertEqual(lines[2:], [
+                'seconds_bucket{le="0.1"} 2',
+                'seconds_bucket{le="1.0"} 3',
+                'seconds_bucket{le="+Inf"} 4',
+                'seconds_sum 5.65',
+                'seconds_count 4'])
+
+    def testRenderWhileProfiling(self):
+        running = [True]
+        def recurse(depth):
+            if depth:
+                recurse(depth - 1)
+        def busy():
+            # Stacks of many depths, so that new ones keep being seen.
+            depth = 0
+            while running[0]:
+                recurse(depth % 200)
+                depth += 1
+        profiled = {}
+        def target():
+            profiled['thread'] = thread.get_ident()
+            busy()
+        worker = threading.Thread(target=target)
+        worker.start()
+        while 'thread' not in profiled:
+            time.sleep(0.001)
+        profiler = SamplingProfiler(profiled['thread'], 0.0001)
+        profiler.start()
+        try:
+            deadline = time.time() + 0.5
+            while time.time() < deadline:
+                profiler.render()
+        finally:
+            profiler.stop()
+            running[0] = False
+            worker.join()
+        self.assertTrue('recurse' in profiler.render())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+import unittest
+from pypublishsubscribe.patterns import SubscriptionTrie, is_pattern
+
+class SubscriptionTrieTest(unittest.TestCase):
+
+    def setUp(self):
+        self.trie = SubscriptionTrie()
+        for pattern in ['orders.*.fr', 'orders.#', 'orders.eu.#', '#', 'weather.*', '*.*.fr', 'orders.#.fr']:
+            self.trie.add(pattern)
+
+    def testIsPattern(self):
+        self.assertTrue(is_pattern('orders.*'))
+        self.assertTrue(is_pattern('#'))
+        self.assertFalse(is_pattern('orders.eu'))
+        self.assertFalse(is_pattern('orders.eu#'))
+
+    def testMatch(self):
+        self.assertEqual(self.trie.match('orders.eu.fr'),
+                set(['orders.*.fr', 'orders.#', 'orders.eu.#', '#', '*.*.fr', 'orders.#.fr']))
+        self.assertEqual(self.trie.match('orders'), set(['orders.#', '#']))
+        self.assertEqual(self.trie.match('orders.fr'), set(['orders.#', '#', 'orders.#.fr']))
+        self.assertEqual(self.trie.match('weather.london'), set(['weather.*', '#']))
+        self.assertEqual(self.trie.match('weather.london.today'), set(['#']))
+
+    def testRemove(self):
+        self.trie.remove('#')
+        self.trie.remove('orders.#')
+        self.assertEqual(self.trie.match('orders'), set())
+        self.assertEqual(self.trie.match('orders.eu.fr'),
+                set(['orders.*.fr', 'orders.eu.#', '*.*.fr', 'orders.#.fr']))
+        for pattern in ['orders.*.fr', 'orders.eu.#', 'weather.*', '*.*.fr', 'orders.#.fr']:
+            self.trie.remove(pattern)
+        # Removing every pattern should leave the trie empty.
+        self.assertFalse(self.trie)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import zlib
+import gzip
+import unittest
+from StringIO import StringIO
+from pypublishsubscribe.payload import Payload, prepare_message, accepted_encodings, encode_message
+
+def gunzip(data):
+    return gzip.GzipFile(fileobj=StringIO(data)).read()
+
+class PayloadTest(unittest.TestCase):
+
+    def testEncodingsMadeOnce(self):
+        message = '{"reading": 12.5}' * 1000
+        payload = Payload(message)
+        self.assertEqual(payload, message)
+        self.assertEqual(len(payload), len(message))
+        gzipped = payload.encoded('gzip')
+        self.assertEqual(gunzip(gzipped), message)
+        self.assertTrue(payload.encoded('gzip') is gzipped)
+        self.assertEqual(zlib.decompress(payload.encoded('deflate')), message)
+        self.assertEqual(payload.encoded('br'), None)
+
+    def testIncompressibleMessageNotEncoded(self):
+        payload = Payload('x')
+        self.assertEqual(payload.encoded('gzip'), None)
+        self.assertEqual(encode_message(payload, 'gzip'), (None, payload))
+
+    def testPrepareMessage(self):
+        self.assertFalse(isinstance(prepare_message('cloudy', 100), Payload))
+        payload = prepare_message('cloudy' * 100, 100)
+        self.assertTrue(isinstance(payload, Payload))
+        # Compressed with gzip as it is published.
+        self.assertTrue('gzip' in payload.encodings)
+        self.assertTrue(prepare_message(payload, 100) is payload)
+
+    def testAcceptedEncodings(self):
+        self.assertEqual(accepted_encodings(None), [])
+        self.assertEqual(accepted_encodings('gzip, deflate'), ['gzip', 'deflate'])
+        self.assertEqual(accepted_encodings('gzip;q=0.5, deflate'), ['deflate', 'gzip'])
+        self.assertEqual(accepted_encodings('gzip;q=0, x-gzip;q=bad, br'), ['br'])
+        self.assertEqual(accepted_encodings('*'), ['gzip', 'deflate'])
+        # "*" only covers encodings the header doesn't name.
+        self.assertEqual(accepted_encodings('gzip;q=0, *'), ['deflate'])
+        self.assertEqual(accepted_encodings('*;q=0.5, gzip'), ['gzip', 'deflate'])
+
+    def testEncodeMessage(self):
+        payload = prepare_message('cloudy' * 100, 100)
+        self.assertEqual(encode_message('cloudy', 'gzip'), (None, 'cloudy'))
+        self.assertEqual(encode_message(payload, None), (None, payload))
+        self.assertEqual(encode_message(payload, 'br, gzip'), ('gzip', payload.encodings['gzip']))
+        self.assertEqual(encode_message(payload, 'identity, gzip;q=0.5'), (None, payload))
+        encoding, body = encode_message(payload, 'gzip;q=0, *')
+        self.assertEqual(encoding, 'deflate')
+        self.assertEqual(encode_message(payload, 'gzip;q=0, deflate;q=0, *'), (None, payload))
+        encoding, body = encode_message(payload, 'deflate')
+        self.assertEqual(encoding, 'deflate')
+        self.assertEqual(zlib.decompress(body), payload)
+
+if __name__ == '__main__':
+    unittest.main()
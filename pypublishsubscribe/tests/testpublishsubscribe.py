@@ -1,10 +1,12 @@
 import unittest
 import requests
 from pypublishsubscribe.publishsubscribeserver import PublishSubscribeServer
+from pypublishsubscribe.framing import decode_frames, encode_frames, FRAMED_CONTENT_TYPE
 from twisted.web import server
 from twisted.internet import reactor
 from threading import Thread
 from Queue import Queue
+import time
 
 class PublishSubscribeTest(unittest.TestCase):
     """A set of tests for the server, including tests both
@@ -201,6 +203,358 @@ class PublishSubscribeTest(unittest.TestCase):
         response = requests.post("http://localhost:%d/weather" % self.port_number, data='cloudy')
         self.assertEqual(response.status_code, 200)
 
+    def testBatchGetReturnsAllOutstandingMessages(self):
+        response = requests.post("http://localhost:%d/weather/bob" % self.port_number, data='')
+        self.assertEqual(response.status_code, 200)
+        messages = ['cloudy', 'sunny\nand warm', '', 'raining']
+        for message in messages:
+            response = requests.post("http://localhost:%d/weather" % self.port_number, data=message)
+            self.assertEqual(response.status_code, 200)
+        # A single batched GET should return every message, in order.
+        response = requests.get("http://localhost:%d/weather/bob?max=10" % self.port_number)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(decode_frames(response.content), messages)
+        # Bob has now received everything, so there should be nothing left.
+        response = requests.get("http://localhost:%d/weather/bob?max=10" % self.port_number)
+        self.assertEqual(response.status_code, 204)
+
+    def testBatchGetLimits(self):
+        response = requests.post("http://localhost:%d/weather/bob" % self.port_number, data='')
+        self.assertEqual(response.status_code, 200)
+        for message in ['cloudy', 'sunny', 'raining', 'snowing']:
+            response = requests.post("http://localhost:%d/weather" % self.port_number, data=message)
+            self.assertEqual(response.status_code, 200)
+        response = requests.get("http://localhost:%d/weather/bob?max=2" % self.port_number)
+        self.assertEqual(decode_frames(response.content), ['cloudy', 'sunny'])
+        # Only "raining" fits in 10 bytes.
+        response = requests.get("http://localhost:%d/weather/bob?max_bytes=10" % self.port_number)
+        self.assertEqual(decode_frames(response.content), ['raining'])
+        response = requests.get("http://localhost:%d/weather/bob" % self.port_number)
+        self.assertEqual(response.text, 'snowing')
+
+    def testBatchGetInvalidLimitGives400(self):
+        response = requests.post("http://localhost:%d/weather/bob" % self.port_number, data='')
+        self.assertEqual(response.status_code, 200)
+        response = requests.get("http://localhost:%d/weather/bob?max=none" % self.port_number)
+        self.assertEqual(response.status_code, 400)
+        response = requests.get("http://localhost:%d/weather/bob?max=0" % self.port_number)
+        self.assertEqual(response.status_code, 400)
+
+    def testBatchPost(self):
+        response = requests.post("http://localhost:%d/weather/bob" % self.port_number, data='')
+        self.assertEqual(response.status_code, 200)
+        messages = ['cloudy', 'sunny', 'raining']
+        response = requests.post("http://localhost:%d/weather" % self.port_number,
+                data=encode_frames(messages), headers={'Content-Type': FRAMED_CONTENT_TYPE})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), [0, 1, 2])
+        # Each message should be received individually, in order.
+        for message in messages:
+            response = requests.get("http://localhost:%d/weather/bob" % self.port_number)
+            self.assertEqual(response.text, message)
+
+    def testBatchPostToManyTopics(self):
+        response = requests.post("http://localhost:%d/weather/bob" % self.port_number, data='')
+        self.assertEqual(response.status_code, 200)
+        response = requests.post("http://localhost:%d/news/bob" % self.port_number, data='')
+        self.assertEqual(response.status_code, 200)
+        # Frames alternate between topic and message. Nobody is subscribed
+        # to "sport", so that message is dropped and has no sequence number.
+        frames = ['weather', 'cloudy', 'news', 'nothing new', 'sport', 'no score', 'weather', 'sunny']
+        response = requests.post("http://localhost:%d/" % self.port_number,
+                data=encode_frames(frames), headers={'Content-Type': FRAMED_CONTENT_TYPE})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), [0, 0, None, 1])
+        response = requests.get("http://localhost:%d/weather/bob?max=10" % self.port_number)
+        self.assertEqual(decode_frames(response.content), ['cloudy', 'sunny'])
+        response = requests.get("http://localhost:%d/news/bob" % self.port_number)
+        self.assertEqual(response.text, 'nothing new')
+
+    def testBatchPostBadFramingGives400(self):
+        response = requests.post("http://localhost:%d/weather/bob" % self.port_number, data='')
+        self.assertEqual(response.status_code, 200)
+        response = requests.post("http://localhost:%d/weather" % self.port_number,
+                data='10\ncloudy\n', headers={'Content-Type': FRAMED_CONTENT_TYPE})
+        self.assertEqual(response.status_code, 400)
+        # Nothing from the bad batch should have been published.
+        response = requests.get("http://localhost:%d/weather/bob" % self.port_number)
+        self.assertEqual(response.status_code, 204)
+
+    def testLongPollReturnsWhenMessagePosted(self):
+        response = requests.post("http://localhost:%d/weather/bob" % self.port_number, data='')
+        self.assertEqual(response.status_code, 200)
+        responses = Queue()
+        def longPoll():
+            responses.put(requests.get("http://localhost:%d/weather/bob?wait=10" % self.port_number))
+        t = Thread(target=longPoll)
+        t.daemon = True
+        t.start()
+        # Give the GET time to be parked before posting.
+        time.sleep(0.2)
+        response = requests.post("http://localhost:%d/weather" % self.port_number, data='cloudy')
+        self.assertEqual(response.status_code, 200)
+        response = responses.get(timeout=5)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.text, 'cloudy')
+
+    def testLongPollTimesOutWith204(self):
+        response = requests.post("http://localhost:%d/weather/bob" % self.port_number, data='')
+        self.assertEqual(response.status_code, 200)
+        start = time.time()
+        response = requests.get("http://localhost:%d/weather/bob?wait=0.3" % self.port_number)
+        self.assertEqual(response.status_code, 204)
+        self.assertTrue(time.time() - start >= 0.3)
+
+    def testLongPollUnsubscribeGives404(self):
+        self.subscribeAliceAndBobAndPost()
+        response = requests.get("http://localhost:%d/weather/bob" % self.port_number)
+        self.assertEqual(response.text, 'cloudy')
+        responses = Queue()
+        def longPoll():
+            responses.put(requests.get("http://localhost:%d/weather/bob?wait=10" % self.port_number))
+        t = Thread(target=longPoll)
+        t.daemon = True
+        t.start()
+        time.sleep(0.2)
+        response = requests.delete("http://localhost:%d/weather/bob" % self.port_number)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(responses.get(timeout=5).status_code, 404)
+
+    def testEventStream(self):
+        self.subscribeAliceAndBobAndPost()
+        response = requests.get("http://localhost:%d/weather/bob?stream=1" % self.port_number, stream=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Type'], 'text/event-stream')
+        lines = response.iter_lines()
+        self.assertEqual(next(lines), ':')
+        self.assertEqual(next(lines), '')
+        # The message already waiting should be sent straight away.
+        self.assertEqual(next(lines), 'data: cloudy')
+        self.assertEqual(next(lines), '')
+        # New messages are pushed as they are published.
+        response = requests.post("http://localhost:%d/weather" % self.port_number, data='sunny\nand warm')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(next(lines), 'data: sunny')
+        self.assertEqual(next(lines), 'data: and warm')
+        self.assertEqual(next(lines), '')
+        # Unsubscribing ends the stream.
+        response = requests.delete("http://localhost:%d/weather/bob" % self.port_number)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(lines), [])
+
+    def testMetrics(self):
+        self.subscribeAliceAndBobAndPost()
+        response = requests.get("http://localhost:%d/weather/bob" % self.port_number)
+        self.assertEqual(response.status_code, 200)
+        response = requests.get("http://localhost:%d/_metrics" % self.port_number)
+        self.assertEqual(response.status_code, 200)
+        lines = response.text.splitlines()
+        self.assertTrue('pubsub_topic_messages{topic="weather"} 1' in lines)
+        self.assertTrue('pubsub_topic_subscribers{topic="weather"} 2' in lines)
+        self.assertTrue('pubsub_messages_delivered_total{topic="weather"} 1' in lines)
+        self.assertTrue('# TYPE pubsub_fetch_seconds histogram' in lines)
+
+    def testMetricsPathIsNotATopic(self):
+        response = requests.post("http://localhost:%d/_metrics/bob" % self.port_number, data='')
+        self.assertEqual(response.status_code, 404)
+
+    def testProfiler(self):
+        response = requests.get("http://localhost:%d/_metrics/profile" % self.port_number)
+        self.assertEqual(response.status_code, 404)
+        response = requests.post("http://localhost:%d/_metrics/profile?interval=0.001" % self.port_number)
+        self.assertEqual(response.status_code, 200)
+        self.runMultipleRequests(20, lambda: None)
+        response = requests.delete("http://localhost:%d/_metrics/profile" % self.port_number)
+        self.assertEqual(response.status_code, 200)
+        response = requests.get("http://localhost:%d/_metrics/profile" % self.port_number)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.text)
+
+    def testWildcardSubscription(self):
+        response = requests.post("http://localhost:%d/weather.*/bob" % self.port_number, data='')
+        self.assertEqual(response.status_code, 200)
+        response = requests.post("http://localhost:%d/weather.london/alice" % self.port_number, data='')
+        self.assertEqual(response.status_code, 200)
+        for topic, message in [('weather.london', 'cloudy'), ('weather.paris', 'sunny'), ('news', 'nothing new')]:
+            response = requests.post("http://localhost:%d/%s" % (self.port_number, topic), data=message)
+            self.assertEqual(response.status_code, 200)
+        # Bob should get messages for every matching topic, in order.
+        response = requests.get("http://localhost:%d/weather.*/bob?max=10" % self.port_number)
+        self.assertEqual(decode_frames(response.content), ['cloudy', 'sunny'])
+        # Alice, subscribed to just one of those topics, gets only its message.
+        response = requests.get("http://localhost:%d/weather.london/alice?max=10" % self.port_number)
+        self.assertEqual(decode_frames(response.content), ['cloudy'])
+
+    def testMultiLevelWildcard(self):
+        # "#" has to be escaped as "%23" in a URL.
+        response = requests.post("http://localhost:%d/orders.eu.%%23/bob" % self.port_number, data='')
+        self.assertEqual(response.status_code, 200)
+        for topic in ['orders.eu', 'orders.eu.fr.paris', 'orders.us']:
+            response = requests.post("http://localhost:%d/%s" % (self.port_number, topic), data=topic)
+            self.assertEqual(response.status_code, 200)
+        response = requests.get("http://localhost:%d/orders.eu.%%23/bob?max=10" % self.port_number)
+        self.assertEqual(decode_frames(response.content), ['orders.eu', 'orders.eu.fr.paris'])
+        # Once Bob unsubscribes, nothing should match any more.
+        response = requests.delete("http://localhost:%d/orders.eu.%%23/bob" % self.port_number)
+        self.assertEqual(response.status_code, 200)
+        response = requests.post("http://localhost:%d/" % self.port_number,
+                data=encode_frames(['orders.eu', 'dropped']), headers={'Content-Type': FRAMED_CONTENT_TYPE})
+        self.assertEqual(response.json(), [None])
+
+    def testPostToWildcardGives400(self):
+        response = requests.post("http://localhost:%d/weather.*/bob" % self.port_number, data='')
+        self.assertEqual(response.status_code, 200)
+        response = requests.post("http://localhost:%d/weather.*" % self.port_number, data='cloudy')
+        self.assertEqual(response.status_code, 400)
+        response = requests.post("http://localhost:%d/" % self.port_number,
+                data=encode_frames(['weather.uk', 'cloudy', 'weather.*', 'sunny']),
+                headers={'Content-Type': FRAMED_CONTENT_TYPE})
+        self.assertEqual(response.status_code, 400)
+        # Nothing in the batch is published.
+        response = requests.get("http://localhost:%d/weather.*/bob" % self.port_number)
+        self.assertEqual(response.status_code, 204)
+
+    def testConsumerGroup(self):
+        for member in ['w1', 'w2']:
+            response = requests.post("http://localhost:%d/jobs/workers/%s" % (self.port_number, member), data='')
+            self.assertEqual(response.status_code, 200)
+        response = requests.post("http://localhost:%d/jobs" % self.port_number,
+                data=encode_frames(['a', 'b', 'c']), headers={'Content-Type': FRAMED_CONTENT_TYPE})
+        self.assertEqual(response.status_code, 200)
+        response = requests.get("http://localhost:%d/jobs/workers/w1" % self.port_number)
+        self.assertEqual(response.text, 'a')
+        response = requests.get("http://localhost:%d/jobs/workers/w2?max=10" % self.port_number)
+        self.assertEqual(decode_frames(response.content), ['b', 'c'])
+        # W1 leaves without acknowledging its message, so W2 gets it.
+        response = requests.delete("http://localhost:%d/jobs/workers/w1" % self.port_number)
+        self.assertEqual(response.status_code, 200)
+        response = requests.get("http://localhost:%d/jobs/workers/w2" % self.port_number)
+        self.assertEqual(response.text, 'a')
+        response = requests.get("http://localhost:%d/jobs/workers/w2?wait=0.1" % self.port_number)
+        self.assertEqual(response.status_code, 204)
+        response = requests.get("http://localhost:%d/jobs/workers/w1" % self.port_number)
+        self.assertEqual(response.status_code, 404)
+
+    def testConsumerGroupLongPoll(self):
+        response = requests.post("http://localhost:%d/jobs/workers/w1" % self.port_number, data='')
+        self.assertEqual(response.status_code, 200)
+        responses = Queue()
+        def longPoll():
+            responses.put(requests.get("http://localhost:%d/jobs/workers/w1?wait=10" % self.port_number))
+        t = Thread(target=longPoll)
+        t.daemon = True
+        t.start()
+        time.sleep(0.2)
+        response = requests.post("http://localhost:%d/jobs" % self.port_number, data='a')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(responses.get(timeout=5).text, 'a')
+
+    def testUserFetch(self):
+        url = "http://localhost:%d" % self.port_number
+        self.assertEqual(requests.get(url + "/_user/bob").status_code, 404)
+        requests.post(url + "/weather/bob")
+        requests.post(url + "/news/bob")
+        requests.post(url + "/weather", data=encode_frames(['cloudy', 'sunny']),
+                headers={'Content-Type': FRAMED_CONTENT_TYPE})
+        requests.post(url + "/news", data='nothing new')
+        response = requests.get(url + "/_user/bob?max=10")
+        self.assertEqual(response.headers['Content-Type'], FRAMED_CONTENT_TYPE)
+        self.assertEqual(decode_frames(response.content), ['weather', 'cloudy', 'news', 'nothing new', 'weather', 'sunny'])
+        self.assertEqual(requests.get(url + "/_user/bob").status_code, 204)
+        self.assertEqual(requests.get(url + "/_user/bob?max_bytes=10").status_code, 400)
+        self.assertEqual(requests.post(url + "/_user/bob").status_code, 405)
+        responses = Queue()
+        Thread(target=lambda: responses.put(requests.get(url + "/_user/bob?wait=5"))).start()
+        time.sleep(0.2)
+        requests.post(url + "/news", data='breaking news')
+        response = responses.get(timeout=5)
+        self.assertEqual(decode_frames(response.content), ['news', 'breaking news'])
+
+    def testFilteredSubscription(self):
+        url = "http://localhost:%d" % self.port_number
+        response = requests.post(url + "/prices/bob", params={'filter': ['price>100', 'region=eu']})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(requests.post(url + "/prices/alice", params={'filter': 'price>'}).status_code, 400)
+        responses = Queue()
+        Thread(target=lambda: responses.put(requests.get(url + "/prices/bob?wait=5"))).start()
+        time.sleep(0.2)
+        # Messages the filter leaves out don't end the wait.
+        requests.post(url + "/prices", data='{"price": 150, "region": "us"}')
+        requests.post(url + "/prices", data='{"price": 150, "region": "eu"}')
+        response = responses.get(timeout=5)
+        self.assertEqual(response.content, '{"price": 150, "region": "eu"}')
+        self.assertEqual(requests.delete(url + "/prices/bob").status_code, 200)
+        self.assertEqual(requests.get(url + "/prices/bob").status_code, 404)
+
+    def testMessageTimeToLive(self):
+        response = requests.post("http://localhost:%d/weather/bob" % self.port_number, data='')
+        self.assertEqual(response.status_code, 200)
+        response = requests.post("http://localhost:%d/weather?ttl=0.1" % self.port_number, data='cloudy')
+        self.assertEqual(response.status_code, 200)
+        response = requests.post("http://localhost:%d/weather?ttl=-1" % self.port_number, data='sunny')
+        self.assertEqual(response.status_code, 400)
+        time.sleep(0.3)
+        response = requests.get("http://localhost:%d/weather/bob" % self.port_number)
+        self.assertEqual(response.status_code, 204)
+
+    def testCompressedMessage(self):
+        engine = PublishSubscribeTest.publisher.engine
+        engine.compress_min_bytes = 100
+        try:
+            message = '{"reading": 12.5}' * 1000
+            requests.post("http://localhost:%d/weather/bob" % self.port_number, data='')
+            requests.post("http://localhost:%d/weather" % self.port_number, data=message)
+            requests.post("http://localhost:%d/weather" % self.port_number, data=message)
+            requests.post("http://localhost:%d/weather" % self.port_number, data=message)
+            response = requests.get("http://localhost:%d/weather/bob" % self.port_number,
+                    headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+            self.assertTrue(int(response.headers['Content-Length']) < len(message))
+            self.assertEqual(response.content, message)
+            response = requests.get("http://localhost:%d/weather/bob" % self.port_number,
+                    headers={'Accept-Encoding': 'identity'})
+            self.assertFalse('Content-Encoding' in response.headers)
+            self.assertEqual(response.content, message)
+            # Framed responses aren't compressed.
+            response = requests.get("http://localhost:%d/weather/bob?max=10" % self.port_number,
+                    headers={'Accept-Encoding': 'gzip'})
+            self.assertFalse('Content-Encoding' in response.headers)
+            self.assertEqual(decode_frames(response.content), [message])
+        finally:
+            engine.compress_min_bytes = None
+
+    def testLeaseAndAcknowledge(self):
+        response = requests.post("http://localhost:%d/jobs/bob" % self.port_number, data='')
+        self.assertEqual(response.status_code, 200)
+        response = requests.post("http://localhost:%d/jobs" % self.port_number,
+                data=encode_frames(['a', 'b']), headers={'Content-Type': FRAMED_CONTENT_TYPE})
+        self.assertEqual(response.status_code, 200)
+        response = requests.get("http://localhost:%d/jobs/bob?lease=0.2&max=10" % self.port_number)
+        self.assertEqual(decode_frames(response.content), ['a', 'b'])
+        delivery_id = response.headers['X-Delivery-Id']
+        # Unacknowledged, the messages are given out again once
+        # the lease expires...
+        response = requests.get("http://localhost:%d/jobs/bob?lease=10" % self.port_number)
+        self.assertEqual(response.status_code, 204)
+        time.sleep(0.5)
+        response = requests.post("http://localhost:%d/jobs/bob?ack=%s" % (self.port_number, delivery_id))
+        self.assertEqual(response.status_code, 404)
+        response = requests.get("http://localhost:%d/jobs/bob?lease=10" % self.port_number)
+        self.assertEqual(response.text, 'a')
+        delivery_id = response.headers['X-Delivery-Id']
+        # ...until they are acknowledged.
+        response = requests.post("http://localhost:%d/jobs/bob?ack=%s" % (self.port_number, delivery_id))
+        self.assertEqual(response.status_code, 200)
+        response = requests.get("http://localhost:%d/jobs/bob" % self.port_number)
+        self.assertEqual(response.text, 'b')
+        response = requests.get("http://localhost:%d/jobs/bob?lease=10" % self.port_number)
+        self.assertEqual(response.status_code, 204)
+        response = requests.get("http://localhost:%d/jobs/bob?lease=10&stream=1" % self.port_number)
+        self.assertEqual(response.status_code, 400)
+        response = requests.post("http://localhost:%d/jobs/bob?ack=x" % self.port_number)
+        self.assertEqual(response.status_code, 400)
+
     ###########################################################
     # A set of simple load tests to validate that the server
     # will stay up under load.
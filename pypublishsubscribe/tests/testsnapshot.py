@@ -0,0 +1,109 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from pypublishsubscribe.engine import PublishSubscribeEngine
+from pypublishsubscribe.snapshot import write_snapshot, read_snapshot, RestoredTopic
+from pypublishsubscribe.topic import Topic
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "snapshot")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testRoundTrip(self):
+        topic = Topic()
+        topic.subscribe('bob')
+        topic.subscribe('alice')
+        topic.extend(['cloudy', 'sunny', 'windy'])
+        topic.extend(['foggy'], time.time() + 60)
+        self.assertEqual(topic.next_message('alice'), 'cloudy')
+        topic.join_group('workers', 'w1')
+        topic.join_group('workers', 'w2')
+        topic.extend(['a', 'b'])
+        self.assertEqual(topic.next_group_messages('workers', 'w1', 1), ['a'])
+        delivery_id, messages = topic.lease_messages('bob', 1)
+        write_snapshot({'weather': topic}, self.path)
+        topics = read_snapshot(self.path)
+        restored = topics['weather']
+        self.assertTrue(isinstance(restored, RestoredTopic))
+        self.assertEqual(len(restored), len(topic))
+        self.assertEqual(restored.bytes, topic.bytes)
+        self.assertEqual(len(restored.expiries), 1)
+        # Bob hadn't acknowledged his lease, so is given it again.
+        self.assertEqual(restored.next_messages('bob', 10), ['cloudy', 'sunny', 'windy', 'foggy', 'a', 'b'])
+        self.assertEqual(restored.next_messages('alice', 10), ['sunny', 'windy', 'foggy', 'a', 'b'])
+        # So is the message w1 hadn't acknowledged, though to any member.
+        self.assertEqual(restored.next_group_messages('workers', 'w2', 10), ['a'])
+        self.assertEqual(restored.next_group_messages('workers', 'w2', 10), ['b'])
+        # Delivery ids given out before the snapshot aren't reused.
+        self.assertTrue(next(restored.delivery_ids) > delivery_id)
+
+    def testRestoredTopicKeepsWorking(self):
+        topic = Topic()
+        topic.subscribe('bob')
+        topic.extend(['message %d' % i for i in range(10)])
+        write_snapshot({'weather': topic}, self.path)
+        restored = read_snapshot(self.path, max_messages=5)['weather']
+        # The tighter limit drops the oldest messages.
+        self.assertEqual(len(restored), 5)
+        self.assertEqual(restored.evicted, 5)
+        restored.extend(['new'])
+        self.assertEqual(restored.next_messages('bob', 2), ['message 6', 'message 7'])
+        self.assertEqual(restored.bytes, len('message 8') * 2 + len('new'))
+        self.assertEqual(restored.next_messages('bob', 10), ['message 8', 'message 9', 'new'])
+        self.assertEqual(restored.bytes, 0)
+        restored.unsubscribe('bob')
+        self.assertEqual(restored.log.data, None)
+
+    def testExpiredMessagesStayExpired(self):
+        topic = Topic()
+        topic.subscribe('bob')
+        topic.extend(['cloudy'])
+        topic.extend(['sunny'], time.time() - 1)
+        topic.extend(['windy'])
+        topic.expire(time.time())
+        write_snapshot({'weather': topic}, self.path)
+        restored = read_snapshot(self.path)['weather']
+        self.assertEqual(restored.expired, 1)
+        self.assertEqual(restored.next_messages('bob', 10), ['cloudy', 'windy'])
+
+    def testNotASnapshot(self):
+        with open(self.path, "wb") as not_a_snapshot:
+            not_a_snapshot.write("not a snapshot")
+        self.assertRaises(ValueError, read_snapshot, self.path)
+
+    def testEngineSnapshotAndRestore(self):
+        engine = PublishSubscribeEngine()
+        engine.subscribe('weather', 'bob')
+        engine.subscribe('news.#', 'alice')
+        engine.subscribe('news.#', 'carol', ['urgent'])
+        engine.publish('weather', ['cloudy'])
+        engine.publish('news.uk', ['nothing new'], ttl=60)
+        self.assertTrue(engine.snapshot(self.path))
+        # Changes after the fork aren't in the snapshot.
+        engine.publish('weather', ['sunny'])
+        for attempt in range(100):
+            engine.expire()
+            if engine.snapshot_writer is None:
+                break
+            time.sleep(0.05)
+        self.assertTrue('pubsub_snapshots_total{result="ok"} 1' in engine.metrics.render())
+        restored = PublishSubscribeEngine()
+        restored.restore(self.path)
+        self.assertEqual(restored.user_topics('alice'), ['news.#'])
+        self.assertEqual(restored.take_messages('weather', 'bob', 10), ['cloudy'])
+        self.assertEqual(restored.publish('news.sport', ['a goal']), [1])
+        self.assertEqual(restored.take_messages('news.#', 'alice', 10), ['nothing new', 'a goal'])
+        self.assertEqual(len(restored.message_wheel), 1)
+        # Filtered subscriptions are restored with their filters.
+        restored.publish('news.uk', ['{"urgent": true}'])
+        self.assertEqual(restored.take_messages('news.#', 'carol', 10), ['{"urgent": true}'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import unittest
+from pypublishsubscribe import spill
+from pypublishsubscribe.spill import SpillingTopic
+from pypublishsubscribe.topic import MemoryBudget
+
+class SpillingTopicTest(unittest.TestCase):
+    """Tests that messages spilled out of memory are read back
+       transparently."""
+
+    def testSpilledMessagesReadBack(self):
+        topic = SpillingTopic(max_bytes=10)
+        topic.subscribe('bob')
+        topic.extend(['message %d' % i for i in range(5)])
+        # Only the newest message fits in memory.
+        self.assertEqual(topic.bytes, 9)
+        self.assertEqual(topic.spilled, 4)
+        self.assertEqual(topic.evicted, 0)
+        self.assertEqual(topic.next_messages('bob', 2), ['message 0', 'message 1'])
+        topic.append('message 5')
+        self.assertEqual(topic.next_messages('bob', 10), ['message %d' % i for i in range(2, 6)])
+        self.assertEqual(topic.bytes, 0)
+        self.assertEqual(len(topic.log.overflow), 0)
+        topic.close()
+
+    def testSharedBudget(self):
+        budget = MemoryBudget(20)
+        first = SpillingTopic(budget=budget)
+        second = SpillingTopic(budget=budget)
+        first.subscribe('bob')
+        second.subscribe('bob')
+        first.extend(['a' * 10, 'b' * 10])
+        second.append('c' * 10)
+        # The second topic had to spill its own message, as it had
+        # nothing older in memory.
+        self.assertEqual(budget.used, 20)
+        self.assertEqual(second.next_message('bob'), 'c' * 10)
+        self.assertEqual(first.next_messages('bob', 10), ['a' * 10, 'b' * 10])
+        self.assertEqual(budget.used, 0)
+        first.close()
+        second.close()
+
+    def testCountLimitStillDropsOldest(self):
+        topic = SpillingTopic(max_messages=3, max_bytes=1)
+        topic.subscribe('bob')
+        topic.extend(['1', '2', '3', '4'])
+        self.assertEqual(topic.evicted, 1)
+        self.assertEqual(topic.next_messages('bob', 10), ['2', '3', '4'])
+        topic.close()
+
+    def testOverflowFileCompacted(self):
+        original = spill.COMPACT_BYTES
+        spill.COMPACT_BYTES = 20
+        try:
+            topic = SpillingTopic(max_bytes=1)
+            topic.subscribe('bob')
+            topic.extend(['%02d' % i for i in range(30)])
+            self.assertEqual(topic.next_messages('bob', 15), ['%02d' % i for i in range(15)])
+            # The file was rewritten without the messages received.
+            self.assertEqual(topic.log.overflow.size, 30)
+            self.assertEqual(topic.log.overflow.offsets[0], 0)
+            self.assertEqual(topic.next_messages('bob', 20), ['%02d' % i for i in range(15, 30)])
+            topic.close()
+        finally:
+            spill.COMPACT_BYTES = original
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+import os
+import shutil
+import tempfile
+import unittest
+from pypublishsubscribe.storage import SegmentStore
+
+class SegmentStoreTest(unittest.TestCase):
+    """Tests that topics kept in a SegmentStore are recovered
+       correctly after a restart."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = SegmentStore(self.directory, segment_bytes=100)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def restart(self, max_messages=500):
+        # Simulate a restart by syncing everything, closing all
+        # the files and recovering into a new store.
+        self.store.sync_now()
+        for topic in self.topics.values():
+            topic.close()
+        self.store = SegmentStore(self.directory, segment_bytes=100)
+        self.topics = self.store.recover(max_messages)
+        return self.topics
+
+    def testMessagesAndCursorsRecovered(self):
+        topic = self.store.create_topic('weather', 500)
+        self.topics = {'weather': topic}
+        topic.subscribe('alice')
+        topic.subscribe('bob')
+        for i in range(20):
+            topic.append('message %d' % i)
+        for i in range(5):
+            self.assertEqual(topic.next_message('alice'), 'message %d' % i)
+        topic = self.restart()['weather']
+        # Each subscriber should carry on from where they were.
+        self.assertEqual(topic.next_message('alice'), 'message 5')
+        self.assertEqual(topic.next_message('bob'), 'message 0')
+        self.assertEqual(topic.next_messages('bob', 100)[-1], 'message 19')
+        # New messages should follow on from the recovered ones.
+        self.assertEqual(topic.append('message 20'), 20)
+        self.assertEqual(topic.next_message('bob'), 'message 20')
+
+    def testByteLimitAppliedOnRecovery(self):
+        topic = self.store.create_topic('weather', 500)
+        self.topics = {'weather': topic}
+        topic.subscribe('alice')
+        for i in range(20):
+            topic.append('message %02d' % i)
+        self.assertEqual(topic.bytes, 200)
+        self.store.sync_now()
+        for topic in self.topics.values():
+            topic.close()
+        self.store = SegmentStore(self.directory, segment_bytes=100)
+        self.topics = self.store.recover(500, max_bytes=50)
+        topic = self.topics['weather']
+        self.assertEqual(topic.bytes, 50)
+        self.assertEqual(topic.next_messages('alice', 100), ['message %02d' % i for i in range(15, 20)])
+        self.assertEqual(topic.bytes, 0)
+
+    def testSegmentsDeletedWithLastSubscriber(self):
+        topic = self.store.create_topic('weather', 500)
+        self.topics = {'weather': topic}
+        topic.subscribe('alice')
+        for i in range(50):
+            topic.append('message %d' % i)
+        topic.unsubscribe('alice')
+        self.assertEqual(topic.log.segments, [])
+        self.assertEqual([name for name in os.listdir(topic.directory) if name.endswith('.seg')], [])
+        topic.subscribe('alice')
+        topic.append('message 50')
+        self.assertEqual(topic.next_message('alice'), 'message 50')
+
+    def testReceivedSegmentsDeleted(self):
+        topic = self.store.create_topic('weather', 500)
+        self.topics = {'weather': topic}
+        topic.subscribe('alice')
+        for i in range(50):
+            topic.append('message %d' % i)
+        segment_count = len(topic.log.segments)
+        self.assertTrue(segment_count > 2)
+        topic.next_messages('alice', 49)
+        # Only the segment holding the last message should remain.
+        self.assertEqual(len(topic.log.segments), 1)
+        topic = self.restart()['weather']
+        self.assertEqual(topic.next_message('alice'), 'message 49')
+        self.assertEqual(topic.next_message('alice'), None)
+
+    def testTruncatedRecordIgnored(self):
+        topic = self.store.create_topic('weather', 500)
+        self.topics = {'weather': topic}
+        topic.subscribe('alice')
+        topic.append('cloudy')
+        topic.append('sunny')
+        self.store.sync_now()
+        # Chop the end off the last record, as if the server
+        # crashed part way through writing it.
+        path = topic.log.segments[-1].path
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) - 2)
+        topic = self.restart()['weather']
+        self.assertEqual(topic.next_message('alice'), 'cloudy')
+        self.assertEqual(topic.next_message('alice'), None)
+
+    def testUnsubscribedTopicNotRecovered(self):
+        topic = self.store.create_topic('weather', 500)
+        self.topics = {'weather': topic}
+        topic.subscribe('alice')
+        topic.subscribe('bob')
+        topic.append('cloudy')
+        topic.unsubscribe('bob')
+        topic = self.restart()['weather']
+        self.assertFalse('bob' in topic)
+        self.store.delete_topic(topic)
+        self.topics = {}
+        self.assertEqual(self.restart(), {})
+
+    def testGroupMembersRecovered(self):
+        topic = self.store.create_topic('jobs', 500)
+        self.topics = {'jobs': topic}
+        topic.join_group('workers', 'w1')
+        topic.join_group('workers', 'w2')
+        topic.join_group('workers', 'w3')
+        topic.leave_group('workers', 'w3')
+        topic.append('a')
+        topic.append('b')
+        self.assertEqual(topic.next_group_messages('workers', 'w1', 1), ['a'])
+        topic = self.restart()['jobs']
+        self.assertTrue(topic.is_group_member('workers', 'w1'))
+        self.assertTrue(topic.is_group_member('workers', 'w2'))
+        self.assertFalse(topic.is_group_member('workers', 'w3'))
+        self.assertEqual(topic.next_group_messages('workers', 'w2', 10), ['b'])
+        # Once every member has left, the topic isn't recovered.
+        topic.leave_group('workers', 'w1')
+        topic.leave_group('workers', 'w2')
+        self.assertEqual(self.restart(), {})
+
+    def testGroupCursorWithoutMembersDropped(self):
+        topic = self.store.create_topic('jobs', 500)
+        self.topics = {'jobs': topic}
+        topic.subscribe('alice')
+        topic.join_group('workers', 'w1')
+        topic.append('a')
+        # A journal written before members were kept has just the
+        # group's cursor.
+        topic.journal.compact(topic.cursors, {})
+        topic = self.restart()['jobs']
+        self.assertEqual(topic.groups, {})
+        self.assertEqual(list(topic.cursors), ['alice'])
+        self.assertEqual(topic.next_message('alice'), 'a')
+        self.assertEqual(len(topic), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,32 @@
+import unittest
+from pypublishsubscribe.timerwheel import TimerWheel
+
+class TimerWheelTest(unittest.TestCase):
+
+    def testItemsExpireAfterDeadline(self):
+        wheel = TimerWheel(tick=1, slots=8)
+        wheel.add(2.5, 'a')
+        wheel.add(3, 'b')
+        wheel.add(20, 'c')
+        self.assertEqual(len(wheel), 3)
+        self.assertEqual(wheel.expire(2.9), [])
+        self.assertEqual(wheel.expire(3), ['a', 'b'])
+        # 'c' shares a slot with earlier ticks, on a later turn.
+        self.assertEqual(wheel.expire(19.5), [])
+        self.assertEqual(wheel.expire(20), ['c'])
+        self.assertEqual(len(wheel), 0)
+
+    def testLongGapExpiresEverything(self):
+        wheel = TimerWheel(tick=1, slots=4)
+        for deadline in range(1, 10):
+            wheel.add(deadline, deadline)
+        self.assertEqual(sorted(wheel.expire(100)), range(1, 10))
+
+    def testPastDeadlineExpiresOnNextTick(self):
+        wheel = TimerWheel(tick=1, slots=4, now=10)
+        wheel.add(5, 'late')
+        self.assertEqual(wheel.expire(10.5), [])
+        self.assertEqual(wheel.expire(11), ['late'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,274 @@
+import time
+import unittest
+from pypublishsubscribe.topic import Topic, MemoryBudget, TopicFull, ServerFull, REJECT
+
+class TopicTest(unittest.TestCase):
+    """Tests for the shared log and per-subscriber cursors
+       that back each topic."""
+
+    def testMessageTrimmedOnceAllSubscribersReceive(self):
+        topic = Topic()
+        topic.subscribe('alice')
+        topic.subscribe('bob')
+        topic.append('cloudy')
+        self.assertEqual(topic.next_message('alice'), 'cloudy')
+        # Bob still needs the message, so it should be kept.
+        self.assertEqual(len(topic), 1)
+        self.assertEqual(topic.next_message('bob'), 'cloudy')
+        self.assertEqual(len(topic), 0)
+        self.assertEqual(topic.next_message('bob'), None)
+
+    def testMessageSharedByAllSubscribers(self):
+        # However many subscribers there are, each message
+        # is only held in the log once.
+        topic = Topic()
+        for i in range(1000):
+            topic.subscribe('user%d' % i)
+        topic.append('cloudy')
+        self.assertEqual(len(topic.log), 1)
+
+    def testUnsubscribeReleasesMessages(self):
+        topic = Topic()
+        topic.subscribe('alice')
+        topic.subscribe('bob')
+        for i in range(10):
+            topic.append('message %d' % i)
+        for i in range(10):
+            topic.next_message('alice')
+        # Only Bob is holding these messages, so unsubscribing
+        # him should leave the log empty.
+        self.assertEqual(len(topic), 10)
+        topic.unsubscribe('bob')
+        self.assertEqual(len(topic), 0)
+        self.assertFalse('bob' in topic)
+
+    def testOldestMessageEvictedWhenFull(self):
+        topic = Topic(max_messages=3)
+        topic.subscribe('alice')
+        for i in range(5):
+            topic.append('message %d' % i)
+        self.assertEqual(len(topic), 3)
+        # Alice's cursor pointed at an evicted message, so she
+        # should continue from the oldest one that remains.
+        self.assertEqual(topic.next_message('alice'), 'message 2')
+        self.assertEqual(topic.next_message('alice'), 'message 3')
+        self.assertEqual(topic.next_message('alice'), 'message 4')
+        self.assertEqual(topic.next_message('alice'), None)
+        self.assertEqual(len(topic), 0)
+
+    def testSubscriberOnlySeesLaterMessages(self):
+        topic = Topic()
+        topic.subscribe('alice')
+        topic.append('cloudy')
+        topic.subscribe('bob')
+        topic.append('sunny')
+        self.assertEqual(topic.next_message('bob'), 'sunny')
+        self.assertEqual(topic.next_message('alice'), 'cloudy')
+
+    def testGroupMembersShareMessages(self):
+        topic = Topic()
+        topic.join_group('workers', 'w1')
+        topic.join_group('workers', 'w2')
+        topic.subscribe('alice')
+        for i in range(4):
+            topic.append('message %d' % i)
+        # Each message goes to just one member of the group...
+        self.assertEqual(topic.next_group_messages('workers', 'w1', 3), ['message 0', 'message 1', 'message 2'])
+        self.assertEqual(topic.next_group_messages('workers', 'w2', 3), ['message 3'])
+        self.assertEqual(topic.next_group_messages('workers', 'w2', 3), [])
+        # ...but ordinary subscribers still get every message.
+        self.assertEqual(len(topic.next_messages('alice', 10)), 4)
+
+    def testInFlightMessagesRedeliveredWhenMemberLeaves(self):
+        topic = Topic()
+        topic.join_group('workers', 'w1')
+        topic.join_group('workers', 'w2')
+        for i in range(3):
+            topic.append('message %d' % i)
+        self.assertEqual(topic.next_group_messages('workers', 'w1', 2), ['message 0', 'message 1'])
+        # W1 leaves without acknowledging, so W2 gets its messages
+        # before any new ones.
+        topic.leave_group('workers', 'w1')
+        self.assertEqual(topic.next_group_messages('workers', 'w2', 10), ['message 0', 'message 1'])
+        self.assertEqual(topic.next_group_messages('workers', 'w2', 10), ['message 2'])
+        # When the last member leaves the group's cursor goes too.
+        topic.leave_group('workers', 'w2')
+        self.assertEqual(topic.cursors, {})
+        self.assertFalse(topic.is_group_member('workers', 'w2'))
+
+    def testLeasedMessagesKeptUntilAcknowledged(self):
+        topic = Topic()
+        topic.subscribe('bob')
+        for i in range(3):
+            topic.append('message %d' % i)
+        first, messages = topic.lease_messages('bob', 2, deadline=10)
+        self.assertEqual(messages, ['message 0', 'message 1'])
+        second, messages = topic.lease_messages('bob', 2, deadline=10)
+        self.assertEqual(messages, ['message 2'])
+        self.assertEqual(topic.lease_messages('bob', 2, deadline=10), (None, []))
+        # Acknowledging out of order commits nothing until the
+        # oldest lease is acknowledged too.
+        self.assertTrue(topic.acknowledge('bob', second))
+        self.assertEqual(len(topic.log), 3)
+        self.assertTrue(topic.acknowledge('bob', first))
+        self.assertEqual(len(topic.log), 0)
+        self.assertFalse(topic.acknowledge('bob', first))
+
+    def testExpiredLeaseRedelivered(self):
+        topic = Topic()
+        topic.subscribe('bob')
+        for i in range(3):
+            topic.append('message %d' % i)
+        first, messages = topic.lease_messages('bob', 3, deadline=10)
+        self.assertTrue(topic.expire_lease('bob', first, 10))
+        self.assertFalse(topic.acknowledge('bob', first))
+        # The expired messages come back first, in smaller leases
+        # if asked for fewer.
+        second, messages = topic.lease_messages('bob', 2, deadline=20)
+        self.assertEqual(messages, ['message 0', 'message 1'])
+        third, messages = topic.lease_messages('bob', 2, deadline=20)
+        self.assertEqual(messages, ['message 2'])
+        topic.append('message 3')
+        self.assertEqual(topic.next_messages('bob', 10), ['message 3'])
+        self.assertTrue(topic.acknowledge('bob', second))
+        self.assertTrue(topic.acknowledge('bob', third))
+        self.assertEqual(len(topic.log), 0)
+        self.assertEqual(topic.leases, {})
+
+    def testByteLimitDropsOldest(self):
+        topic = Topic(max_bytes=10)
+        topic.subscribe('bob')
+        topic.extend(['1234', '5678'])
+        self.assertEqual(topic.bytes, 8)
+        topic.append('abcd')
+        self.assertEqual(topic.bytes, 8)
+        self.assertEqual(topic.evicted, 1)
+        self.assertEqual(topic.next_messages('bob', 10), ['5678', 'abcd'])
+        self.assertEqual(topic.bytes, 0)
+
+    def testBudgetDropsFromLargestTopic(self):
+        budget = MemoryBudget(20)
+        large = Topic(budget=budget)
+        small = Topic(budget=budget)
+        large.subscribe('bob')
+        small.subscribe('alice')
+        large.extend(['1234567890', '0987654321'])
+        self.assertEqual(small.append('hello'), 0)
+        # Room is made in the topic holding the most, rather than
+        # by dropping what was just published.
+        self.assertEqual(small.next_messages('alice', 10), ['hello'])
+        self.assertEqual(small.evicted, 0)
+        self.assertEqual(large.evicted, 1)
+        self.assertEqual(large.next_messages('bob', 10), ['0987654321'])
+        self.assertEqual(budget.used, 0)
+
+    def testBudgetCostDoesntGrowWithTopics(self):
+        def publish_time(topic_count):
+            budget = MemoryBudget(100 * topic_count)
+            topics = [Topic(budget=budget) for i in range(topic_count)]
+            for topic in topics:
+                topic.subscribe('bob')
+                topic.append('x' * 100)
+            # The server is full, so each publish from here on drops
+            # a message somewhere.
+            start = time.time()
+            for i in range(2000):
+                topics[i % topic_count].append('y' * 100)
+            self.assertEqual(budget.used, 100 * topic_count)
+            return time.time() - start
+        few = min(publish_time(10) for attempt in range(3))
+        many = min(publish_time(5000) for attempt in range(3))
+        # Looking through every topic on each publish would make
+        # this around 100 times slower.
+        self.assertTrue(many < few * 5 + 0.01, (few, many))
+
+    def testRejectPolicy(self):
+        budget = MemoryBudget(12)
+        topic = Topic(max_messages=3, max_bytes=8, overflow=REJECT, budget=budget)
+        other = Topic(overflow=REJECT, budget=budget)
+        topic.subscribe('bob')
+        other.subscribe('alice')
+        topic.extend(['1234', '5678'])
+        # Nothing is appended from a batch that doesn't fit.
+        self.assertRaises(TopicFull, topic.extend, ['a', 'b'])
+        self.assertEqual(len(topic), 2)
+        self.assertRaises(ServerFull, other.append, '12345')
+        other.append('1234')
+        self.assertEqual(budget.used, 12)
+        topic.next_message('bob')
+        self.assertEqual(budget.used, 8)
+        topic.append('abcd')
+        self.assertRaises(TopicFull, topic.append, 'x')
+
+    def testExpiredMessagesSkipped(self):
+        topic = Topic()
+        topic.subscribe('alice')
+        topic.subscribe('bob')
+        topic.extend(['cloudy', 'sunny'], expires=10)
+        topic.append('windy')
+        topic.extend(['rainy'], expires=5)
+        self.assertEqual(topic.next_message('alice'), 'cloudy')
+        self.assertEqual(topic.expire(9), 1)
+        self.assertEqual(topic.next_messages('alice', 10), ['sunny', 'windy'])
+        # Alice has had "cloudy", but Bob hasn't, so it expires too.
+        self.assertEqual(topic.expire(10), 2)
+        self.assertEqual(topic.bytes, 5)
+        # Bob's unread messages go from the start of the log at
+        # once, but the message after them stays for him.
+        self.assertEqual(topic.first_seq, 2)
+        self.assertEqual(topic.next_messages('bob', 10), ['windy'])
+        self.assertEqual(topic.expired, 3)
+        self.assertEqual(topic.expire(100), 0)
+
+    def testExpiredLeaseNotRedelivered(self):
+        topic = Topic()
+        topic.subscribe('bob')
+        topic.extend(['cloudy', 'sunny'], expires=10)
+        topic.append('windy')
+        first, messages = topic.lease_messages('bob', 2, deadline=5)
+        second, messages = topic.lease_messages('bob', 1, deadline=5)
+        self.assertTrue(topic.expire_lease('bob', first, 5))
+        self.assertTrue(topic.acknowledge('bob', second))
+        # The lease's messages expired while waiting to be given
+        # out again, so there is nothing left to lease...
+        topic.expire(10)
+        self.assertEqual(topic.lease_messages('bob', 10, deadline=20), (None, []))
+        # ...and having been acknowledged, "windy" isn't given out
+        # again either.
+        topic.append('rainy')
+        self.assertEqual(topic.next_messages('bob', 10), ['rainy'])
+        self.assertEqual(topic.leases, {})
+
+    def testExpiredGroupMessagesNotRedelivered(self):
+        topic = Topic()
+        topic.join_group('workers', 'w1')
+        topic.join_group('workers', 'w2')
+        topic.extend(['cloudy', 'sunny'], expires=10)
+        topic.append('windy')
+        self.assertEqual(topic.next_group_messages('workers', 'w1', 3), ['cloudy', 'sunny', 'windy'])
+        topic.leave_group('workers', 'w1')
+        topic.expire(10)
+        self.assertEqual(topic.next_group_messages('workers', 'w2', 10), ['windy'])
+        # Messages still in flight when they expire aren't handed out
+        # again when their member leaves.
+        topic.join_group('workers', 'w3')
+        topic.extend(['rainy'], expires=20)
+        self.assertEqual(topic.next_group_messages('workers', 'w3', 10), ['rainy'])
+        topic.expire(20)
+        topic.leave_group('workers', 'w3')
+        self.assertEqual(topic.next_group_messages('workers', 'w2', 10), [])
+
+    def testLastUnsubscribeClearsLogAtOnce(self):
+        topic = Topic(max_messages=10000)
+        topic.subscribe('bob')
+        topic.extend(['message %d' % i for i in range(5000)])
+        topic.unsubscribe('bob')
+        self.assertEqual(len(topic), 0)
+        self.assertEqual(topic.log, {})
+        self.assertEqual(topic.bytes, 0)
+        topic.subscribe('bob')
+        self.assertEqual(topic.append('cloudy'), 5000)
+        self.assertEqual(topic.next_message('bob'), 'cloudy')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import math
+
+class TimerWheel(object):
+    """A hashed timing wheel, for tracking very many deadlines
+        cheaply. Time is divided into ticks, and each item is put
+        in the slot for the tick its deadline falls in, so adding
+        an item is constant time, and so is finding the expired
+        items, for each one found. An item may be reported up to
+        one tick after its deadline, but never before it.
+
+        Items can't be removed. Anything that no longer needs to
+        expire should be ignored when it is reported."""
+
+    def __init__(self, tick=0.1, slots=1024, now=0.0):
+        self.tick = tick
+        self.slots = [[] for i in xrange(slots)]
+        # The last tick whose items have all been reported.
+        self.current = int(now / tick)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, deadline, item):
+        # Round up, so that the item is only reported once its
+        # deadline has passed.
+        index = max(int(math.ceil(deadline / self.tick)), self.current + 1)
+        self.slots[index % len(self.slots)].append((index, item))
+        self.count += 1
+
+    def expire(self, now):
+        """Return the items whose deadlines have passed by "now"."""
+        target = int(now / self.tick)
+        if target <= self.current or not self.count:
+            self.current = max(self.current, target)
+            return []
+        expired = []
+        # Visit each slot between the last tick and this one, or
+        # every slot once if more time than that has passed. A
+        # slot also holds items for later turns of the wheel,
+        # which are kept.
+        steps = min(target - self.current, len(self.slots))
+        for step in xrange(1, steps + 1):
+            position = (self.current + step) % len(self.slots)
+            slot = self.slots[position]
+            if not slot:
+                continue
+            kept = []
+            for entry in slot:
+                if entry[0] <= target:
+                    expired.append(entry[1])
+                else:
+                    kept.append(entry)
+            self.slots[position] = kept
+        self.current = target
+        self.count -= len(expired)
+        return expired
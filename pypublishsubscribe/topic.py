@@ -0,0 +1,668 @@
+import heapq
+import itertools
+from collections import deque
+
+# Each consumer group reads the topic through a single cursor,
+# kept alongside those of ordinary subscribers under a key made
+# from this prefix and the group's name. Usernames may not
+# contain a NUL, so the keys can't clash.
+GROUP_CURSOR_PREFIX = "\0group\0"
+
+# What a topic does when a publish would take it over its limits:
+# drop its oldest messages, refuse the publish, or move its oldest
+# messages out of memory into an overflow file (see spill.py).
+DROP_OLDEST = "drop"
+REJECT = "reject"
+SPILL = "spill"
+OVERFLOW_POLICIES = (DROP_OLDEST, REJECT, SPILL)
+
+class TopicFull(Exception):
+    """A publish was refused because the topic has no room for it."""
+
+class ServerFull(Exception):
+    """A publish was refused because the server has no room for it."""
+
+class MemoryBudget(object):
+    """A limit on the bytes of messages held by every topic together.
+        Each topic adds the size of its messages to "used" as they
+        arrive, and takes it away as they go."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used = 0
+        # Every topic sharing the budget. Each adds itself when it
+        # is created, and the engine removes it along with the topic.
+        self.topics = set()
+        # The topics by the bytes they hold, most first, as a heap of
+        # (-bytes, count, topic). An entry is added whenever a topic
+        # grows, and entries that are out of date are only fixed, or
+        # dropped, when they reach the top, so an entry's bytes are
+        # never less than its topic holds now.
+        self.sizes = []
+        self.counter = itertools.count()
+
+    def grew(self, topic):
+        """Record that a topic now holds more bytes than before."""
+        heapq.heappush(self.sizes, (-topic.bytes, next(self.counter), topic))
+        if len(self.sizes) > 2 * len(self.topics) + 64:
+            # Most of the entries are out of date, so start again
+            # from those that aren't.
+            self.sizes = [(-each.bytes, next(self.counter), each) for each in self.topics if each.bytes]
+            heapq.heapify(self.sizes)
+
+    def largest_topic(self):
+        """Return the topic holding the most bytes, or None if
+            no topic holds any."""
+        sizes = self.sizes
+        while sizes:
+            negative_bytes, count, topic = sizes[0]
+            if topic not in self.topics or not topic.bytes:
+                heapq.heappop(sizes)
+            elif -negative_bytes != topic.bytes:
+                heapq.heapreplace(sizes, (-topic.bytes, next(self.counter), topic))
+            else:
+                return topic
+        return None
+
+def is_valid_name(name):
+    """Return True if a name can be used for a subscriber,
+        consumer group or group member."""
+    return "\0" not in name
+
+class ConsumerGroup(object):
+    """A set of members sharing one subscription to a topic, so
+        that each message is handed to just one of them."""
+
+    def __init__(self):
+        # The messages, as (sequence number, message) pairs, that
+        # each member has been given but not yet acknowledged.
+        self.in_flight = {}
+        # Messages given to members who left before acknowledging
+        # them, to be handed out again before any new messages.
+        self.redelivery = deque()
+
+class Lease(object):
+    """Messages given to a subscriber in at-least-once mode, which
+        will be given to them again unless acknowledged in time."""
+
+    __slots__ = ("seqs", "messages", "deadline", "done")
+
+    def __init__(self, seqs, messages, deadline):
+        self.seqs = seqs
+        self.messages = messages
+        self.deadline = deadline
+        # Set once the messages have been acknowledged, or handed
+        # out again under another lease.
+        self.done = False
+
+class LeaseState(object):
+    """The leases of one subscriber in at-least-once mode. Their
+        cursor stays at the oldest message they haven't yet
+        acknowledged, so that every message from there on is kept,
+        while "read_seq" is the next message that hasn't yet been
+        leased to them."""
+
+    def __init__(self, read_seq):
+        self.read_seq = read_seq
+        # Leases that haven't expired, keyed by delivery id.
+        self.leases = {}
+        # Leases that expired unacknowledged, to be handed out
+        # again before any new messages.
+        self.redelivery = deque()
+        # The first sequence number of every lease, to find the
+        # oldest one still outstanding. Entries for leases that are
+        # done are only removed once they reach the top.
+        self.starts = []
+
+class Topic(object):
+    """The storage for a single topic: one shared, append-only
+        log of messages, plus a read cursor for each subscriber."""
+
+    # Every message appended to a topic is given a sequence
+    # number, one greater than the message before it. The log
+    # is a dict from sequence number to message, holding every
+    # message from "first_seq" up to (but not including)
+    # "next_seq".
+    #
+    # Subclasses may keep the log somewhere else (see SegmentLog
+    # in storage.py, OverflowLog in spill.py and SnapshotLog in
+    # snapshot.py). Any log only needs what a Topic uses of the
+    # dict: "log[seq]" to read a message, "log[seq] = message" to
+    # append one at "next_seq" (or, in _discard, to replace one that
+    # has expired), "del log[seq]" for the oldest message only, and
+    # "clear" to drop every message at once.
+    #
+    # Each subscriber's cursor is the sequence number of the
+    # next message it should receive. Rather than recording which
+    # subscribers still need each message, we keep a count of
+    # how many subscribers have their cursor at each sequence
+    # number. Once no cursor points at the oldest message
+    # in the log, nobody can still need it and it is trimmed.
+    #
+    # This makes publishing, fetching and unsubscribing all
+    # (amortized) constant time, and the memory used by a message
+    # does not depend on how many subscribers the topic has.
+    #
+    # The topic holds at most "max_messages" messages and, if given,
+    # "max_bytes" bytes of them. "budget", if given, is a MemoryBudget
+    # shared with other topics. "overflow" is the policy (see above)
+    # applied when a publish would break any of those limits.
+    def __init__(self, max_messages=500, max_bytes=None, overflow=DROP_OLDEST, budget=None):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.overflow = overflow
+        self.budget = budget
+        if budget is not None:
+            budget.topics.add(self)
+        # The total size of the messages held in memory.
+        self.bytes = 0
+        self.log = {}
+        self.first_seq = 0
+        self.next_seq = 0
+        self.cursors = {}
+        self.cursor_counts = {}
+        self.waiters = set()
+        # The number of messages evicted before every
+        # subscriber had received them.
+        self.evicted = 0
+        # The time-to-live, in seconds, of every message published
+        # to the topic, or None if they don't expire. It is set by
+        # the engine, which also applies it (see extend).
+        self.ttl = None
+        # The filter, if this is a filtered subscription's view of a
+        # topic, that the engine applies to messages published to it
+        # (see filters.py).
+        self.filter = None
+        # The deadline of each batch of messages that will expire,
+        # as a heap of (deadline, first sequence number, sequence
+        # number after the last). Nothing is done at the deadline
+        # itself: expired messages are found when "expire" is next
+        # called.
+        self.expiries = []
+        # Messages that have expired but are still in the log, as
+        # some subscriber's cursor is behind them. They are skipped
+        # when read, and no longer count against the topic's limits.
+        self.expired_seqs = set()
+        # The number of messages that expired before every
+        # subscriber had received them.
+        self.expired = 0
+        self.groups = {}
+        # The state of each subscriber with messages leased to them
+        # (see lease_messages).
+        self.leases = {}
+        self.delivery_ids = itertools.count(1)
+
+    def __contains__(self, username):
+        return username in self.cursors
+
+    def __len__(self):
+        """The number of messages currently held in the log."""
+        return self.next_seq - self.first_seq
+
+    def subscribe(self, username):
+        """Subscribe a user, who will receive only messages
+            published from now on. Subscribing twice is a no-op."""
+        if username not in self.cursors:
+            self.cursors[username] = self.next_seq
+            self._add_to_count(self.next_seq)
+
+    def unsubscribe(self, username):
+        """Remove a user's subscription, releasing any messages
+            that were being kept only for them."""
+        cursor = self._cursor(username)
+        del self.cursors[username]
+        self.leases.pop(username, None)
+        self._remove_from_count(cursor)
+        self._trim()
+        self._notify_waiters()
+
+    def append(self, message):
+        """Append a message to the log, returning its
+            sequence number."""
+        return self.extend([message])[0]
+
+    def extend(self, messages, expires=None):
+        """Append several messages to the log in one pass,
+            returning a list of their sequence numbers. Under the
+            REJECT policy, raises TopicFull or ServerFull, having
+            appended nothing, if they don't all fit. If "expires" is
+            given, the messages expire at that time (see expire)."""
+        size = sum(map(len, messages))
+        if self.overflow == REJECT:
+            self.check_room(len(messages), size)
+        first = self.next_seq
+        log = self.log
+        for seq, message in enumerate(messages, first):
+            log[seq] = message
+        self.next_seq = first + len(messages)
+        self._add_bytes(size)
+        if expires is not None and messages:
+            heapq.heappush(self.expiries, (expires, first, self.next_seq))
+        self._make_room()
+        self._notify_waiters()
+        return range(first, self.next_seq)
+
+    def check_room(self, count, size):
+        """Raise TopicFull or ServerFull if "count" more messages,
+            of "size" bytes in all, would break the topic's limits."""
+        if len(self) + count > self.max_messages or \
+                (self.max_bytes is not None and self.bytes + size > self.max_bytes):
+            raise TopicFull("Topic is full")
+        if self.budget is not None and self.budget.used + size > self.budget.max_bytes:
+            raise ServerFull("Server is full")
+
+    def expire(self, now):
+        """Expire every message whose deadline has passed by "now",
+            returning how many did. Expired messages are never given
+            to a subscriber. They are dropped from the log at once
+            if they are the oldest in it, and otherwise once every
+            subscriber's cursor has passed them."""
+        expiries = self.expiries
+        if not expiries or expiries[0][0] > now:
+            return 0
+        count = 0
+        released = 0
+        ranges = []
+        while expiries and expiries[0][0] <= now:
+            deadline, start, stop = heapq.heappop(expiries)
+            ranges.append((start, stop))
+            # Some of the batch may have been trimmed already.
+            for seq in xrange(max(start, self.first_seq), stop):
+                released += self._size(seq)
+                self._discard(seq)
+                self.expired_seqs.add(seq)
+                count += 1
+        self._add_bytes(-released)
+        self.expired += count
+        while self.first_seq in self.expired_seqs:
+            self._drop_oldest()
+        if self.groups:
+            self._expire_group_messages(ranges)
+        return count
+
+    def _expire_group_messages(self, ranges):
+        # A consumer group's cursor has already passed the messages
+        # given to its members, so they may have left the log. Those
+        # that expired, from any of "ranges" of sequence numbers, are
+        # forgotten, so that they aren't handed out again if their
+        # member leaves, or are waiting to be.
+        def unexpired(pairs):
+            return [(seq, message) for seq, message in pairs
+                    if not any(start <= seq < stop for start, stop in ranges)]
+        for consumer_group in self.groups.itervalues():
+            redelivery = consumer_group.redelivery
+            if redelivery:
+                kept = unexpired(redelivery)
+                redelivery.clear()
+                redelivery.extend(kept)
+            for in_flight in consumer_group.in_flight.itervalues():
+                if in_flight:
+                    in_flight[:] = unexpired(in_flight)
+
+    def close(self):
+        """Release anything held by the topic outside of memory.
+            It can't be used afterwards."""
+
+    def next_message(self, username):
+        """Return the next message for this user, advancing
+            their cursor past it, or None if there isn't one."""
+        messages = self.next_messages(username, 1)
+        return messages[0] if messages else None
+
+    def next_messages(self, username, max_count, max_bytes=None):
+        """Return up to "max_count" of the next messages for this
+            user, advancing their cursor past all of them at once.
+            If "max_bytes" is given we stop before the total size
+            would exceed it, though the first message is always
+            returned so that a large message can't get stuck."""
+        if username in self.leases:
+            # Some messages are leased to this user, so their cursor
+            # is behind the messages they should get next. Lease
+            # those messages and acknowledge them straight away.
+            delivery_id, messages = self.lease_messages(username, max_count, max_bytes, None)
+            if delivery_id is not None:
+                self.acknowledge(username, delivery_id)
+            return messages
+        cursor = self._cursor(username)
+        messages, seq = self._read(cursor, max_count, max_bytes)
+        if seq != cursor:
+            self._move_cursor(username, cursor, seq)
+        return messages
+
+    def _read(self, seq, max_count, max_bytes=None, seqs=None):
+        # Read up to "max_count" messages (and "max_bytes" bytes, as
+        # for next_messages) from "seq" on, skipping any that have
+        # expired. Returns the messages and the sequence number to
+        # read from next time. If "seqs" is given, each message's
+        # sequence number is appended to it.
+        log = self.log
+        expired_seqs = self.expired_seqs
+        next_seq = self.next_seq
+        messages = []
+        total_bytes = 0
+        while seq < next_seq and len(messages) < max_count:
+            if expired_seqs and seq in expired_seqs:
+                seq += 1
+                continue
+            message = log[seq]
+            total_bytes += len(message)
+            if max_bytes is not None and messages and total_bytes > max_bytes:
+                break
+            messages.append(message)
+            if seqs is not None:
+                seqs.append(seq)
+            seq += 1
+        return messages, seq
+
+    def lease_messages(self, username, max_count, max_bytes=None, deadline=None):
+        """Lease up to "max_count" messages (and "max_bytes" bytes, as
+            for next_messages) to a user, for at-least-once delivery.
+            Returns a delivery id and the messages, or (None, []) if
+            there are none. The messages stay in the log until the
+            user acknowledges the delivery id. If they don't before
+            "deadline", expire_lease gives the messages to them again
+            under a new delivery id. Messages that expired are given
+            out before any new ones."""
+        state = self.leases.get(username)
+        if state is None:
+            state = self.leases[username] = LeaseState(self._cursor(username))
+        seqs = []
+        messages = []
+        total_bytes = 0
+        self._drop_gone_redelivery(username, state)
+        if state.redelivery:
+            expired = state.redelivery[0]
+            for seq, message in zip(expired.seqs, expired.messages):
+                total_bytes += len(message)
+                if len(messages) == max_count or (max_bytes is not None and messages and total_bytes > max_bytes):
+                    break
+                seqs.append(seq)
+                messages.append(message)
+            if len(messages) == len(expired.messages):
+                expired.done = True
+                state.redelivery.popleft()
+            else:
+                expired.seqs = expired.seqs[len(messages):]
+                expired.messages = expired.messages[len(messages):]
+        else:
+            messages, state.read_seq = self._read(max(state.read_seq, self.first_seq), max_count, max_bytes, seqs)
+        if not messages:
+            self._forget_leases(username, state)
+            return None, []
+        delivery_id = next(self.delivery_ids)
+        lease = state.leases[delivery_id] = Lease(seqs, messages, deadline)
+        heapq.heappush(state.starts, (seqs[0], delivery_id, lease))
+        return delivery_id, messages
+
+    def acknowledge(self, username, delivery_id):
+        """Acknowledge the messages leased under a delivery id, so
+            that they are never given to the user again. Returns
+            False if there is no such lease, perhaps because it
+            has expired."""
+        state = self.leases.get(username)
+        lease = state.leases.pop(delivery_id, None) if state is not None else None
+        if lease is None:
+            return False
+        lease.done = True
+        self._advance_lease_cursor(username, state)
+        self._forget_leases(username, state)
+        return True
+
+    def expire_lease(self, username, delivery_id, now):
+        """Expire a lease if its deadline has passed, so that its
+            messages are given to the user again. Returns True if
+            the lease expired."""
+        state = self.leases.get(username)
+        lease = state.leases.get(delivery_id) if state is not None else None
+        if lease is None or lease.deadline is None or lease.deadline > now:
+            return False
+        return self.release_lease(username, delivery_id)
+
+    def release_lease(self, username, delivery_id):
+        """Give the messages leased under a delivery id back to the
+            user at once, as if the lease had expired. Returns False
+            if there is no such lease."""
+        state = self.leases.get(username)
+        lease = state.leases.pop(delivery_id, None) if state is not None else None
+        if lease is None:
+            return False
+        state.redelivery.append(lease)
+        self._notify_waiters()
+        return True
+
+    def _advance_lease_cursor(self, username, state):
+        # Move the user's cursor up to the oldest message they
+        # haven't acknowledged.
+        starts = state.starts
+        while starts and starts[0][2].done:
+            heapq.heappop(starts)
+        new = min(starts[0][0], state.read_seq) if starts else state.read_seq
+        cursor = self._cursor(username)
+        if new > cursor:
+            self._move_cursor(username, cursor, new)
+
+    def _drop_gone_redelivery(self, username, state):
+        # Drop messages that expired, or were evicted, while waiting
+        # to be given out again, so that they are never delivered.
+        # Until a lease's messages are acknowledged they stay in the
+        # log, so any that aren't there have gone for good.
+        redelivery = state.redelivery
+        dropped = False
+        while redelivery:
+            lease = redelivery[0]
+            kept = [(seq, message) for seq, message in zip(lease.seqs, lease.messages)
+                    if seq >= self.first_seq and seq not in self.expired_seqs]
+            if len(kept) != len(lease.seqs):
+                lease.seqs = [seq for seq, message in kept]
+                lease.messages = [message for seq, message in kept]
+            if kept:
+                break
+            lease.done = True
+            redelivery.popleft()
+            dropped = True
+        if dropped:
+            self._advance_lease_cursor(username, state)
+
+    def _forget_leases(self, username, state):
+        # With nothing leased, the user's cursor has caught up with
+        # their reading, and the state is no longer needed.
+        if not state.leases and not state.redelivery:
+            del self.leases[username]
+
+    def join_group(self, group, member):
+        """Add a member to a consumer group, creating the group if
+            it doesn't exist yet. A new group receives only messages
+            published from now on."""
+        if group not in self.groups:
+            self.groups[group] = ConsumerGroup()
+            self.subscribe(GROUP_CURSOR_PREFIX + group)
+        self.groups[group].in_flight.setdefault(member, [])
+
+    def leave_group(self, group, member):
+        """Remove a member from a consumer group. Any messages it
+            had not acknowledged are handed out again to the other
+            members. When the last member leaves, the group goes."""
+        consumer_group = self.groups[group]
+        in_flight = consumer_group.in_flight.pop(member)
+        if not consumer_group.in_flight:
+            del self.groups[group]
+            self.unsubscribe(GROUP_CURSOR_PREFIX + group)
+            return
+        consumer_group.redelivery.extendleft(reversed(in_flight))
+        if in_flight:
+            self._notify_waiters()
+
+    def is_group_member(self, group, member):
+        return group in self.groups and member in self.groups[group].in_flight
+
+    def next_group_messages(self, group, member, max_count, max_bytes=None):
+        """Return up to "max_count" messages (and, if given, at most
+            "max_bytes" bytes of them) for a member of a consumer
+            group, which no other member of the group will be given.
+
+            Asking for more messages acknowledges the messages the
+            member was given last time. Until then they are tracked
+            as the member's in-flight messages, so that they can be
+            given to another member if this one leaves. Each member
+            has its own in-flight messages, so a slow member doesn't
+            hold up the rest of its group."""
+        consumer_group = self.groups[group]
+        in_flight = consumer_group.in_flight[member]
+        del in_flight[:]
+        redelivery = consumer_group.redelivery
+        if redelivery:
+            # Hand out messages left by departed members first. These
+            # are never mixed with new messages in one batch.
+            total_bytes = 0
+            while redelivery and len(in_flight) < max_count:
+                total_bytes += len(redelivery[0][1])
+                if max_bytes is not None and in_flight and total_bytes > max_bytes:
+                    break
+                in_flight.append(redelivery.popleft())
+        else:
+            key = GROUP_CURSOR_PREFIX + group
+            cursor = self._cursor(key)
+            seqs = []
+            messages, seq = self._read(cursor, max_count, max_bytes, seqs)
+            if seq != cursor:
+                self._move_cursor(key, cursor, seq)
+            in_flight.extend(zip(seqs, messages))
+        return [message for seq, message in in_flight]
+
+    def add_waiter(self, callback):
+        """Register a callback to be called, once, the next time
+            a message is appended or a subscriber leaves. This
+            lets a reader that found nothing wait for more."""
+        self.waiters.add(callback)
+
+    def remove_waiter(self, callback):
+        self.waiters.discard(callback)
+
+    def _notify_waiters(self):
+        if self.waiters:
+            waiters = self.waiters
+            self.waiters = set()
+            for callback in waiters:
+                callback()
+
+    def _cursor(self, username):
+        # A cursor may have fallen behind "first_seq" if the
+        # message it pointed at was evicted. Its count was moved
+        # along with the eviction, so treat it as being at the
+        # start of the log.
+        return max(self.cursors[username], self.first_seq)
+
+    def _move_cursor(self, username, old, new):
+        self.cursors[username] = new
+        self._remove_from_count(old)
+        self._add_to_count(new)
+        if old == self.first_seq:
+            self._trim()
+
+    def _add_to_count(self, seq):
+        self.cursor_counts[seq] = self.cursor_counts.get(seq, 0) + 1
+
+    def _remove_from_count(self, seq):
+        count = self.cursor_counts[seq] - 1
+        if count:
+            self.cursor_counts[seq] = count
+        else:
+            del self.cursor_counts[seq]
+
+    def _trim(self):
+        # Drop messages from the start of the log until we
+        # reach one that some cursor still points at.
+        if not self.cursor_counts:
+            # Nobody needs anything in the log, so rather than
+            # dropping the messages one at a time, drop them all
+            # at once.
+            self._clear_log()
+            return
+        released = 0
+        while self.first_seq < self.next_seq and \
+                self.first_seq not in self.cursor_counts:
+            released += self._release(self.first_seq)
+            self.first_seq += 1
+        if released:
+            self._add_bytes(-released)
+
+    def _clear_log(self):
+        self.log.clear()
+        self._add_bytes(-self.bytes)
+        self.first_seq = self.next_seq
+        self.expired_seqs.clear()
+        del self.expiries[:]
+
+    def _release(self, seq):
+        # Remove the oldest message from the log, returning
+        # the memory it had taken.
+        if seq in self.expired_seqs:
+            # Its memory was released when it expired.
+            self.expired_seqs.remove(seq)
+            size = 0
+        else:
+            size = self._size(seq)
+        del self.log[seq]
+        return size
+
+    def _size(self, seq):
+        # The memory taken by a message in the log.
+        return len(self.log[seq])
+
+    def _discard(self, seq):
+        # Release the memory taken by an expired message, which
+        # may have to stay in the log for a while yet.
+        self.log[seq] = ""
+
+    def _add_bytes(self, size):
+        self.bytes += size
+        if self.budget is not None:
+            self.budget.used += size
+            if size > 0:
+                self.budget.grew(self)
+
+    def _over_bytes(self):
+        return (self.max_bytes is not None and self.bytes > self.max_bytes) or \
+                (self.budget is not None and self.budget.used > self.budget.max_bytes)
+
+    def _make_room(self):
+        # Bring the topic back within its limits after an append.
+        # The count limit always holds, whatever the policy. Under
+        # DROP_OLDEST the byte limits do too: when the server as a
+        # whole is over its budget, room is made by dropping the
+        # oldest messages of whichever topic holds the most, which
+        # may be another one. Otherwise a topic holding the whole
+        # budget would leave none for the rest, and anything they
+        # were published would be dropped as soon as it arrived.
+        while len(self) > self.max_messages:
+            self._evict_oldest()
+        if self.overflow != DROP_OLDEST:
+            return
+        while len(self) and self.max_bytes is not None and self.bytes > self.max_bytes:
+            self._evict_oldest()
+        budget = self.budget
+        while budget is not None and budget.used > budget.max_bytes:
+            largest = budget.largest_topic()
+            if largest is None:
+                break
+            while largest.bytes and budget.used > budget.max_bytes:
+                largest._evict_oldest()
+
+    def _evict_oldest(self):
+        # The log is full, so drop the oldest message even though
+        # some subscribers have not received it.
+        if self.first_seq not in self.expired_seqs:
+            self.evicted += 1
+        self._drop_oldest()
+
+    def _drop_oldest(self):
+        # Drop the oldest message, whether or not everyone has
+        # received it. Any cursors pointing at it now point at
+        # the next message instead.
+        self._add_bytes(-self._release(self.first_seq))
+        count = self.cursor_counts.pop(self.first_seq, 0)
+        self.first_seq += 1
+        if count:
+            self.cursor_counts[self.first_seq] = \
+                self.cursor_counts.get(self.first_seq, 0) + count
+        self._trim()